@@ -3,7 +3,6 @@ from datetime import datetime, timedelta
 import time
 import asyncio
 import random
-import threading
 import os
 from app.utils import (
     log_manager,
@@ -19,6 +18,14 @@ from app.utils.maintenance import api_call_stats_clean
 from app.utils.logging import log, vertex_log_manager
 from app.config.persistence import save_settings
 from app.utils.stats import api_stats_manager
+from app.utils.race import RACE_POLICIES, hedge_delay
+from app.utils.concurrency import concurrency_controller
+from app.utils.circuit_breaker import key_breaker
+from app.utils.key_scheduler import SCHEDULER_MODES
+from app.utils.key_limits import key_rate_ledger, parse_rate_limits
+from app.utils.key_validation import key_validator, new_progress
+from app.utils.auth_cache import validated_key_cache
+from app.utils.http_client import reset_http_clients
 from typing import List
 import json
 
@@ -37,15 +44,8 @@ response_cache_manager = None
 active_requests_manager = None
 credential_manager = None  # 添加全局credential_manager变量
 
-# 用于存储API密钥检测的进度信息
-api_key_test_progress = {
-    "is_running": False,
-    "completed": 0,
-    "total": 0,
-    "valid": 0,
-    "invalid": 0,
-    "is_completed": False
-}
+# 用于存储API密钥检测的进度信息，检测过程中由检测引擎实时更新
+api_key_test_progress = new_progress()
 
 def init_dashboard_router(
     key_mgr,
@@ -88,9 +88,15 @@ async def run_blocking_init_vertex():
     except Exception as e:
         log('error', f"执行 run_blocking_init_vertex 时出错: {e}")
 
+# api_key_stats 每页的默认和最大密钥数
+API_KEY_STATS_PAGE_SIZE = 100
+API_KEY_STATS_MAX_PAGE_SIZE = 1000
+
 @dashboard_router.get("/dashboard-data")
-async def get_dashboard_data():
-    """获取仪表盘数据的API端点，用于动态刷新"""
+async def get_dashboard_data(key_page: int = 1, key_page_size: int = API_KEY_STATS_PAGE_SIZE):
+    """获取仪表盘数据的API端点，用于动态刷新；api_key_stats 按调用次数排序后分页返回"""
+    if key_page < 1 or not 1 <= key_page_size <= API_KEY_STATS_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=422, detail=f"参数值错误：key_page 应不小于1，key_page_size 应在1到{API_KEY_STATS_MAX_PAGE_SIZE}之间")
     # 先清理过期数据，确保统计数据是最新的
     await api_stats_manager.maybe_cleanup()
     await response_cache_manager.clean_expired()  # 使用管理器清理缓存
@@ -108,7 +114,8 @@ async def get_dashboard_data():
     time_series_data, tokens_time_series = api_stats_manager.get_time_series_data(30, now)
     
     # 获取API密钥使用统计
-    api_key_stats = api_stats_manager.get_api_key_stats(key_manager.api_keys)
+    api_key_stats = api_stats_manager.get_api_key_stats(
+        key_manager.api_keys, offset=(key_page - 1) * key_page_size, limit=key_page_size)
     
     # 根据ENABLE_VERTEX设置决定返回哪种日志
     if settings.ENABLE_VERTEX:
@@ -118,11 +125,22 @@ async def get_dashboard_data():
     
     # 获取缓存统计
     total_cache = response_cache_manager.cur_cache_num
+    cache_bytes = response_cache_manager.cur_cache_bytes
+    cache_evicted_bytes = response_cache_manager.evicted_bytes
+    disk_cache_entries = response_cache_manager.disk_tier.entry_count if response_cache_manager.disk_tier else 0
+    cache_compressed_entries = response_cache_manager.compressed_entries
+    cache_compression_ratio = round(response_cache_manager.compression_ratio, 2)
+    cache_compress_time_ms = round(response_cache_manager.compress_seconds * 1000, 2)
+    cache_decompress_time_ms = round(response_cache_manager.decompress_seconds * 1000, 2)
     
     # 获取活跃请求统计
     active_count = len(active_requests_manager.active_requests)
     active_done = sum(1 for task in active_requests_manager.active_requests.values() if task.done())
     active_pending = active_count - active_done
+    # 流式请求广播统计
+    active_streams = list(active_requests_manager.active_streams.values())
+    active_stream_count = len(active_streams)
+    active_stream_subscribers = sum(b.subscriber_count for b in active_streams)
 
     # 获取凭证数量
     credentials_count = 0
@@ -132,6 +150,9 @@ async def get_dashboard_data():
     # 返回JSON格式的数据
     return {
         "key_count": len(key_manager.api_keys),
+        # api_key_stats 的分页信息，总数即 key_count
+        "api_key_stats_page": key_page,
+        "api_key_stats_page_size": key_page_size,
         "model_count": len(GeminiClient.AVAILABLE_MODELS),
         "retry_count": settings.MAX_RETRY_NUM,
         "credentials_count": credentials_count,  # 添加凭证数量
@@ -143,6 +164,28 @@ async def get_dashboard_data():
         "current_time": datetime.now().strftime('%H:%M:%S'),
         "logs": recent_logs,
         "api_key_stats": api_key_stats,
+        # 密钥调度方式，各密钥的调度指标见 api_key_stats 中的 scheduler
+        "key_scheduler": settings.KEY_SCHEDULER,
+        # 按（密钥, 模型）限流配置、准入统计及当前需要等待的密钥数
+        "key_rate_limit_enabled": settings.KEY_RATE_LIMIT_ENABLED,
+        "key_rate_limit_max_wait": settings.KEY_RATE_LIMIT_MAX_WAIT,
+        "model_rate_limits": settings.MODEL_RATE_LIMITS,
+        "key_rate_limits": key_rate_ledger.snapshot(),
+        # 密钥检测并发数和同一上游主机的请求间隔
+        "key_check_concurrency": settings.KEY_CHECK_CONCURRENCY,
+        "key_check_interval": settings.KEY_CHECK_INTERVAL,
+        # 客户端 Gemini API 密钥验证结果缓存
+        "gemini_key_auth_ttl": settings.GEMINI_KEY_AUTH_TTL,
+        "gemini_key_auth_negative_ttl": settings.GEMINI_KEY_AUTH_NEGATIVE_TTL,
+        "gemini_key_auth_cache": validated_key_cache.snapshot(),
+        # 密钥熔断配置及处于熔断（open）或半开（half_open）状态的密钥
+        "breaker_enabled": settings.BREAKER_ENABLED,
+        "breaker_auth_cooldown": settings.BREAKER_AUTH_COOLDOWN,
+        "breaker_quota_cooldown": settings.BREAKER_QUOTA_COOLDOWN,
+        "breaker_quota_max_cooldown": settings.BREAKER_QUOTA_MAX_COOLDOWN,
+        "breaker_server_threshold": settings.BREAKER_SERVER_THRESHOLD,
+        "breaker_server_cooldown": settings.BREAKER_SERVER_COOLDOWN,
+        "key_breakers": key_breaker.snapshot(),
         # 添加配置信息
         "max_requests_per_minute": settings.MAX_REQUESTS_PER_MINUTE,
         "max_requests_per_day_per_ip": settings.MAX_REQUESTS_PER_DAY_PER_IP,
@@ -163,14 +206,66 @@ async def get_dashboard_data():
         "cache_entries": total_cache,
         "cache_expiry_time": settings.CACHE_EXPIRY_TIME,
         "max_cache_entries": settings.MAX_CACHE_ENTRIES,
+        "cache_bytes": cache_bytes,
+        "cache_evicted_bytes": cache_evicted_bytes,
+        "max_cache_bytes": settings.MAX_CACHE_BYTES,
+        "disk_cache_entries": disk_cache_entries,
+        "cache_compressed_entries": cache_compressed_entries,
+        "cache_compression_ratio": cache_compression_ratio,
+        "cache_compress_time_ms": cache_compress_time_ms,
+        "cache_decompress_time_ms": cache_decompress_time_ms,
         # 添加活跃请求池信息
         "active_count": active_count,
         "active_done": active_done,
         "active_pending": active_pending,
+        "active_stream_count": active_stream_count,
+        "active_stream_subscribers": active_stream_subscribers,
+        "stream_join_count": active_requests_manager.stream_join_count,
+        # 客户端断开后取消的请求（按类型）及中止的上游调用数
+        "cancelled_requests": dict(api_stats_manager.cancelled_requests),
+        "cancelled_upstream_calls": api_stats_manager.cancelled_upstream_calls,
         # 添加并发请求配置
         "concurrent_requests": settings.CONCURRENT_REQUESTS,
         "increase_concurrent_on_failure": settings.INCREASE_CONCURRENT_ON_FAILURE,
         "max_concurrent_requests": settings.MAX_CONCURRENT_REQUESTS,
+        # 自适应并发配置及各模型当前的并发状态
+        "adaptive_concurrency": settings.ADAPTIVE_CONCURRENCY,
+        "adaptive_max_concurrency": settings.ADAPTIVE_MAX_CONCURRENCY,
+        "adaptive_failure_threshold": settings.ADAPTIVE_FAILURE_THRESHOLD,
+        "adaptive_success_threshold": settings.ADAPTIVE_SUCCESS_THRESHOLD,
+        "adaptive_concurrency_state": concurrency_controller.snapshot(),
+        # 并发竞速策略及各策略的统计（cancelled 即节省的上游调用配额）
+        "race_policy": settings.RACE_POLICY,
+        "race_keep_per_key": settings.RACE_KEEP_PER_KEY,
+        "race_loser_deadline": settings.RACE_LOSER_DEADLINE,
+        "race_stats": {policy: dict(counts) for policy, counts in api_stats_manager.race_stats.items()},
+        # 延迟对冲配置，及各模型的对冲统计和当前对冲等待时间（滚动分位数延迟）
+        "hedge_enabled": settings.HEDGE_ENABLED,
+        "hedge_max_requests": settings.HEDGE_MAX_REQUESTS,
+        "hedge_percentile": settings.HEDGE_PERCENTILE,
+        "hedge_min_samples": settings.HEDGE_MIN_SAMPLES,
+        "hedge_default_delay": settings.HEDGE_DEFAULT_DELAY,
+        # 真流式首个数据块竞速配置（统计见 race_stats 的 first-token 项）
+        "stream_race_count": settings.STREAM_RACE_COUNT,
+        "stream_ttft_timeout": settings.STREAM_TTFT_TIMEOUT,
+        "stream_race_models": ",".join(settings.STREAM_RACE_MODELS),
+        # 真流式中途断流续写配置及统计
+        "stream_idle_timeout": settings.STREAM_IDLE_TIMEOUT,
+        "stream_failover_retries": settings.STREAM_FAILOVER_RETRIES,
+        "stream_failover_stats": dict(api_stats_manager.stream_failover_stats),
+        "hedge_stats": {
+            model: {
+                **api_stats_manager.hedge_stats.get(model, {}),
+                "samples": len(latencies),
+                "delay": round(hedge_delay(model), 3),
+            }
+            for model, latencies in list(api_stats_manager.model_latencies.items())
+        },
+        # 上游共享连接池配置
+        "http_pool_max_connections": settings.HTTP_POOL_MAX_CONNECTIONS,
+        "http_pool_max_keepalive_connections": settings.HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS,
+        "http_pool_keepalive_expiry": settings.HTTP_POOL_KEEPALIVE_EXPIRY,
+        "enable_http2": settings.ENABLE_HTTP2,
         # 启用vertex
         "enable_vertex": settings.ENABLE_VERTEX,
         # 添加Vertex Express配置
@@ -429,6 +524,274 @@ async def update_config(config_data: dict):
             except ValueError as e:
                 raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
                 
+        elif config_key == "key_scheduler":
+            if config_value not in SCHEDULER_MODES:
+                raise HTTPException(status_code=422, detail=f"参数值错误：密钥调度方式应为 {', '.join(SCHEDULER_MODES)} 之一")
+            settings.KEY_SCHEDULER = config_value
+            log('info', f"密钥调度方式已更新为：{config_value}")
+                
+        elif config_key == "key_rate_limit_enabled":
+            if not isinstance(config_value, bool):
+                raise HTTPException(status_code=422, detail="参数类型错误：应为布尔值")
+            settings.KEY_RATE_LIMIT_ENABLED = config_value
+            if not config_value:
+                key_rate_ledger.reset()
+            log('info', f"按密钥和模型限流已更新为：{config_value}")
+                
+        elif config_key == "key_rate_limit_max_wait":
+            try:
+                value = float(config_value)
+                if value < 0:
+                    raise ValueError("限流最长等待时间不能为负数")
+                settings.KEY_RATE_LIMIT_MAX_WAIT = value
+                log('info', f"限流最长等待时间已更新为：{value}秒")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "model_rate_limits":
+            if not isinstance(config_value, str):
+                raise HTTPException(status_code=422, detail="参数类型错误：应为字符串")
+            try:
+                parse_rate_limits(config_value)
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数值错误：{str(e)}")
+            settings.MODEL_RATE_LIMITS = config_value
+            log('info', f"模型限额已更新为：{config_value}")
+                
+        elif config_key == "key_check_concurrency":
+            try:
+                value = int(config_value)
+                if value <= 0:
+                    raise ValueError("密钥检测并发数必须大于0")
+                settings.KEY_CHECK_CONCURRENCY = value
+                log('info', f"密钥检测并发数已更新为：{value}")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key in ("gemini_key_auth_ttl", "gemini_key_auth_negative_ttl"):
+            try:
+                value = float(config_value)
+                if value < 0:
+                    raise ValueError("缓存时间不能为负数")
+                setattr(settings, config_key.upper(), value)
+                # 缩短缓存时间后不再沿用按旧设置缓存的结果
+                validated_key_cache.clear()
+                log('info', f"{config_key} 已更新为：{value}秒")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "key_check_interval":
+            try:
+                value = float(config_value)
+                if value < 0:
+                    raise ValueError("密钥检测间隔不能为负数")
+                settings.KEY_CHECK_INTERVAL = value
+                log('info', f"密钥检测间隔已更新为：{value}秒")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "breaker_enabled":
+            if not isinstance(config_value, bool):
+                raise HTTPException(status_code=422, detail="参数类型错误：应为布尔值")
+            settings.BREAKER_ENABLED = config_value
+            if not config_value:
+                key_breaker.reset()
+            log('info', f"密钥熔断已更新为：{config_value}")
+                
+        elif config_key in ("breaker_auth_cooldown", "breaker_quota_cooldown", "breaker_quota_max_cooldown", "breaker_server_cooldown"):
+            try:
+                value = float(config_value)
+                if value < 0:
+                    raise ValueError("熔断冷却时间不能为负数")
+                setattr(settings, config_key.upper(), value)
+                log('info', f"{config_key} 已更新为：{value}秒")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "breaker_server_threshold":
+            try:
+                value = int(config_value)
+                if value <= 0:
+                    raise ValueError("服务端错误的熔断阈值必须大于0")
+                settings.BREAKER_SERVER_THRESHOLD = value
+                log('info', f"服务端错误的熔断阈值已更新为：{value}")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "adaptive_concurrency":
+            if not isinstance(config_value, bool):
+                raise HTTPException(status_code=422, detail="参数类型错误：应为布尔值")
+            settings.ADAPTIVE_CONCURRENCY = config_value
+            log('info', f"自适应并发已更新为：{config_value}")
+                
+        elif config_key == "adaptive_max_concurrency":
+            try:
+                value = int(config_value)
+                if value <= 0:
+                    raise ValueError("自适应并发的最大并发数必须大于0")
+                settings.ADAPTIVE_MAX_CONCURRENCY = value
+                log('info', f"自适应并发的最大并发数已更新为：{value}")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key in ("adaptive_failure_threshold", "adaptive_success_threshold"):
+            try:
+                value = float(config_value)
+                if not 0 <= value <= 1:
+                    raise ValueError("比例阈值应在 0 到 1 之间")
+                setattr(settings, config_key.upper(), value)
+                log('info', f"{config_key} 已更新为：{value}")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "race_policy":
+            if config_value not in RACE_POLICIES:
+                raise HTTPException(status_code=422, detail=f"参数值错误：竞速策略应为 {', '.join(RACE_POLICIES)} 之一")
+            settings.RACE_POLICY = config_value
+            log('info', f"并发竞速策略已更新为：{config_value}")
+                
+        elif config_key == "race_keep_per_key":
+            try:
+                value = int(config_value)
+                if value < 0:
+                    raise ValueError("每个请求保留的备用响应数不能为负数")
+                settings.RACE_KEEP_PER_KEY = value
+                log('info', f"每个请求保留的备用响应数已更新为：{value}")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "race_loser_deadline":
+            try:
+                value = float(config_value)
+                if value < 0:
+                    raise ValueError("落败调用的运行期限不能为负数")
+                settings.RACE_LOSER_DEADLINE = value
+                log('info', f"落败调用的运行期限已更新为：{value}秒")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "hedge_enabled":
+            if not isinstance(config_value, bool):
+                raise HTTPException(status_code=422, detail="参数类型错误：应为布尔值")
+            settings.HEDGE_ENABLED = config_value
+            log('info', f"延迟对冲请求已更新为：{config_value}")
+                
+        elif config_key == "hedge_max_requests":
+            try:
+                value = int(config_value)
+                if value <= 0:
+                    raise ValueError("对冲请求的最大调用数必须大于0")
+                settings.HEDGE_MAX_REQUESTS = value
+                log('info', f"对冲请求的最大调用数已更新为：{value}")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "hedge_percentile":
+            try:
+                value = float(config_value)
+                if not 0 < value <= 100:
+                    raise ValueError("对冲延迟分位数应在 0 到 100 之间")
+                settings.HEDGE_PERCENTILE = value
+                log('info', f"对冲延迟分位数已更新为：{value}")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "hedge_min_samples":
+            try:
+                value = int(config_value)
+                if value < 1:
+                    raise ValueError("对冲延迟的最少样本数必须大于0")
+                settings.HEDGE_MIN_SAMPLES = value
+                log('info', f"对冲延迟的最少样本数已更新为：{value}")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "hedge_default_delay":
+            try:
+                value = float(config_value)
+                if value < 0:
+                    raise ValueError("默认对冲等待时间不能为负数")
+                settings.HEDGE_DEFAULT_DELAY = value
+                log('info', f"默认对冲等待时间已更新为：{value}秒")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "stream_race_count":
+            try:
+                value = int(config_value)
+                if value <= 0:
+                    raise ValueError("真流式竞速的流数量必须大于0")
+                settings.STREAM_RACE_COUNT = value
+                log('info', f"真流式竞速的流数量已更新为：{value}")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "stream_ttft_timeout":
+            try:
+                value = float(config_value)
+                if value < 0:
+                    raise ValueError("首个数据块超时时间不能为负数")
+                settings.STREAM_TTFT_TIMEOUT = value
+                log('info', f"首个数据块超时时间已更新为：{value}秒")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "stream_race_models":
+            if not isinstance(config_value, str):
+                raise HTTPException(status_code=422, detail="参数类型错误：模型列表应为字符串")
+            settings.STREAM_RACE_MODELS = [x.strip() for x in config_value.split(",") if x.strip()]
+            log('info', f"启用真流式竞速的模型已更新为：{settings.STREAM_RACE_MODELS or '所有模型'}")
+                
+        elif config_key == "stream_idle_timeout":
+            try:
+                value = float(config_value)
+                if value < 0:
+                    raise ValueError("流式响应空闲超时时间不能为负数")
+                settings.STREAM_IDLE_TIMEOUT = value
+                log('info', f"流式响应空闲超时时间已更新为：{value}秒")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "stream_failover_retries":
+            try:
+                value = int(config_value)
+                if value < 0:
+                    raise ValueError("断流续写次数不能为负数")
+                settings.STREAM_FAILOVER_RETRIES = value
+                log('info', f"断流续写次数已更新为：{value}")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key in ("http_pool_max_connections", "http_pool_max_keepalive_connections"):
+            try:
+                value = int(config_value)
+                if value <= 0:
+                    raise ValueError("连接数必须大于0")
+                setattr(settings, config_key.upper(), value)
+                # 连接池限制只能在创建时设置，按新配置重建
+                reset_http_clients()
+                log('info', f"{config_key} 已更新为：{value}")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "http_pool_keepalive_expiry":
+            try:
+                value = float(config_value)
+                if value < 0:
+                    raise ValueError("空闲连接保持时间不能为负数")
+                settings.HTTP_POOL_KEEPALIVE_EXPIRY = value
+                reset_http_clients()
+                log('info', f"空闲连接保持时间已更新为：{value}秒")
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"参数类型错误：{str(e)}")
+                
+        elif config_key == "enable_http2":
+            if not isinstance(config_value, bool):
+                raise HTTPException(status_code=422, detail="参数类型错误：应为布尔值")
+            settings.ENABLE_HTTP2 = config_value
+            reset_http_clients()
+            log('info', f"上游HTTP/2已{'启用' if config_value else '禁用'}")
+                
         elif config_key == "enable_vertex":
             if not isinstance(config_value, bool):
                 raise HTTPException(status_code=422, detail="参数类型错误：应为布尔值")
@@ -587,11 +950,7 @@ async def update_config(config_data: dict):
             settings.GEMINI_API_KEYS = ','.join(all_keys)
             
             # 计算新添加的密钥数量
-            added_key_count = 0
-            for key in new_keys:
-                if key not in key_manager.api_keys:
-                    key_manager.api_keys.append(key)
-                    added_key_count += 1
+            added_key_count = key_manager.api_keys.extend(new_keys)
             
             # 重置密钥栈
             key_manager._reset_key_stack()
@@ -889,12 +1248,9 @@ async def test_api_keys(password_data: dict):
         # 获取有效密钥列表
         valid_keys = key_manager.api_keys.copy()
         
-        # 启动异步测试
-        threading.Thread(
-            target=start_api_key_test_in_thread, 
-            args=(valid_keys,), 
-            daemon=True
-        ).start()
+        # 在事件循环中启动后台检测任务
+        api_key_test_progress["is_running"] = True
+        asyncio.create_task(run_api_key_test(valid_keys))
         
         return {"status": "success", "message": "API密钥检测已启动，将同时检测有效密钥和无效密钥"}
     except HTTPException:
@@ -912,76 +1268,19 @@ async def get_test_api_keys_progress():
     """
     return api_key_test_progress
 
-def check_api_key_in_thread(key):
-    """在线程中检查单个API密钥的有效性"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+async def run_api_key_test(keys):
+    """并发检测当前有效密钥和无效密钥，并按检测结果更新密钥列表"""
     try:
-        is_valid = loop.run_until_complete(test_api_key(key))
-        if is_valid:
-            log('info', f"API密钥 {key[:8]}... 有效")
-            return key, True
-        else:
-            log('warning', f"API密钥 {key[:8]}... 无效")
-            return key, False
-    finally:
-        loop.close()
-
-async def test_api_key(key):
-    """测试单个API密钥是否有效"""
-    try:
-        # 尝试列出可用模型来检查API密钥是否有效
-        all_models = await GeminiClient.list_available_models(key)
-        return len(all_models) > 0
-    except Exception as e:
-        log('error', f"测试API密钥 {key[:8]}... 时出错: {str(e)}")
-        return False
-
-def start_api_key_test_in_thread(keys):
-    """在线程中启动API密钥检测过程"""
-    # 重置进度信息
-    api_key_test_progress.update({
-        "is_running": True,
-        "completed": 0,
-        "total": 0,  # 稍后会更新
-        "valid": 0,
-        "invalid": 0,
-        "is_completed": False
-    })
-    
-    try:
-        # 获取所有需要检测的密钥（包括当前GEMINI_API_KEYS和INVALID_API_KEYS）
-        current_keys = keys
-        
         # 获取当前无效密钥
         invalid_api_keys = settings.INVALID_API_KEYS.split(',') if settings.INVALID_API_KEYS else []
         invalid_api_keys = [key.strip() for key in invalid_api_keys if key.strip()]
         
-        # 合并所有需要测试的密钥，去重
-        all_keys_to_test = list(set(current_keys + invalid_api_keys))
-        
-        # 更新总数
-        api_key_test_progress["total"] = len(all_keys_to_test)
+        # 合并所有需要测试的密钥（包括当前GEMINI_API_KEYS和INVALID_API_KEYS），检测进度实时写入api_key_test_progress
+        valid_keys, invalid_keys = await key_validator.run(keys + invalid_api_keys, progress=api_key_test_progress)
         
-        # 创建有效和无效密钥列表
-        valid_keys = []
-        invalid_keys = []
-        
-        # 检查每个密钥
-        for key in all_keys_to_test:
-            # 检查密钥
-            _, is_valid = check_api_key_in_thread(key)
-            
-            # 更新进度
-            api_key_test_progress["completed"] += 1
-            
-            # 将密钥添加到相应列表
-            if is_valid:
-                valid_keys.append(key)
-                api_key_test_progress["valid"] += 1
-            else:
-                invalid_keys.append(key)
-                api_key_test_progress["invalid"] += 1
+        # 保留检测期间新加入密钥池的密钥（如请求成功的客户端密钥）
+        tested = set(keys) | set(invalid_api_keys)
+        valid_keys += [key for key in key_manager.api_keys if key not in tested]
         
         # 更新全局密钥列表
         key_manager.api_keys = valid_keys
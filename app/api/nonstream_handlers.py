@@ -1,4 +1,5 @@
 import asyncio
+import time
 from fastapi import HTTPException, Request
 from fastapi.responses import StreamingResponse, Response
 from app.models.schemas import ChatCompletionRequest
@@ -9,7 +10,10 @@ from app.utils.logging import log
 import app.config.settings as settings
 from typing import Literal
 from app.utils.response import gemini_from_text, openAI_from_Gemini, openAI_from_text
-from app.utils.stats import get_api_key_usage
+from app.utils.stats import get_api_key_usage, api_stats_manager
+from app.utils.request import cancel_pending
+from app.utils.concurrency import concurrency_controller
+from app.utils.race import RequestRace, hedge_delay
 from app.utils.content_validator import quick_unclosed_check, quick_required_tags_check
 
 
@@ -22,9 +26,10 @@ async def process_nonstream_request(
     response_cache_manager,
     safety_settings,
     safety_settings_g2,
-    cache_key: str
+    cache_key: str,
+    race: RequestRace = None
 ):
-    """处理非流式API请求"""
+    """处理非流式API请求，race 为多个并发调用共享的竞速状态"""
     gemini_client = GeminiClient(current_api_key)
     # 创建调用 Gemini API 的主任务
     gemini_task = asyncio.create_task(
@@ -71,12 +76,25 @@ async def process_nonstream_request(
                 extra={'key': current_api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
             return "too_short"
         
-        # 缓存响应结果
-        await response_cache_manager.store(cache_key, response_content)
+        if race is None:
+            # 缓存响应结果
+            await response_cache_manager.store(cache_key, response_content)
+            status = "success"
+        elif race.claim(response_content):
+            status = "success"
+        else:
+            # 并发竞速中落败，按竞速策略处理响应
+            await race.store_loser(response_content)
+            status = "lost"
         # 更新 API 调用统计
         await update_api_call_stats(settings.api_call_stats, endpoint=current_api_key, model=chat_request.model,token=response_content.total_token_count)
         
-        return "success"
+        return status
+
+    except asyncio.CancelledError:
+        # 请求已被放弃（如客户端断开），同时取消受保护的上游调用
+        gemini_task.cancel()
+        raise
 
     except Exception as e:
         # 处理 API 调用过程中可能发生的任何异常
@@ -94,7 +112,8 @@ async def process_nonstream_request_with_keepalive(
     safety_settings,
     safety_settings_g2,
     cache_key: str,
-    keepalive_interval: float = 30.0  # 保活间隔，默认30秒
+    keepalive_interval: float = 30.0,  # 保活间隔，默认30秒
+    race: RequestRace = None
 ):
     """处理非流式API请求，带TCP保活功能"""
     gemini_client = GeminiClient(current_api_key)
@@ -151,12 +170,26 @@ async def process_nonstream_request_with_keepalive(
                 extra={'key': current_api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
             return "too_short"
         
-        # 缓存响应结果
-        await response_cache_manager.store(cache_key, response_content)
+        if race is None:
+            # 缓存响应结果
+            await response_cache_manager.store(cache_key, response_content)
+            status = "success"
+        elif race.claim(response_content):
+            status = "success"
+        else:
+            # 并发竞速中落败，按竞速策略处理响应
+            await race.store_loser(response_content)
+            status = "lost"
         # 更新 API 调用统计
         await update_api_call_stats(settings.api_call_stats, endpoint=current_api_key, model=chat_request.model,token=response_content.total_token_count)
         
-        return "success"
+        return status
+
+    except asyncio.CancelledError:
+        # 请求已被放弃（如客户端断开），同时取消上游调用和保活任务
+        gemini_task.cancel()
+        keepalive_task.cancel()
+        raise
 
     except Exception as e:
         # 取消保活任务
@@ -176,7 +209,8 @@ async def process_nonstream_request_with_simple_keepalive(
     safety_settings,
     safety_settings_g2,
     cache_key: str,
-    keepalive_interval: float = 30.0  # 保活间隔，默认30秒
+    keepalive_interval: float = 30.0,  # 保活间隔，默认30秒
+    race: RequestRace = None
 ):
     """处理非流式API请求，带简化TCP保活功能"""
     gemini_client = GeminiClient(current_api_key)
@@ -233,12 +267,26 @@ async def process_nonstream_request_with_simple_keepalive(
                 extra={'key': current_api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
             return "too_short"
         
-        # 缓存响应结果
-        await response_cache_manager.store(cache_key, response_content)
+        if race is None:
+            # 缓存响应结果
+            await response_cache_manager.store(cache_key, response_content)
+            status = "success"
+        elif race.claim(response_content):
+            status = "success"
+        else:
+            # 并发竞速中落败，按竞速策略处理响应
+            await race.store_loser(response_content)
+            status = "lost"
         # 更新 API 调用统计
         await update_api_call_stats(settings.api_call_stats, endpoint=current_api_key, model=chat_request.model,token=response_content.total_token_count)
         
-        return "success"
+        return status
+
+    except asyncio.CancelledError:
+        # 请求已被放弃（如客户端断开），同时取消上游调用和保活任务
+        gemini_task.cancel()
+        keepalive_task.cancel()
+        raise
 
     except Exception as e:
         # 取消保活任务
@@ -286,7 +334,9 @@ async def process_request(
         contents, system_instruction = GeminiClient.convert_messages(GeminiClient, chat_request.messages,model=chat_request.model)
 
     # 设置初始并发数
-    current_concurrent = settings.CONCURRENT_REQUESTS
+    current_concurrent = concurrency_controller.limit(chat_request.model) if settings.ADAPTIVE_CONCURRENCY else settings.CONCURRENT_REQUESTS
+    # 第一批调用的结果计入自适应并发统计
+    first_batch = True
     max_retry_num = settings.MAX_RETRY_NUM
     
     # 当前请求次数
@@ -295,27 +345,71 @@ async def process_request(
     # 重试原因跟踪
     retry_reason = None
     
-    # 尝试使用不同API密钥，直到达到最大重试次数
-    while current_try_num < max_retry_num:
-        # 获取当前批次的密钥数量
-        batch_num = min(max_retry_num - current_try_num, current_concurrent)
-        
-        # 获取当前批次的密钥
+    # 当前批次的并发任务，请求被放弃时需要一并取消
+    tasks = []
+    tasks_map = {}
+    start_times = {}
+    # 对冲模式下超过等待时间后追加发起的调用
+    hedge_tasks = set()
+    hedging = settings.HEDGE_ENABLED
+    # 并发调用的竞速状态，决定落败调用的去留；对冲模式下胜者返回后总是取消其余调用
+    race = RequestRace(cache_key, response_cache_manager, chat_request.model, policy="cancel" if hedging else None)
+    
+    def start_task(api_key):
+        # 记录当前尝试的密钥信息
+        log('info', f"非流式请求开始，使用密钥: {api_key[:8]}...", 
+            extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
+    
+        # 创建任务 - 根据配置决定是否使用保活功能
+        if settings.NONSTREAM_KEEPALIVE_ENABLED:
+            task = asyncio.create_task(
+                process_nonstream_request_with_simple_keepalive(
+                    chat_request,
+                    contents,
+                    system_instruction,
+                    api_key,
+                    response_cache_manager,
+                    safety_settings,
+                    safety_settings_g2,
+                    cache_key,
+                    settings.NONSTREAM_KEEPALIVE_INTERVAL,
+                    race
+                )
+            )
+        else:
+            task = asyncio.create_task(
+                process_nonstream_request(
+                    chat_request,
+                    contents,
+                    system_instruction,
+                    api_key,
+                    response_cache_manager,
+                    safety_settings,
+                    safety_settings_g2,
+                    cache_key,
+                    race
+                )
+            )
+        tasks.append((api_key, task))
+        tasks_map[task] = api_key
+        start_times[task] = time.monotonic()
+        return task
+    
+    async def fetch_keys(count, checked_keys):
+        """
+        获取最多 count 个未达到每日调用限制的密钥，跳过 checked_keys 中已检查过的密钥。
+        返回 (有效密钥列表, 是否已检查所有密钥)
+        """
         valid_keys = []
-        checked_keys = set()  # 用于记录已检查过的密钥
-        all_keys_checked = False  # 标记是否已检查所有密钥
-        
-        # 尝试获取足够数量的有效密钥
-        while len(valid_keys) < batch_num:
-            api_key = await key_manager.get_available_key(priority_key)
+        while len(valid_keys) < count:
+            api_key = await key_manager.get_available_key(priority_key, exclude=checked_keys, model=chat_request.model)
             if not api_key:
                 break
-                
+            
             # 如果这个密钥已经检查过，说明已经检查了所有密钥
             if api_key in checked_keys:
-                all_keys_checked = True
-                break
-            
+                return valid_keys, True
+        
             checked_keys.add(api_key)
             # 获取API密钥的调用次数
             usage = await get_api_key_usage(settings.api_call_stats, api_key)
@@ -325,117 +419,148 @@ async def process_request(
             else:
                 log('warning', f"API密钥 {api_key[:8]}... 已达到每日调用限制 ({usage}/{settings.API_KEY_DAILY_LIMIT})",
                     extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
+        return valid_keys, False
+    
+    try:
+        # 尝试使用不同API密钥，直到达到最大重试次数
+        while current_try_num < max_retry_num:
+            # 获取当前批次的密钥数量，对冲模式下先只取一个，对冲调用的密钥在发起时才获取
+            batch_num = 1 if hedging else min(max_retry_num - current_try_num, current_concurrent)
         
-        # 如果已经检查了所有密钥且没有找到有效密钥，则重置密钥栈
-        if all_keys_checked and not valid_keys:
-            log('warning', "所有API密钥已达到每日调用限制，重置密钥栈",
-                extra={'request_type': 'non-stream', 'model': chat_request.model})
-            key_manager._reset_key_stack()
-            # 重置后重新获取一个密钥
-            api_key = await key_manager.get_available_key(priority_key)
-            if api_key:
-                valid_keys = [api_key]
+            # 获取当前批次的密钥
+            checked_keys = set()  # 用于记录已检查过的密钥
+            valid_keys, all_keys_checked = await fetch_keys(batch_num, checked_keys)
         
-        # 如果没有获取到任何有效密钥，跳出循环
-        if not valid_keys:
-            break
-            
-        # 更新当前尝试次数
-        current_try_num += len(valid_keys)
+            # 如果已经检查了所有密钥且没有找到有效密钥，则重置密钥栈
+            if all_keys_checked and not valid_keys:
+                log('warning', "所有API密钥已达到每日调用限制，重置密钥栈",
+                    extra={'request_type': 'non-stream', 'model': chat_request.model})
+                key_manager._reset_key_stack()
+                # 重置后重新获取一个密钥
+                api_key = await key_manager.get_available_key(priority_key)
+                if api_key:
+                    valid_keys = [api_key]
         
-        # 创建并发任务
-        tasks = []
-        tasks_map = {}
-        for api_key in valid_keys:
-            # 记录当前尝试的密钥信息
-            log('info', f"非流式请求开始，使用密钥: {api_key[:8]}...", 
-                extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
+            # 如果没有获取到任何有效密钥，跳出循环
+            if not valid_keys:
+                break
             
-            # 创建任务 - 根据配置决定是否使用保活功能
-            if settings.NONSTREAM_KEEPALIVE_ENABLED:
-                task = asyncio.create_task(
-                    process_nonstream_request_with_simple_keepalive(
-                        chat_request,
-                        contents,
-                        system_instruction,
-                        api_key,
-                        response_cache_manager,
-                        safety_settings,
-                        safety_settings_g2,
-                        cache_key,
-                        settings.NONSTREAM_KEEPALIVE_INTERVAL
-                    )
-                )
-            else:
-                task = asyncio.create_task(
-                    process_nonstream_request(
-                        chat_request,
-                        contents,
-                        system_instruction,
-                        api_key,
-                        response_cache_manager,
-                        safety_settings,
-                        safety_settings_g2,
-                        cache_key
-                    )
-                )
-            tasks.append((api_key, task))
-            tasks_map[task] = api_key
+            # 更新当前尝试次数
+            current_try_num += len(valid_keys)
         
-        # 等待所有任务完成或找到成功响应
-        success = False
-        while tasks and not success:
-            # 短时间等待任务完成
-            done, pending = await asyncio.wait(
-                [task for _, task in tasks],
-                return_when=asyncio.FIRST_COMPLETED
-            )
-            # 检查已完成的任务是否成功
-            for task in done:
-                api_key = tasks_map[task]
-                try:
-                    status = task.result()                    
-                    # 如果有成功响应内容
-                    if status == "success" :  
-                        success = True
-                        log('info', f"非流式请求成功", 
-                            extra={'key': api_key[:8],'request_type': 'non-stream', 'model': chat_request.model})
-                        # 如果使用的是客户端提供的优先密钥且请求成功，将其添加到密钥池中
-                        if priority_key and api_key == priority_key:
-                            await key_manager.add_successful_client_key(api_key)
-                        cached_response, cache_hit = await  response_cache_manager.get_and_remove(cache_key)
+            # 创建并发任务，对冲模式下还可以再发起 hedges_left 个调用，每发起一个才计入尝试次数
+            tasks = []
+            tasks_map = {}
+            start_times = {}
+            hedges_left = min(settings.HEDGE_MAX_REQUESTS - 1, max_retry_num - current_try_num) if hedging else 0
+            for api_key in valid_keys:
+                start_task(api_key)
+            hedge_at = time.monotonic() + hedge_delay(chat_request.model)
+        
+            # 等待所有任务完成或找到成功响应
+            success = False
+            while (tasks or hedges_left) and not success:
+                # 进行中的调用均已失败，或超过对冲等待时间仍未返回时，获取下一个密钥发起调用
+                if hedges_left and (not tasks or time.monotonic() >= hedge_at):
+                    hedges_left -= 1
+                    next_keys, _ = await fetch_keys(1, checked_keys)
+                    if not next_keys:
+                        hedges_left = 0
+                    elif tasks:
+                        current_try_num += 1
+                        log('info', "请求超过对冲等待时间，发起对冲调用", 
+                            extra={'request_type': 'non-stream', 'model': chat_request.model})
+                        api_stats_manager.record_hedge(chat_request.model, hedged=1)
+                        hedge_tasks.add(start_task(next_keys[0]))
+                    else:
+                        current_try_num += 1
+                        start_task(next_keys[0])
+                    hedge_at = time.monotonic() + hedge_delay(chat_request.model)
+                    if not tasks:
+                        break
+                
+                # 等待任务完成，还可以发起对冲调用时最多等到对冲时间
+                done, pending = await asyncio.wait(
+                    [task for _, task in tasks],
+                    timeout=max(0, hedge_at - time.monotonic()) if hedges_left else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                # 检查已完成的任务是否成功
+                for task in done:
+                    api_key = tasks_map[task]
+                    try:
+                        status = task.result()                    
+                        concurrency_controller.record_attempt(chat_request.model, status)
+                        # 如果有成功响应内容
+                        if status == "success" :  
+                            success = True
+                            if first_batch:
+                                concurrency_controller.record_first_batch(chat_request.model, True)
+                                first_batch = False
+                            log('info', "非流式请求成功", 
+                                extra={'key': api_key[:8],'request_type': 'non-stream', 'model': chat_request.model})
+                            now = time.monotonic()
+                            api_stats_manager.record_latency(chat_request.model, now - start_times[task])
+                            # 仍在运行的调用即将落败，其已运行时间作为延迟下界计入，避免分位数只反映较快的胜者
+                            for _, other in tasks:
+                                if not other.done():
+                                    api_stats_manager.record_latency(chat_request.model, now - start_times[other], censored=True)
+                            if task in hedge_tasks:
+                                api_stats_manager.record_hedge(chat_request.model, won=1)
+                            # 如果使用的是客户端提供的优先密钥且请求成功，将其添加到密钥池中
+                            if priority_key and api_key == priority_key:
+                                await key_manager.add_successful_client_key(api_key)
+                            cached_response = race.winner_response
+                            # 按竞速策略处理仍在运行的其他调用
+                            race.settle(t for _, t in tasks)
                         
-                        if is_gemini :
-                            return cached_response.data
-                        else:
-                            return openAI_from_Gemini(cached_response,stream=False)
-                    elif status == "empty":
-                        retry_reason = "空响应"
-                        log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
-                            extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
-                    elif status == "unclosed_tags":
-                        retry_reason = "未闭合标签"
-                        log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
-                            extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
-                    elif status == "too_short":
-                        retry_reason = "响应过短"
-                        log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
-                            extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
+                            if is_gemini :
+                                return cached_response.data
+                            else:
+                                return openAI_from_Gemini(cached_response,stream=False)
+                        elif status == "empty":
+                            retry_reason = "空响应"
+                            log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
+                                extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
+                        elif status == "unclosed_tags":
+                            retry_reason = "未闭合标签"
+                            log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
+                                extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
+                        elif status == "too_short":
+                            retry_reason = "响应过短"
+                            log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
+                                extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
                 
-                except Exception as e:
-                    handle_gemini_error(e, api_key)
+                    except Exception as e:
+                        handle_gemini_error(e, api_key)
                 
-                # 更新任务列表，移除已完成的任务
-                tasks = [(k, t) for k, t in tasks if not t.done()]
+                    # 更新任务列表，移除已完成的任务
+                    tasks = [(k, t) for k, t in tasks if not t.done()]
                 
-        # 如果当前批次没有成功响应，并且还有密钥可用，则继续尝试
-        if not success and valid_keys:
-            # 增加并发数，但不超过最大并发数
-            current_concurrent = min(current_concurrent + settings.INCREASE_CONCURRENT_ON_FAILURE, settings.MAX_CONCURRENT_REQUESTS)
-            log('info', f"所有并发请求失败或返回空响应，增加并发数至: {current_concurrent}", 
-                extra={'request_type': 'non-stream', 'model': chat_request.model})
+            # 第一批调用均未成功，计入自适应并发统计
+            if first_batch and valid_keys:
+                concurrency_controller.record_first_batch(chat_request.model, False)
+                first_batch = False
+            # 如果当前批次没有成功响应，并且还有密钥可用，则继续尝试（对冲模式下批次宽度固定）
+            if not success and valid_keys and not hedging:
+                if settings.ADAPTIVE_CONCURRENCY:
+                    # 自适应并发：使用该模型当前的并发数
+                    current_concurrent = concurrency_controller.limit(chat_request.model)
+                else:
+                    # 增加并发数，但不超过最大并发数
+                    current_concurrent = min(current_concurrent + settings.INCREASE_CONCURRENT_ON_FAILURE, settings.MAX_CONCURRENT_REQUESTS)
+                    log('info', f"所有并发请求失败或返回空响应，增加并发数至: {current_concurrent}", 
+                        extra={'request_type': 'non-stream', 'model': chat_request.model})
         
     
+    except asyncio.CancelledError:
+        # 请求已被放弃（如客户端断开），取消所有进行中的上游调用
+        cancelled = cancel_pending(task for _, task in tasks)
+        api_stats_manager.record_cancellation('non-stream', cancelled)
+        log('info', f"非流式请求已取消，中止 {cancelled} 个进行中的上游调用",
+            extra={'request_type': 'non-stream', 'model': chat_request.model})
+        raise
+
     # 如果所有尝试都失败
     log('error', "API key 替换失败，所有API key都已尝试，请重新配置或稍后重试", extra={'request_type': 'switch_key'})
     
@@ -456,14 +581,23 @@ async def process_nonstream_with_keepalive_stream(
     safety_settings_g2,
     cache_key: str,
     is_gemini: bool,
-    priority_key: str = None
+    priority_key: str = None,
+    active_requests_manager = None,
+    pool_key: str = None
 ):
-    """处理带保活的非流式请求，使用流式响应发送保活消息但最终返回非流式格式"""
+    """
+    处理带保活的非流式请求，使用流式响应发送保活消息但最终返回非流式格式。
+    传入 active_requests_manager 时，响应通过广播器分发，相同请求可共享同一组上游调用。
+    """
     from fastapi.responses import StreamingResponse
     import json
     
     async def keepalive_stream_generator():
         """生成带保活的流式响应"""
+        # 当前批次的并发任务，客户端断开时需要一并取消
+        tasks = []
+        # 并发调用的竞速状态，决定落败调用的去留
+        race = RequestRace(cache_key, response_cache_manager, chat_request.model)
         try:
             # 转换消息格式
             format_type = getattr(chat_request, 'format_type', None)
@@ -473,7 +607,9 @@ async def process_nonstream_with_keepalive_stream(
                 contents, system_instruction = GeminiClient.convert_messages(GeminiClient, chat_request.messages, model=chat_request.model)
 
             # 设置初始并发数
-            current_concurrent = settings.CONCURRENT_REQUESTS
+            current_concurrent = concurrency_controller.limit(chat_request.model) if settings.ADAPTIVE_CONCURRENCY else settings.CONCURRENT_REQUESTS
+            # 第一批调用的结果计入自适应并发统计
+            first_batch = True
             max_retry_num = settings.MAX_RETRY_NUM
             
             # 当前请求次数
@@ -494,7 +630,7 @@ async def process_nonstream_with_keepalive_stream(
                 
                 # 尝试获取足够数量的有效密钥
                 while len(valid_keys) < batch_num:
-                    api_key = await key_manager.get_available_key(priority_key)
+                    api_key = await key_manager.get_available_key(priority_key, exclude=checked_keys, model=chat_request.model)
                     if not api_key:
                         break
                         
@@ -548,7 +684,8 @@ async def process_nonstream_with_keepalive_stream(
                             response_cache_manager,
                             safety_settings,
                             safety_settings_g2,
-                            cache_key
+                            cache_key,
+                            race
                         )
                     )
                     tasks.append((api_key, task))
@@ -578,15 +715,21 @@ async def process_nonstream_with_keepalive_stream(
                         api_key = tasks_map[task]
                         try:
                             status = task.result()                    
+                            concurrency_controller.record_attempt(chat_request.model, status)
                             # 如果有成功响应内容
                             if status == "success" :  
                                 success = True
+                                if first_batch:
+                                    concurrency_controller.record_first_batch(chat_request.model, True)
+                                    first_batch = False
                                 log('info', f"非流式请求成功", 
                                     extra={'key': api_key[:8],'request_type': 'non-stream', 'model': chat_request.model})
                                 # 如果使用的是客户端提供的优先密钥且请求成功，将其添加到密钥池中
                                 if priority_key and api_key == priority_key:
                                     await key_manager.add_successful_client_key(api_key)
-                                cached_response, cache_hit = await response_cache_manager.get_and_remove(cache_key)
+                                cached_response = race.winner_response
+                                # 按竞速策略处理仍在运行的其他调用
+                                race.settle(t for _, t in tasks)
                                 
                                 # 发送最终的非流式响应
                                 if is_gemini:
@@ -616,12 +759,20 @@ async def process_nonstream_with_keepalive_stream(
                         # 更新任务列表，移除已完成的任务
                         tasks = [(k, t) for k, t in tasks if not t.done()]
                         
+                # 第一批调用均未成功，计入自适应并发统计
+                if first_batch and valid_keys:
+                    concurrency_controller.record_first_batch(chat_request.model, False)
+                    first_batch = False
                 # 如果当前批次没有成功响应，并且还有密钥可用，则继续尝试
                 if not success and valid_keys:
-                    # 增加并发数，但不超过最大并发数
-                    current_concurrent = min(current_concurrent + settings.INCREASE_CONCURRENT_ON_FAILURE, settings.MAX_CONCURRENT_REQUESTS)
-                    log('info', f"所有并发请求失败或返回空响应，增加并发数至: {current_concurrent}", 
-                        extra={'request_type': 'non-stream', 'model': chat_request.model})
+                    if settings.ADAPTIVE_CONCURRENCY:
+                        # 自适应并发：使用该模型当前的并发数
+                        current_concurrent = concurrency_controller.limit(chat_request.model)
+                    else:
+                        # 增加并发数，但不超过最大并发数
+                        current_concurrent = min(current_concurrent + settings.INCREASE_CONCURRENT_ON_FAILURE, settings.MAX_CONCURRENT_REQUESTS)
+                        log('info', f"所有并发请求失败或返回空响应，增加并发数至: {current_concurrent}", 
+                            extra={'request_type': 'non-stream', 'model': chat_request.model})
                 
             
             # 如果所有尝试都失败
@@ -634,12 +785,21 @@ async def process_nonstream_with_keepalive_stream(
             
             yield json.dumps(error_response, ensure_ascii=False)
                 
+        except (asyncio.CancelledError, GeneratorExit):
+            # 客户端断开导致响应流被取消或关闭，取消所有进行中的上游调用
+            cancelled = cancel_pending(task for _, task in tasks)
+            api_stats_manager.record_cancellation('non-stream-keepalive', cancelled)
+            log('info', f"客户端已断开，中止 {cancelled} 个进行中的上游调用",
+                extra={'request_type': 'non-stream', 'keepalive': True})
+            raise
         except Exception as e:
             log('error', f"保活流式处理出错: {str(e)}", 
                 extra={'request_type': 'non-stream', 'keepalive': True})
             raise
     
     # 返回流式响应，但使用application/json媒体类型
+    if active_requests_manager is not None:
+        return active_requests_manager.start_stream(pool_key, keepalive_stream_generator(), media_type="application/json").as_response()
     return StreamingResponse(
         keepalive_stream_generator(),
         media_type="application/json"
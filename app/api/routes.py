@@ -1,10 +1,10 @@
-import json
 from typing import Optional, Union
 from fastapi import APIRouter, Body, HTTPException, Path, Query, Request, Depends, status, Header
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from app.services import GeminiClient
 from app.utils import protect_from_abuse,generate_cache_key,openAI_from_text,log
-from app.utils.response import openAI_from_Gemini
+from app.utils.response import openAI_from_Gemini, stream_from_cached_response
+from app.utils.request import ClientDisconnectedError
 from app.utils.auth import custom_verify_password, verify_gemini_auth
 from .stream_handlers import process_stream_request
 from .nonstream_handlers import process_request, process_nonstream_with_keepalive_stream
@@ -76,6 +76,10 @@ async def verify_user_agent(request: Request):
     if request.headers.get("User-Agent") not in settings.WHITELIST_USER_AGENT:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed client")
 
+def _client_disconnected_response() -> Response:
+    """客户端已断开时的占位响应（客户端不会收到），沿用 nginx 的 499 状态码"""
+    return Response(status_code=499)
+
 # todo : 添加 gemini 支持(流式返回)
 async def get_cache(cache_key,is_stream: bool,is_gemini=False):
     # 检查缓存是否存在，如果存在，返回缓存
@@ -85,17 +89,14 @@ async def get_cache(cache_key,is_stream: bool,is_gemini=False):
         log('info', f"缓存命中: {cache_key[:8]}...", 
             extra={'request_type': 'non-stream', 'model': cached_response.model})
         
-        if is_gemini:
-            if is_stream:
-                data = f"data: {json.dumps(cached_response.data, ensure_ascii=False)}\n\n"
-                return StreamingResponse(data, media_type="text/event-stream")
-            else:
-                return cached_response.data
-            
-        
         if is_stream:
-            chunk = openAI_from_Gemini(cached_response,stream=True)
-            return StreamingResponse(chunk, media_type="text/event-stream")
+            # 真流式缓存按原 chunk 顺序重放
+            return StreamingResponse(
+                stream_from_cached_response(cached_response, is_gemini=is_gemini),
+                media_type="text/event-stream")
+
+        if is_gemini:
+            return cached_response.data
         else: 
             return openAI_from_Gemini(cached_response,stream=False)
 
@@ -192,6 +193,17 @@ async def aistudio_chat_completions(
         # 构建包含缓存键的活跃请求池键
         pool_key = f"{cache_key}"
         
+        # 流式响应（流式请求和带保活的非流式请求）按响应类型区分广播
+        broadcast_key = f"{pool_key}:{'stream' if request.stream else 'keepalive'}"
+        
+        # 加入相同请求正在进行的广播，共享同一组上游调用
+        if request.stream or settings.NONSTREAM_KEEPALIVE_ENABLED:
+            broadcaster = active_requests_manager.join_stream(broadcast_key)
+            if broadcaster is not None:
+                log('info', f"发现相同的进行中请求，加入其广播 (当前订阅者 {broadcaster.subscriber_count} 个)", 
+                    extra={'request_type': 'stream' if request.stream else "non-stream", 'model': request.model})
+                return broadcaster.as_response()
+        
         # 查找所有使用相同缓存键的活跃任务
         active_task = active_requests_manager.get(pool_key)
         if active_task and not active_task.done():
@@ -200,16 +212,20 @@ async def aistudio_chat_completions(
             
             # 等待已有任务完成
             try:
-                # 设置超时，避免无限等待
-                await asyncio.wait_for(active_task, timeout=240)
+                # 设置超时，避免无限等待；客户端断开时若无其他等待者则取消该任务
+                result = await active_requests_manager.wait_for_task(active_task, http_request, timeout=240)
                 
                 # 使用任务结果
-                if active_task.done() and not active_task.cancelled():
-                    
-                    result = active_task.result()
+                active_requests_manager.remove(pool_key)
+                if result:
+                    return result
+            
+            except ClientDisconnectedError:
+                log('info', f"客户端已断开，停止等待已有任务: {pool_key}", 
+                    extra={'request_type': 'non-stream', 'model': request.model})
+                if active_task.done() or active_task.waiter_count <= 0:
                     active_requests_manager.remove(pool_key)
-                    if result:
-                        return result
+                return _client_disconnected_response()
             
             except (asyncio.TimeoutError, asyncio.CancelledError) as e:
                 # 任务超时或被取消的情况下，记录日志然后让代码继续执行
@@ -225,6 +241,19 @@ async def aistudio_chat_completions(
     
         
     if request.stream:
+        if not settings.PUBLIC_MODE:
+            # 流式请求通过广播器分发，之后的相同请求可直接加入
+            return await process_stream_request(
+                chat_request = request, 
+                key_manager=key_manager,
+                response_cache_manager = response_cache_manager,
+                safety_settings = safety_settings,
+                safety_settings_g2 = safety_settings_g2,
+                cache_key = cache_key,
+                priority_key = priority_key,
+                active_requests_manager = active_requests_manager,
+                pool_key = broadcast_key
+            )
         # 流式请求处理任务
         process_task = asyncio.create_task(
             process_stream_request(
@@ -240,7 +269,21 @@ async def aistudio_chat_completions(
     
     else:
         # 检查是否启用非流式保活功能
-        if settings.NONSTREAM_KEEPALIVE_ENABLED:
+        if settings.NONSTREAM_KEEPALIVE_ENABLED and not settings.PUBLIC_MODE:
+            # 带保活的非流式响应通过广播器分发，之后的相同请求可直接加入
+            return await process_nonstream_with_keepalive_stream(
+                chat_request = request,
+                key_manager = key_manager,
+                response_cache_manager = response_cache_manager,
+                safety_settings = safety_settings,
+                safety_settings_g2 = safety_settings_g2,
+                cache_key = cache_key,
+                is_gemini = is_gemini,
+                priority_key = priority_key,
+                active_requests_manager = active_requests_manager,
+                pool_key = broadcast_key
+            )
+        elif settings.NONSTREAM_KEEPALIVE_ENABLED:
             # 使用带保活功能的非流式请求处理
             process_task = asyncio.create_task(
                 process_nonstream_with_keepalive_stream(
@@ -272,13 +315,20 @@ async def aistudio_chat_completions(
         # 将任务添加到活跃请求池
         active_requests_manager.add(pool_key, process_task)
     
-    # 等待任务完成
+    # 等待任务完成，客户端断开且没有其他等待者时取消任务及其上游请求
     try:
-        response = await process_task
+        response = await active_requests_manager.wait_for_task(process_task, http_request)
         if not settings.PUBLIC_MODE:
             active_requests_manager.remove(pool_key)
         
         return response
+    except ClientDisconnectedError:
+        log('info', "客户端已断开连接", 
+            extra={'request_type': 'stream' if request.stream else "non-stream", 'model': request.model})
+        # 任务已结束或因无人等待而被取消时，从活跃请求池移除
+        if not settings.PUBLIC_MODE and (process_task.done() or process_task.waiter_count <= 0):
+            active_requests_manager.remove(pool_key)
+        return _client_disconnected_response()
     except Exception as e:
         if not settings.PUBLIC_MODE:
             # 如果任务失败，从活跃请求池中移除
@@ -1,14 +1,228 @@
 import asyncio
 import json
+import time
 from fastapi.responses import StreamingResponse
 from app.models.schemas import ChatCompletionRequest
 from app.services import GeminiClient
+from app.services.gemini import GeminiResponseWrapper, GeminiStreamResponse
 from app.utils import handle_gemini_error, update_api_call_stats,log,openAI_from_text
-from app.utils.response import openAI_from_Gemini,gemini_from_text
-from app.utils.stats import get_api_key_usage
+from app.utils.response import openAI_from_Gemini,gemini_from_text,stream_from_cached_response
+from app.utils.stats import get_api_key_usage, api_stats_manager
+from app.utils.request import cancel_pending
+from app.utils.concurrency import concurrency_controller
+from app.utils.race import RequestRace, hedge_delay, stream_race_enabled
 from app.utils.content_validator import quick_unclosed_check, quick_required_tags_check
 import app.config.settings as settings
 
+def _total_token_count_from_event(event_data: bytes) -> int:
+    """从透传的最后一个 SSE 事件中读取总 token 数，只解析这一个事件"""
+    try:
+        return int(GeminiResponseWrapper(json.loads(event_data)).total_token_count or 0)
+    except (ValueError, TypeError, AttributeError):
+        return 0
+
+def _parse_events(events):
+    """解析透传的 SSE 事件数据，任一事件不是 JSON 对象时返回 None"""
+    try:
+        parsed = [json.loads(data) for data in events]
+    except (ValueError, TypeError):
+        return None
+    return parsed if all(isinstance(event, dict) for event in parsed) else None
+
+async def _cache_stream_response(response_cache_manager, cache_key: str, chunks, model: str, api_key: str):
+    """缓存完整的 chunk 序列，客户端断线后重试相同请求时可直接重放"""
+    if not chunks:
+        return
+    try:
+        response = GeminiStreamResponse(chunks, model)
+        # 没有结束原因说明流未完整结束，不缓存
+        if not response.finish_reason:
+            return
+        await response_cache_manager.store(cache_key, response)
+        log('info', f"真流式响应已缓存，共 {len(chunks)} 个数据块",
+            extra={'key': api_key[:8], 'request_type': 'stream', 'model': model})
+    except Exception as e:
+        log('error', f"缓存真流式响应失败: {str(e)}",
+            extra={'key': api_key[:8], 'request_type': 'stream', 'model': model})
+
+async def _resume_stream(first, stream, idle_timeout: float = 0):
+    """
+    先产出竞速时已读取的首个数据块，再继续读取剩余数据块。
+    idle_timeout 大于 0 时，超过该秒数没有新数据块则抛出 asyncio.TimeoutError。
+    """
+    try:
+        yield first
+        while True:
+            try:
+                if idle_timeout > 0:
+                    item = await asyncio.wait_for(stream.__anext__(), idle_timeout)
+                else:
+                    item = await stream.__anext__()
+            except StopAsyncIteration:
+                break
+            yield item
+    finally:
+        await stream.aclose()
+
+class _StreamReader:
+    """
+    在独立任务中读取上游流，数据块经队列交给响应生成器。
+    客户端断开只会中断生成器对队列的等待，上游读取不受影响，可以交给后台任务继续读完。
+    """
+
+    # 队列中最多缓存的数据块数，客户端读取较慢时暂停读取上游
+    QUEUE_SIZE = 64
+
+    def __init__(self, items):
+        self._queue = asyncio.Queue(self.QUEUE_SIZE)
+        self._task = asyncio.create_task(self._read(items))
+        # 已取到流结束、读取失败或已关闭，不会再有数据块
+        self.exhausted = False
+
+    async def _read(self, items):
+        try:
+            async for item in items:
+                await self._queue.put((item, None))
+            await self._queue.put((None, StopAsyncIteration()))
+        except Exception as e:
+            # 读取失败（含空闲超时）时由消费方抛出
+            await self._queue.put((None, e))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.exhausted:
+            raise StopAsyncIteration
+        item, error = await self._queue.get()
+        if error is not None:
+            self.exhausted = True
+            raise error
+        return item
+
+    async def aclose(self):
+        """不再需要剩余数据块时取消读取，并关闭上游流"""
+        self.exhausted = True
+        if not self._task.done():
+            self._task.cancel()
+            await asyncio.wait({self._task})
+
+# 客户端断开后继续读取上游的后台任务，持有引用防止被垃圾回收
+_background_streams = set()
+
+def _finish_in_background(reader: _StreamReader, sent_chunks, is_gemini: bool, response_cache_manager, cache_key: str, model: str, api_key: str):
+    """
+    客户端在流式输出中途断开后，在后台读完上游流并缓存完整响应，
+    客户端重试相同请求时可直接重放，不再重新调用上游。完整发送给客户端的流不缓存。
+    """
+    async def _finish():
+        chunks = list(sent_chunks)
+        token = 0
+        try:
+            async for item in reader:
+                if not is_gemini and not item:
+                    return
+                chunks.append(item.data)
+                if not is_gemini and item.total_token_count:
+                    token = int(item.total_token_count)
+        except Exception as e:
+            log('warning', f"客户端断开后继续读取上游流失败，不缓存该响应: {str(e)}",
+                extra={'key': api_key[:8], 'request_type': 'stream', 'model': model})
+            return
+        finally:
+            if is_gemini and chunks:
+                token = _total_token_count_from_event(chunks[-1])
+            await update_api_call_stats(settings.api_call_stats, endpoint=api_key, model=model, token=token)
+        events = _parse_events(chunks) if is_gemini else chunks
+        if events is not None:
+            await _cache_stream_response(response_cache_manager, cache_key, events, model, api_key)
+
+    task = asyncio.create_task(_finish())
+    _background_streams.add(task)
+    task.add_done_callback(_background_streams.discard)
+
+def _continuation_request(chat_request, contents, is_gemini: bool, partial_text: str):
+    """把已输出的部分内容作为 model 轮次追加到请求末尾，上游会接着这段内容继续生成"""
+    model_turn = {"role": "model", "parts": [{"text": partial_text}]}
+    if is_gemini:
+        payload = chat_request.payload.model_copy(update={"contents": chat_request.payload.contents + [model_turn]})
+        return chat_request.model_copy(update={"payload": payload}), contents
+    return chat_request, contents + [model_turn]
+
+async def _failover_key(key_manager, used_keys, model: str = None):
+    """获取一个本次请求尚未使用、且未达到每日调用限制的密钥"""
+    for _ in range(len(key_manager.api_keys)):
+        api_key = await key_manager.get_available_key(exclude=used_keys, model=model)
+        if not api_key:
+            return None
+        if api_key in used_keys:
+            continue
+        usage = await get_api_key_usage(settings.api_call_stats, api_key)
+        if usage < settings.API_KEY_DAILY_LIMIT:
+            return api_key
+    return None
+
+async def _close_streams(streams):
+    """关闭落败或超时的上游流，释放对应连接"""
+    for stream in streams:
+        try:
+            await stream.aclose()
+        except Exception:
+            pass
+
+async def _race_first_chunk(streams, model: str, ttft_timeout: float):
+    """
+    同时读取多个上游流的首个数据块，最先返回非空数据块的流胜出，其余流立即关闭。
+    streams 为 [(api_key, 流)]；返回 (api_key, 流, 首个数据块)，全部失败或超过 ttft_timeout 秒（大于 0 时）返回 None。
+    """
+    pending = {asyncio.create_task(stream.__anext__()): (api_key, stream) for api_key, stream in streams}
+    deadline = time.monotonic() + ttft_timeout if ttft_timeout > 0 else None
+    # 空响应的流和已返回数据块但落败的流，结束竞速后统一关闭
+    empty, losers = [], []
+    winner = None
+    try:
+        while pending and winner is None:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                log('warning', f"{ttft_timeout:g} 秒内没有上游流返回首个数据块，放弃本批 {len(pending)} 个密钥",
+                    extra={'request_type': 'stream', 'model': model})
+                api_stats_manager.record_race("first-token", ttft_timeouts=1)
+                break
+            for task in done:
+                api_key, stream = pending.pop(task)
+                try:
+                    chunk = task.result()
+                except StopAsyncIteration:
+                    chunk = None
+                except Exception as e:
+                    error_detail = handle_gemini_error(e, api_key)
+                    log('error', f"流式响应: API密钥 {api_key[:8]}... 请求失败: {error_detail}",
+                        extra={'key': api_key[:8], 'request_type': 'stream', 'model': model})
+                    continue
+                if not chunk:
+                    log('warning', f"流式响应: API密钥 {api_key[:8]}... 返回空响应",
+                        extra={'key': api_key[:8], 'request_type': 'stream', 'model': model})
+                    await update_api_call_stats(settings.api_call_stats, endpoint=api_key, model=model, token=0)
+                    empty.append(stream)
+                elif winner is None:
+                    winner = (api_key, stream, chunk)
+                else:
+                    losers.append(stream)
+    finally:
+        # 取消仍在等待首个数据块的流，连同已返回数据块但落败的流一并关闭
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        await _close_streams(empty + losers + [stream for _, stream in pending.values()])
+        if len(streams) > 1:
+            api_stats_manager.record_race("first-token", races=1, cancelled=len(pending) + len(losers))
+    if winner and len(streams) > 1:
+        log('info', f"首个数据块竞速：密钥 {winner[0][:8]}... 胜出，关闭其余 {len(streams) - 1} 个上游流",
+            extra={'key': winner[0][:8], 'request_type': 'stream', 'model': model})
+    return winner
+
 async def stream_response_generator(
     chat_request,
     key_manager,
@@ -27,7 +241,9 @@ async def stream_response_generator(
         # 转换消息格式
         contents, system_instruction = GeminiClient.convert_messages(GeminiClient, chat_request.messages,model=chat_request.model)
     # 设置初始并发数
-    current_concurrent = settings.CONCURRENT_REQUESTS
+    current_concurrent = concurrency_controller.limit(chat_request.model) if settings.ADAPTIVE_CONCURRENCY else settings.CONCURRENT_REQUESTS
+    # 第一批调用的结果计入自适应并发统计
+    first_batch = True
     max_retry_num = settings.MAX_RETRY_NUM
     
     # 当前请求次数
@@ -36,27 +252,56 @@ async def stream_response_generator(
     # 重试原因跟踪
     retry_reason = None
     
-    # (假流式) 尝试使用不同API密钥，直到达到最大重试次数
-    while settings.FAKE_STREAMING and current_try_num < max_retry_num:
-        # 获取当前批次的密钥数量
-        batch_num = min(max_retry_num - current_try_num, current_concurrent)
-        
-        # 获取当前批次的密钥
+    # 当前批次的假流式任务，客户端断开时需要一并取消
+    tasks = []
+    tasks_map = {}
+    start_times = {}
+    # 对冲模式下超过等待时间后追加发起的调用
+    hedge_tasks = set()
+    hedging = settings.HEDGE_ENABLED
+    # 并发调用的竞速状态，决定落败调用的去留；对冲模式下胜者返回后总是取消其余调用
+    race = RequestRace(cache_key, response_cache_manager, chat_request.model, policy="cancel" if hedging else None)
+    
+    def start_task(api_key):
+        # 假流式模式的处理逻辑
+        log('info', f"假流式请求开始，使用密钥: {api_key[:8]}...",
+            extra={'key': api_key[:8], 'request_type': 'fake-stream', 'model': chat_request.model})
+    
+        task = asyncio.create_task(
+            handle_fake_streaming(
+                api_key, 
+                chat_request, 
+                contents, 
+                response_cache_manager,
+                system_instruction, 
+                safety_settings, 
+                safety_settings_g2,
+                cache_key,
+                priority_key,
+                race
+            )
+        )
+    
+        tasks.append((api_key, task))
+        tasks_map[task] = api_key
+        start_times[task] = time.monotonic()
+        return task
+    
+    async def fetch_keys(count, checked_keys):
+        """
+        获取最多 count 个未达到每日调用限制的密钥，跳过 checked_keys 中已检查过的密钥。
+        返回 (有效密钥列表, 是否已检查所有密钥)
+        """
         valid_keys = []
-        checked_keys = set()  # 用于记录已检查过的密钥
-        all_keys_checked = False  # 标记是否已检查所有密钥
-        
-        # 尝试获取足够数量的有效密钥
-        while len(valid_keys) < batch_num:
-            api_key = await key_manager.get_available_key(priority_key)
+        while len(valid_keys) < count:
+            api_key = await key_manager.get_available_key(priority_key, exclude=checked_keys, model=chat_request.model)
             if not api_key:
                 break
-                
+            
             # 如果这个密钥已经检查过，说明已经检查了所有密钥
             if api_key in checked_keys:
-                all_keys_checked = True
-                break
-            
+                return valid_keys, True
+        
             checked_keys.add(api_key)
             # 获取API密钥的调用次数
             usage = await get_api_key_usage(settings.api_call_stats, api_key)
@@ -66,127 +311,191 @@ async def stream_response_generator(
             else:
                 log('warning', f"API密钥 {api_key[:8]}... 已达到每日调用限制 ({usage}/{settings.API_KEY_DAILY_LIMIT})",
                     extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
+        return valid_keys, False
+    
+    try:
+        # (假流式) 尝试使用不同API密钥，直到达到最大重试次数
+        while settings.FAKE_STREAMING and current_try_num < max_retry_num:
+            # 获取当前批次的密钥数量，对冲模式下先只取一个，对冲调用的密钥在发起时才获取
+            batch_num = 1 if hedging else min(max_retry_num - current_try_num, current_concurrent)
         
-        # 如果已经检查了所有密钥且没有找到有效密钥，则重置密钥栈
-        if all_keys_checked and not valid_keys:
-            log('warning', "所有API密钥已达到每日调用限制，重置密钥栈",
-                extra={'request_type': 'stream', 'model': chat_request.model})
-            key_manager._reset_key_stack()
-            # 重置后重新获取一个密钥
-            api_key = await key_manager.get_available_key(priority_key)
-            if api_key:
-                valid_keys = [api_key]
+            # 获取当前批次的密钥
+            checked_keys = set()  # 用于记录已检查过的密钥
+            valid_keys, all_keys_checked = await fetch_keys(batch_num, checked_keys)
         
-        # 如果没有获取到任何有效密钥，跳出循环
-        if not valid_keys:
-            break
-            
-        # 更新当前尝试次数
-        current_try_num += len(valid_keys)
+            # 如果已经检查了所有密钥且没有找到有效密钥，则重置密钥栈
+            if all_keys_checked and not valid_keys:
+                log('warning', "所有API密钥已达到每日调用限制，重置密钥栈",
+                    extra={'request_type': 'stream', 'model': chat_request.model})
+                key_manager._reset_key_stack()
+                # 重置后重新获取一个密钥
+                api_key = await key_manager.get_available_key(priority_key)
+                if api_key:
+                    valid_keys = [api_key]
         
-        # 创建并发任务
-        tasks = []
-        tasks_map = {}
-        for api_key in valid_keys:
-            # 假流式模式的处理逻辑
-            log('info', f"假流式请求开始，使用密钥: {api_key[:8]}...",
-                extra={'key': api_key[:8], 'request_type': 'fake-stream', 'model': chat_request.model})
-            
-            task = asyncio.create_task(
-                handle_fake_streaming(
-                    api_key, 
-                    chat_request, 
-                    contents, 
-                    response_cache_manager,
-                    system_instruction, 
-                    safety_settings, 
-                    safety_settings_g2,
-                    cache_key,
-                    priority_key
-                )
-            )
+            # 如果没有获取到任何有效密钥，跳出循环
+            if not valid_keys:
+                break
             
-            tasks.append((api_key, task))
-            tasks_map[task] = api_key
+            # 更新当前尝试次数
+            current_try_num += len(valid_keys)
         
-        # 等待所有任务完成或找到成功响应
-        success = False
-        while tasks and not success:
-            # 等待任务完成
-            done, pending = await asyncio.wait(
-                [task for _, task in tasks],
-                timeout=settings.FAKE_STREAMING_INTERVAL,
-                return_when=asyncio.FIRST_COMPLETED
-            )
+            # 创建并发任务，对冲模式下还可以再发起 hedges_left 个调用，每发起一个才计入尝试次数
+            tasks = []
+            tasks_map = {}
+            start_times = {}
+            hedges_left = min(settings.HEDGE_MAX_REQUESTS - 1, max_retry_num - current_try_num) if hedging else 0
+            for api_key in valid_keys:
+                start_task(api_key)
+            hedge_at = time.monotonic() + hedge_delay(chat_request.model)
+        
+            # 等待所有任务完成或找到成功响应
+            success = False
+            while (tasks or hedges_left) and not success:
+                # 进行中的调用均已失败，或超过对冲等待时间仍未返回时，获取下一个密钥发起调用
+                if hedges_left and (not tasks or time.monotonic() >= hedge_at):
+                    hedges_left -= 1
+                    next_keys, _ = await fetch_keys(1, checked_keys)
+                    if not next_keys:
+                        hedges_left = 0
+                    elif tasks:
+                        current_try_num += 1
+                        log('info', "请求超过对冲等待时间，发起对冲调用", 
+                            extra={'request_type': 'fake-stream', 'model': chat_request.model})
+                        api_stats_manager.record_hedge(chat_request.model, hedged=1)
+                        hedge_tasks.add(start_task(next_keys[0]))
+                    else:
+                        current_try_num += 1
+                        start_task(next_keys[0])
+                    hedge_at = time.monotonic() + hedge_delay(chat_request.model)
+                    if not tasks:
+                        break
+                
+                # 等待任务完成，还可以发起对冲调用时最多等到对冲时间
+                timeout = settings.FAKE_STREAMING_INTERVAL
+                if hedges_left:
+                    timeout = min(timeout, max(0, hedge_at - time.monotonic()))
+                done, pending = await asyncio.wait(
+                    [task for _, task in tasks],
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
             
-            # 如果没有任务完成，发送保活消息
-            if not done :
-                if is_gemini:
-                    yield gemini_from_text(content='',stream=True)
-                else:
-                    yield openAI_from_text(model=chat_request.model,content='',stream=True)
-                continue
+                # 到达对冲时间，先发起对冲调用
+                if not done and hedges_left and time.monotonic() >= hedge_at:
+                    continue
+                
+                # 如果没有任务完成，发送保活消息
+                if not done :
+                    if is_gemini:
+                        yield gemini_from_text(content='',stream=True)
+                    else:
+                        yield openAI_from_text(model=chat_request.model,content='',stream=True)
+                    continue
             
-            # 检查已完成的任务是否成功
-            for task in done:
-                api_key = tasks_map[task]
-                if not task.cancelled():
-                    try:
-                        status = task.result()
-                        # 如果有成功响应内容
-                        if status == "success" :  
-                            success = True
-                            log('info', f"假流式请求成功", 
-                                extra={'key': api_key[:8],'request_type': "fake-stream", 'model': chat_request.model})
+                # 检查已完成的任务是否成功
+                for task in done:
+                    api_key = tasks_map[task]
+                    if not task.cancelled():
+                        try:
+                            status = task.result()
+                            concurrency_controller.record_attempt(chat_request.model, status)
+                            # 如果有成功响应内容
+                            if status == "success" :  
+                                success = True
+                                if first_batch:
+                                    concurrency_controller.record_first_batch(chat_request.model, True)
+                                    first_batch = False
+                                log('info', f"假流式请求成功", 
+                                    extra={'key': api_key[:8],'request_type': "fake-stream", 'model': chat_request.model})
+                                now = time.monotonic()
+                                api_stats_manager.record_latency(chat_request.model, now - start_times[task])
+                                # 仍在运行的调用即将落败，其已运行时间作为延迟下界计入，避免分位数只反映较快的胜者
+                                for _, other in tasks:
+                                    if not other.done():
+                                        api_stats_manager.record_latency(chat_request.model, now - start_times[other], censored=True)
+                                if task in hedge_tasks:
+                                    api_stats_manager.record_hedge(chat_request.model, won=1)
                             
-                            # 如果使用的是客户端提供的优先密钥且请求成功，将其添加到密钥池中
-                            if priority_key and api_key == priority_key:
-                                from app.api.routes import key_manager
-                                await key_manager.add_successful_client_key(api_key)
+                                # 如果使用的是客户端提供的优先密钥且请求成功，将其添加到密钥池中
+                                if priority_key and api_key == priority_key:
+                                    from app.api.routes import key_manager
+                                    await key_manager.add_successful_client_key(api_key)
                             
-                            cached_response, cache_hit = await response_cache_manager.get_and_remove(cache_key)
-                            if cache_hit and cached_response: 
-                                if is_gemini :
-                                    json_payload = json.dumps(cached_response.data, ensure_ascii=False)
-                                    data_to_yield = f"data: {json_payload}\n\n"
-                                    yield data_to_yield
+                                cached_response = race.winner_response
+                                # 按竞速策略处理仍在运行的其他调用
+                                race.settle(t for _, t in tasks)
+                                if cached_response: 
+                                    for data_to_yield in stream_from_cached_response(cached_response, is_gemini=is_gemini):
+                                        yield data_to_yield
                                 else:
-                                    yield openAI_from_Gemini(cached_response,stream=True)
-                            else:
-                                success = False
-                            break
-                        elif status == "empty":
-                            retry_reason = "空响应"
-                            log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
-                                extra={'key': api_key[:8], 'request_type': 'fake-stream', 'model': chat_request.model})
-                        elif status == "unclosed_tags":
-                            retry_reason = "未闭合标签"
-                            log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
-                                extra={'key': api_key[:8], 'request_type': 'fake-stream', 'model': chat_request.model})
-                        elif status == "too_short":
-                            retry_reason = "响应过短"
-                            log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
-                                extra={'key': api_key[:8], 'request_type': 'fake-stream', 'model': chat_request.model})
+                                    success = False
+                                break
+                            elif status == "empty":
+                                retry_reason = "空响应"
+                                log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
+                                    extra={'key': api_key[:8], 'request_type': 'fake-stream', 'model': chat_request.model})
+                            elif status == "unclosed_tags":
+                                retry_reason = "未闭合标签"
+                                log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
+                                    extra={'key': api_key[:8], 'request_type': 'fake-stream', 'model': chat_request.model})
+                            elif status == "too_short":
+                                retry_reason = "响应过短"
+                                log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
+                                    extra={'key': api_key[:8], 'request_type': 'fake-stream', 'model': chat_request.model})
                         
-                    except Exception as e:
-                        error_detail = handle_gemini_error(e, api_key)
-                        log('error', f"请求失败: {error_detail}",
-                            extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
+                        except Exception as e:
+                            error_detail = handle_gemini_error(e, api_key)
+                            log('error', f"请求失败: {error_detail}",
+                                extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
 
-            # 如果找到成功的响应，跳出循环
-            if success:
-                return
+                # 如果找到成功的响应，跳出循环
+                if success:
+                    return
             
-            # 更新任务列表，移除已完成的任务
-            tasks = [(k, t) for k, t in tasks if not t.done()]
+                # 更新任务列表，移除已完成的任务
+                tasks = [(k, t) for k, t in tasks if not t.done()]
         
-        # 如果所有请求都失败，增加并发数并继续尝试
-        if not success and valid_keys:
-            # 增加并发数，但不超过最大并发数
-            current_concurrent = min(current_concurrent + settings.INCREASE_CONCURRENT_ON_FAILURE, settings.MAX_CONCURRENT_REQUESTS)
-            log('info', f"所有假流式请求失败，增加并发数至: {current_concurrent}", 
-                extra={'request_type': 'stream', 'model': chat_request.model})
+            # 第一批调用均未成功，计入自适应并发统计
+            if first_batch and valid_keys:
+                concurrency_controller.record_first_batch(chat_request.model, False)
+                first_batch = False
+            # 如果所有请求都失败，增加并发数并继续尝试（对冲模式下批次宽度固定）
+            if not success and valid_keys and not hedging:
+                if settings.ADAPTIVE_CONCURRENCY:
+                    # 自适应并发：使用该模型当前的并发数
+                    current_concurrent = concurrency_controller.limit(chat_request.model)
+                else:
+                    # 增加并发数，但不超过最大并发数
+                    current_concurrent = min(current_concurrent + settings.INCREASE_CONCURRENT_ON_FAILURE, settings.MAX_CONCURRENT_REQUESTS)
+                    log('info', f"所有假流式请求失败，增加并发数至: {current_concurrent}", 
+                        extra={'request_type': 'stream', 'model': chat_request.model})
+    except (asyncio.CancelledError, GeneratorExit):
+        # 客户端断开导致响应流被取消或关闭，取消所有进行中的上游调用
+        cancelled = cancel_pending(task for _, task in tasks)
+        api_stats_manager.record_cancellation('fake-stream', cancelled)
+        log('info', f"假流式请求已取消，中止 {cancelled} 个进行中的上游调用",
+            extra={'request_type': 'fake-stream', 'model': chat_request.model})
+        raise
 
+
+    # (真流式) 启用竞速的模型每批同时发起 STREAM_RACE_COUNT 个流式请求，并检测首个数据块超时
+    race_enabled = stream_race_enabled(chat_request.model)
+    stream_batch = max(1, settings.STREAM_RACE_COUNT) if race_enabled else 1
+    ttft_timeout = settings.STREAM_TTFT_TIMEOUT if race_enabled else 0
+    # 本次请求已使用过的密钥，断流续写时换用其他密钥
+    used_keys = set()
+    
+    def open_stream(api_key, request, request_contents):
+        client = GeminiClient(api_key)
+        stream_chat = client.stream_chat_passthrough if is_gemini else client.stream_chat
+        return stream_chat(
+            request,
+            request_contents,
+            safety_settings_g2 if 'gemini-2.5' in chat_request.model else safety_settings,
+            system_instruction
+        )
+    
     # (真流式) 尝试使用不同API密钥，直到达到最大重试次数
     while not settings.FAKE_STREAMING and current_try_num < max_retry_num:
         # 获取当前批次的密钥
@@ -194,9 +503,9 @@ async def stream_response_generator(
         checked_keys = set()  # 用于记录已检查过的密钥
         all_keys_checked = False  # 标记是否已检查所有密钥
         
-        # 尝试获取一个有效密钥
-        while len(valid_keys) < 1:
-            api_key = await key_manager.get_available_key()
+        # 尝试获取足够数量的有效密钥
+        while len(valid_keys) < min(stream_batch, max_retry_num - current_try_num):
+            api_key = await key_manager.get_available_key(exclude=checked_keys, model=chat_request.model)
             if not api_key:
                 break
                 
@@ -230,71 +539,150 @@ async def stream_response_generator(
             break
             
         # 更新当前尝试次数
-        current_try_num += 1
+        current_try_num += len(valid_keys)
+        used_keys.update(valid_keys)
         
-        # 获取密钥
-        api_key = valid_keys[0]
+        # 为每个密钥打开上游流，原生格式直接透传上游 SSE 事件，不做解析和重新序列化
+        streams = [(api_key, open_stream(api_key, chat_request, contents)) for api_key in valid_keys]
         
-        success = False
-        try:            
-            client = GeminiClient(api_key)
-            
-            # 获取流式响应
-            stream_generator = client.stream_chat(
-                chat_request,
-                contents,
-                safety_settings_g2 if 'gemini-2.5' in chat_request.model else safety_settings,
-                system_instruction
-            )
+        try:
+            winner = await _race_first_chunk(streams, chat_request.model, ttft_timeout)
+        except asyncio.CancelledError:
+            # 客户端在首个数据块返回前断开，竞速中的上游流已随之关闭
+            api_stats_manager.record_cancellation('stream', len(streams))
+            log('info', f"流式请求已取消，中止 {len(streams)} 个上游调用",
+                extra={'request_type': 'stream', 'model': chat_request.model})
+            raise
+        if winner is None:
+            retry_reason = "请求失败或首个数据块超时"
+            log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
+                extra={'request_type': 'stream', 'model': chat_request.model})
+            continue
+        api_key, stream, first_chunk = winner
+        
+        # 已发送给客户端的数据块，断流续写时跨多个上游流累积（原生格式为事件原始数据，其余为 Gemini 响应字典）
+        sent_chunks = []
+        failovers = 0
+        while True:
+            success = False
+            interrupted = False
+            # 客户端断开后上游流交给后台任务读完，调用统计也由其记录
+            detached = False
             token=0
-            # 处理流式响应
-            async for chunk in stream_generator:
-                if chunk :
-                    
-                    if chunk.total_token_count:
-                        token = int(chunk.total_token_count)
-                    success = True
-                    
-                    if is_gemini:
-                        json_payload = json.dumps(chunk.data, ensure_ascii=False)
-                        data = f"data: {json_payload}\n\n"
-                    else:
-                        data = openAI_from_Gemini(chunk,stream=True)
-                    
-                    # log('info', f"流式响应发送数据: {data}")
-                    yield data
-                    
+            reader = _StreamReader(_resume_stream(first_chunk, stream, settings.STREAM_IDLE_TIMEOUT))
+            try:            
+                if is_gemini:
+                    async for event in reader:
+                        # 只保留原始数据，断流续写或客户端断开后缓存时才解析
+                        sent_chunks.append(event.data)
+                        success = True
+                        yield event.raw + b"\n\n"
+
+                    # 用量只需从最后一个事件中读取
+                    if sent_chunks:
+                        token = _total_token_count_from_event(sent_chunks[-1])
+                else:
+                    # 处理流式响应，同时保留各数据块用于断流续写
+                    async for chunk in reader:
+                        if chunk :
+                            
+                            if chunk.total_token_count:
+                                token = int(chunk.total_token_count)
+                            success = True
+                            sent_chunks.append(chunk.data)
+                            
+                            data = openAI_from_Gemini(chunk,stream=True)
+                            
+                            # log('info', f"流式响应发送数据: {data}")
+                            yield data
+                            
+                        else:
+                            await reader.aclose()
+                            retry_reason = "空响应"
+                            log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
+                                extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
+                            await update_api_call_stats(
+                                settings.api_call_stats, 
+                                endpoint=api_key, 
+                                model=chat_request.model,
+                                token=token
+                            )
+                            break
+            
+            except (asyncio.CancelledError, GeneratorExit):
+                if sent_chunks and not reader.exhausted:
+                    # 客户端在输出中途断开，通常随后会重试相同请求：后台读完上游流并缓存，供重试时直接重放
+                    detached = True
+                    _finish_in_background(reader, sent_chunks, is_gemini, response_cache_manager, cache_key, chat_request.model, api_key)
+                    log('info', "客户端在流式输出中途断开，后台继续接收上游响应并缓存",
+                        extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
                 else:
-                    retry_reason = "空响应"
-                    log('warning', f"重试 ({current_try_num+1}/{max_retry_num}) - 原因: {retry_reason}",
+                    # 客户端断开导致响应流被取消或关闭，上游流式请求随之中止
+                    api_stats_manager.record_cancellation('stream', 1)
+                    log('info', "流式请求已取消，中止上游调用",
                         extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
+                raise
+            except asyncio.TimeoutError:
+                interrupted = True
+                api_stats_manager.record_stream_failover(stalls=1)
+                log('warning', f"流式响应: API密钥 {api_key[:8]}... 超过 {settings.STREAM_IDLE_TIMEOUT:g} 秒没有新数据块",
+                    extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
+            except Exception as e:
+                interrupted = True
+                api_stats_manager.record_stream_failover(errors=1)
+                error_detail = handle_gemini_error(e, api_key)
+                log('error', f"流式响应: API密钥 {api_key[:8]}... 请求失败: {error_detail}",
+                    extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
+            finally: 
+                if not detached:
+                    await reader.aclose()
+                # 如果成功获取相应，更新API调用统计
+                if success and not detached:
                     await update_api_call_stats(
                         settings.api_call_stats, 
                         endpoint=api_key, 
                         model=chat_request.model,
                         token=token
                     )
-                    break
-        
-        except Exception as e:
-            error_detail = handle_gemini_error(e, api_key)
-            log('error', f"流式响应: API密钥 {api_key[:8]}... 请求失败: {error_detail}",
-                extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
-        finally: 
-            # 如果成功获取相应，更新API调用统计
-            if success:
-                await update_api_call_stats(
-                    settings.api_call_stats, 
-                    endpoint=api_key, 
-                    model=chat_request.model,
-                    token=token
-                )
                 # 如果使用的是客户端提供的优先密钥且请求成功，将其添加到密钥池中
-                if priority_key and api_key == priority_key:
+                if success and priority_key and api_key == priority_key:
                     await key_manager.add_successful_client_key(api_key)
+            
+            if not sent_chunks:
+                break
+            if failovers and success:
+                api_stats_manager.record_stream_failover(resumed=1)
+            if not interrupted:
                 return
             
-    
+            # 已开始输出后上游中断：换用其他密钥，把已输出内容作为 model 轮次续写
+            events = _parse_events(sent_chunks) if is_gemini else sent_chunks
+            if events is None:
+                # 已透传的事件无法解析，不能确定已输出的内容，不再续写
+                return
+            partial = GeminiStreamResponse(events, chat_request.model)
+            if chat_request.model.endswith("-encrypt-full") or partial.function_call or not partial.text:
+                return
+            winner = None
+            while winner is None and failovers < settings.STREAM_FAILOVER_RETRIES:
+                failovers += 1
+                next_key = await _failover_key(key_manager, used_keys, chat_request.model)
+                if not next_key:
+                    break
+                used_keys.add(next_key)
+                api_stats_manager.record_stream_failover(attempts=1)
+                log('info', f"流式响应中断，使用密钥 {next_key[:8]}... 续写已输出的 {len(partial.text)} 个字符（第 {failovers} 次）",
+                    extra={'key': next_key[:8], 'request_type': 'stream', 'model': chat_request.model})
+                continuation_request, continuation_contents = _continuation_request(chat_request, contents, is_gemini, partial.text)
+                winner = await _race_first_chunk(
+                    [(next_key, open_stream(next_key, continuation_request, continuation_contents))],
+                    chat_request.model, ttft_timeout
+                )
+            if winner is None:
+                # 无法续写，保留已发送的部分内容
+                return
+            api_key, stream, first_chunk = winner
+        
     # 所有API密钥都尝试失败的处理
     log('error', "所有 API 密钥均请求失败，请稍后重试",
         extra={'key': 'ALL', 'request_type': 'stream', 'model': chat_request.model})
@@ -305,7 +693,7 @@ async def stream_response_generator(
         yield openAI_from_text(model=chat_request.model,content="所有API密钥均请求失败\n具体错误请查看轮询日志",finish_reason="stop")
 
 # 处理假流式模式
-async def handle_fake_streaming(api_key, chat_request, contents, response_cache_manager, system_instruction, safety_settings, safety_settings_g2, cache_key, priority_key: str = None):
+async def handle_fake_streaming(api_key, chat_request, contents, response_cache_manager, system_instruction, safety_settings, safety_settings_g2, cache_key, priority_key: str = None, race: RequestRace = None):
     
     # 使用非流式请求内容
     gemini_client = GeminiClient(api_key)
@@ -319,11 +707,11 @@ async def handle_fake_streaming(api_key, chat_request, contents, response_cache_
             log_response=False
         )
     )
-    gemini_task = asyncio.shield(gemini_task)
+    shielded_gemini_task = asyncio.shield(gemini_task)
     
     try:
         # 获取响应内容
-        response_content = await gemini_task
+        response_content = await shielded_gemini_task
         response_content.set_model(chat_request.model)
         log('info', f"假流式成功获取响应，进行缓存",
             extra={'key': api_key[:8], 'request_type': 'fake-stream', 'model': chat_request.model})
@@ -364,8 +752,14 @@ async def handle_fake_streaming(api_key, chat_request, contents, response_cache_
                 extra={'key': api_key[:8], 'request_type': 'fake-stream', 'model': chat_request.model})
             return "too_short"
 
-        # 缓存
-        await response_cache_manager.store(cache_key, response_content)
+        if race is not None and not race.claim(response_content):
+            # 并发竞速中落败，按竞速策略处理响应
+            await race.store_loser(response_content)
+            return "lost"
+
+        if race is None:
+            # 缓存
+            await response_cache_manager.store(cache_key, response_content)
         
         # 如果使用的是客户端提供的优先密钥且请求成功，将其添加到密钥池中
         if priority_key and api_key == priority_key:
@@ -375,6 +769,11 @@ async def handle_fake_streaming(api_key, chat_request, contents, response_cache_
         
         return "success"
     
+    except asyncio.CancelledError:
+        # 请求已被放弃（如客户端断开），同时取消受保护的上游调用
+        gemini_task.cancel()
+        raise
+    
     except Exception as e:
         handle_gemini_error(e, api_key)
         # log('error', f"假流式模式: API密钥 {api_key[:8]}... 请求失败: {error_detail}",
@@ -391,11 +790,15 @@ async def process_stream_request(
     safety_settings,
     safety_settings_g2,
     cache_key: str,
-    priority_key: str = None
+    priority_key: str = None,
+    active_requests_manager = None,
+    pool_key: str = None
 ) -> StreamingResponse:
-    """处理流式API请求"""
-    
-    return StreamingResponse(stream_response_generator(
+    """
+    处理流式API请求。
+    传入 active_requests_manager 时，上游流通过广播器分发，相同请求可共享同一个上游流。
+    """
+    stream = stream_response_generator(
                 chat_request,
                 key_manager,
                 response_cache_manager,
@@ -403,4 +806,8 @@ async def process_stream_request(
                 safety_settings_g2,
                 cache_key,
                 priority_key
-            ), media_type="text/event-stream")
+            )
+    if active_requests_manager is not None:
+        return active_requests_manager.start_stream(pool_key, stream).as_response()
+    
+    return StreamingResponse(stream, media_type="text/event-stream")
@@ -41,6 +41,12 @@ HTTPS_PROXY = get_env_value("HTTPS_PROXY", "")
 SOCKS_PROXY = get_env_value("SOCKS_PROXY", "")
 ALL_PROXY = get_env_value("ALL_PROXY", "")
 
+# 上游连接池配置（不可通过Web配置）
+HTTP_POOL_MAX_CONNECTIONS = get_env_value("HTTP_POOL_MAX_CONNECTIONS", "200", int)  # 连接池最大连接数
+HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS = get_env_value("HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS", "50", int)  # 最大保持活跃的空闲连接数
+HTTP_POOL_KEEPALIVE_EXPIRY = get_env_value("HTTP_POOL_KEEPALIVE_EXPIRY", "60", float)  # 空闲连接保持时间（秒）
+ENABLE_HTTP2 = get_env_value("ENABLE_HTTP2", "false", bool)  # 是否对上游启用HTTP/2多路复用（需要安装 h2）
+
 # 调用本项目时使用的密码（不可通过Web配置）
 PASSWORD = get_env_value("PASSWORD", "123").strip('"')
 
@@ -68,12 +74,56 @@ CONCURRENT_REQUESTS = get_env_value("CONCURRENT_REQUESTS", "1", int)  # 默认
 INCREASE_CONCURRENT_ON_FAILURE = get_env_value("INCREASE_CONCURRENT_ON_FAILURE", "0", int)  # 失败时增加的并发数
 MAX_CONCURRENT_REQUESTS = get_env_value("MAX_CONCURRENT_REQUESTS", "3", int)  # 最大并发请求数
 
+# 按模型自适应并发数（可通过Web配置，settings.json优先），启用后取代以上三项
+# 内容失败（空响应、过短、标签未闭合）比例达到 ADAPTIVE_FAILURE_THRESHOLD 时并发数加 1，
+# 第一批即成功的比例达到 ADAPTIVE_SUCCESS_THRESHOLD 时并发数减半，最大为 ADAPTIVE_MAX_CONCURRENCY
+ADAPTIVE_CONCURRENCY = get_env_value("ADAPTIVE_CONCURRENCY", "false", bool)
+ADAPTIVE_MAX_CONCURRENCY = get_env_value("ADAPTIVE_MAX_CONCURRENCY", "5", int)
+ADAPTIVE_FAILURE_THRESHOLD = get_env_value("ADAPTIVE_FAILURE_THRESHOLD", "0.3", float)
+ADAPTIVE_SUCCESS_THRESHOLD = get_env_value("ADAPTIVE_SUCCESS_THRESHOLD", "0.9", float)
+
+# 并发竞速策略：首个成功响应返回后，其余调用的处理方式（可通过Web配置，settings.json优先）
+# cancel: 立即取消；keep-for-swipes: 继续运行并缓存响应，每个缓存键最多保留 RACE_KEEP_PER_KEY 条；
+# keep-until-deadline: 最多再运行 RACE_LOSER_DEADLINE 秒，期间完成的响应写入缓存
+RACE_POLICY = get_env_value("RACE_POLICY", "keep-for-swipes")
+RACE_KEEP_PER_KEY = get_env_value("RACE_KEEP_PER_KEY", "1", int)
+RACE_LOSER_DEADLINE = get_env_value("RACE_LOSER_DEADLINE", "30", float)
+
+# 延迟对冲请求（可通过Web配置，settings.json优先）
+# 启用后每批先只发起一个调用，超过该模型最近调用延迟的 HEDGE_PERCENTILE 分位数仍未返回时，
+# 才使用另一个密钥发起对冲调用，最多同时 HEDGE_MAX_REQUESTS 个；胜者返回后取消其余调用
+HEDGE_ENABLED = get_env_value("HEDGE_ENABLED", "false", bool)
+HEDGE_MAX_REQUESTS = get_env_value("HEDGE_MAX_REQUESTS", "2", int)
+HEDGE_PERCENTILE = get_env_value("HEDGE_PERCENTILE", "90", float)
+HEDGE_MIN_SAMPLES = get_env_value("HEDGE_MIN_SAMPLES", "10", int)  # 样本不足时使用 HEDGE_DEFAULT_DELAY
+HEDGE_DEFAULT_DELAY = get_env_value("HEDGE_DEFAULT_DELAY", "10", float)  # 秒
+
+# 真流式首个数据块竞速（可通过Web配置，settings.json优先）
+# 每批同时使用 STREAM_RACE_COUNT 个密钥发起流式请求，最先返回非空数据块的流胜出，其余立即关闭；
+# 超过 STREAM_TTFT_TIMEOUT 秒仍没有流返回首个数据块时放弃本批，换用其他密钥（0 表示不限制）；
+# 仅对 STREAM_RACE_MODELS 中的模型生效，逗号分隔，留空表示所有模型
+STREAM_RACE_COUNT = get_env_value("STREAM_RACE_COUNT", "1", int)
+STREAM_TTFT_TIMEOUT = get_env_value("STREAM_TTFT_TIMEOUT", "0", float)
+STREAM_RACE_MODELS = [x.strip() for x in get_env_value("STREAM_RACE_MODELS", "").split(",") if x.strip()]
+
+# 真流式中途断流续写（可通过Web配置，settings.json优先）
+# 已开始输出后上游出错，或超过 STREAM_IDLE_TIMEOUT 秒没有新数据块（0 表示不检测）时，把已输出内容作为
+# model 轮次追加到请求末尾，换用其他密钥续写，续写内容接在同一个响应流中；最多续写 STREAM_FAILOVER_RETRIES 次（0 表示不续写）
+STREAM_IDLE_TIMEOUT = get_env_value("STREAM_IDLE_TIMEOUT", "0", float)
+STREAM_FAILOVER_RETRIES = get_env_value("STREAM_FAILOVER_RETRIES", "2", int)
+
 # 缓存配置（可通过Web配置，settings.json优先）
 CACHE_EXPIRY_TIME = get_env_value("CACHE_EXPIRY_TIME", "21600", int)  # 默认缓存 6 小时 (21600 秒)
 MAX_CACHE_ENTRIES = get_env_value("MAX_CACHE_ENTRIES", "500", int)  # 默认最多缓存500条响应
+MAX_CACHE_BYTES = get_env_value("MAX_CACHE_BYTES", "268435456", int)  # 缓存占用内存上限（估算值），默认 256MB，0 表示不限制
+CACHE_COMPRESS_THRESHOLD = get_env_value("CACHE_COMPRESS_THRESHOLD", "16384", int)  # 响应数据超过该字节数时压缩缓存，0 表示不压缩
+CACHE_COMPRESS_LEVEL = get_env_value("CACHE_COMPRESS_LEVEL", "6", int)  # 缓存压缩级别（zlib，1-9）
 CALCULATE_CACHE_ENTRIES = get_env_value("CALCULATE_CACHE_ENTRIES", "6", int)  # 默认取最后 6 条消息算缓存键
 PRECISE_CACHE = get_env_value("PRECISE_CACHE", "false", bool)  # 是否取所有消息来算缓存键
 
+# 磁盘二级缓存配置，缓存存放在 STORAGE_DIR 下，重启后依然可用（不可通过Web配置）
+ENABLE_DISK_CACHE = get_env_value("ENABLE_DISK_CACHE", "false", bool)
+
 # 是否启用 Vertex AI（可通过Web配置，settings.json优先）
 ENABLE_VERTEX = get_env_value("ENABLE_VERTEX", "false", bool)
 GOOGLE_CREDENTIALS_JSON = get_env_value("GOOGLE_CREDENTIALS_JSON", "")
@@ -128,6 +178,39 @@ MAX_REQUESTS_PER_DAY_PER_IP = get_env_value("MAX_REQUESTS_PER_DAY_PER_IP", "600"
 # API密钥使用限制（可通过Web配置，settings.json优先）
 API_KEY_DAILY_LIMIT = get_env_value("API_KEY_DAILY_LIMIT", "100", int)  # 默认每个API密钥每24小时可使用100次
 
+# API密钥调度方式（可通过Web配置，settings.json优先）
+# weighted: 按剩余配额、延迟、错误率和进行中调用数加权随机选择；best: 总是选择权重最大的密钥；random: 原有的随机密钥栈
+KEY_SCHEDULER = get_env_value("KEY_SCHEDULER", "weighted")
+
+# 按（密钥, 模型）限流（可通过Web配置，settings.json优先），仅在 KEY_SCHEDULER 为 weighted/best 时生效
+# 跳过会被上游限流的密钥；所有密钥都需要等待时，等待不超过 KEY_RATE_LIMIT_MAX_WAIT 秒则延迟发送，否则拒绝请求
+# MODEL_RATE_LIMITS 为逗号分隔的 模型前缀=RPM/TPM/RPD（按最长前缀匹配，0 表示不限制，default 用于其他模型），默认值为免费层级限额
+KEY_RATE_LIMIT_ENABLED = get_env_value("KEY_RATE_LIMIT_ENABLED", "false", bool)
+KEY_RATE_LIMIT_MAX_WAIT = get_env_value("KEY_RATE_LIMIT_MAX_WAIT", "5", float)
+MODEL_RATE_LIMITS = get_env_value("MODEL_RATE_LIMITS", "gemini-2.5-pro=5/250000/100,gemini-2.5-flash=10/250000/250,gemini-2.5-flash-lite=15/250000/1000,gemini-2.0-flash=15/1000000/200,gemini-2.0-flash-lite=30/1000000/200")
+
+# 启动时和仪表盘检测API密钥的并发数，以及同一上游主机相邻两次检测请求的最小间隔（秒）（可通过Web配置，settings.json优先）
+KEY_CHECK_CONCURRENCY = get_env_value("KEY_CHECK_CONCURRENCY", "20", int)
+KEY_CHECK_INTERVAL = get_env_value("KEY_CHECK_INTERVAL", "0.02", float)
+
+# 客户端 Gemini API 密钥验证结果的缓存时间（秒）（可通过Web配置，settings.json优先）
+# 有效密钥缓存 GEMINI_KEY_AUTH_TTL 秒，无效密钥缓存 GEMINI_KEY_AUTH_NEGATIVE_TTL 秒，0 表示不缓存
+GEMINI_KEY_AUTH_TTL = get_env_value("GEMINI_KEY_AUTH_TTL", "600", float)
+GEMINI_KEY_AUTH_NEGATIVE_TTL = get_env_value("GEMINI_KEY_AUTH_NEGATIVE_TTL", "60", float)
+
+# 密钥状态（有效性、熔断冷却、当日用量、最近错误）持久化到 STORAGE_DIR 下的 key_state.sqlite3，仅在 ENABLE_STORAGE 时启用
+# 状态变化每隔 KEY_STATE_FLUSH_INTERVAL 秒批量写入一次（不可通过Web配置）
+KEY_STATE_FLUSH_INTERVAL = get_env_value("KEY_STATE_FLUSH_INTERVAL", "5", float)
+
+# API密钥熔断（可通过Web配置，settings.json优先），冷却时间单位为秒
+BREAKER_ENABLED = get_env_value("BREAKER_ENABLED", "true", bool)
+BREAKER_AUTH_COOLDOWN = get_env_value("BREAKER_AUTH_COOLDOWN", "3600", float)  # 无效密钥（400）或权限被拒绝（403）
+BREAKER_QUOTA_COOLDOWN = get_env_value("BREAKER_QUOTA_COOLDOWN", "30", float)  # 配额耗尽（429）的初始冷却，连续出现时翻倍
+BREAKER_QUOTA_MAX_COOLDOWN = get_env_value("BREAKER_QUOTA_MAX_COOLDOWN", "1800", float)
+BREAKER_SERVER_THRESHOLD = get_env_value("BREAKER_SERVER_THRESHOLD", "3", int)  # 连续多少次 500/503 后熔断
+BREAKER_SERVER_COOLDOWN = get_env_value("BREAKER_SERVER_COOLDOWN", "10", float)
+BREAKER_TRIAL_TIMEOUT = get_env_value("BREAKER_TRIAL_TIMEOUT", "60", float)  # 半开试探请求无结果时，超过该时间再放行一次
+
 # 模型屏蔽黑名单，格式应为逗号分隔的模型名称集合（不可通过Web配置）
 BLOCKED_MODELS = { model.strip() for model in get_env_value("BLOCKED_MODELS", "").split(",") if model.strip() }
 
@@ -7,7 +7,6 @@ from app.models.schemas import ErrorResponse
 from app.services import GeminiClient
 from app.utils import (
     APIKeyManager, 
-    test_api_key, 
     ResponseCacheManager,
     ActiveRequestsManager,
     check_version,
@@ -16,12 +15,21 @@ from app.utils import (
     log
 )
 from app.config.persistence import save_settings, load_settings
+from app.utils.http_client import get_http_client, close_http_clients
+from app.utils.key_validation import key_validator
+from app.utils.key_store import key_state_store, current_hour, last_reset_time
+from app.utils.circuit_breaker import key_breaker
+from app.utils.key_limits import key_rate_ledger
+from app.utils.stats import api_stats_manager
+from app.utils.disk_cache import DiskCacheTier
+from app.services.gemini import GeminiResponseWrapper, GeminiStreamResponse
 from app.api import router, init_router, dashboard_router, init_dashboard_router
 from app.vertex.vertex_ai_init import init_vertex_ai
 from app.vertex.credentials_manager import CredentialManager
 import app.config.settings as settings
 from app.config.safety import SAFETY_SETTINGS, SAFETY_SETTINGS_G2
 import asyncio
+import time
 import sys
 import pathlib
 import os
@@ -58,7 +66,7 @@ def ensure_env_keys_persisted():
             current_keys_from_settings = [key.strip() for key in current_keys_from_settings if key.strip()]
             
             # 合并APIKeyManager中的密钥（包括从环境变量读取的）
-            all_unique_keys = list(set(current_keys_from_settings + key_manager.api_keys))
+            all_unique_keys = list(set(current_keys_from_settings).union(key_manager.api_keys))
             
             # 只有当密钥发生变化时才更新和保存
             if set(all_unique_keys) != set(current_keys_from_settings):
@@ -74,11 +82,33 @@ ensure_env_keys_persisted()
 # 创建全局缓存字典，将作为缓存管理器的内部存储
 response_cache = {}
 
+# 由 (模型名, 原始响应数据) 重建缓存的响应对象，供磁盘缓存和压缩缓存使用
+def load_cached_response(model, data):
+    if isinstance(data, list):
+        # 真流式响应以 chunk 列表形式缓存
+        return GeminiStreamResponse(data, model)
+    return GeminiResponseWrapper(data, model)
+
+# 磁盘二级缓存（可选），重启后仍可命中
+disk_cache_tier = None
+if settings.ENABLE_DISK_CACHE:
+    pathlib.Path(settings.STORAGE_DIR).mkdir(parents=True, exist_ok=True)
+    disk_cache_tier = DiskCacheTier(
+        db_path=str(pathlib.Path(settings.STORAGE_DIR) / "response_cache.sqlite3"),
+        expiry_time=settings.CACHE_EXPIRY_TIME,
+        loads=load_cached_response
+    )
+
 # 初始化缓存管理器，使用全局字典作为存储
 response_cache_manager = ResponseCacheManager(
     expiry_time=settings.CACHE_EXPIRY_TIME,
     max_entries=settings.MAX_CACHE_ENTRIES,
-    cache_dict=response_cache
+    max_bytes=settings.MAX_CACHE_BYTES,
+    cache_dict=response_cache,
+    disk_tier=disk_cache_tier,
+    compress_threshold=settings.CACHE_COMPRESS_THRESHOLD,
+    compress_level=settings.CACHE_COMPRESS_LEVEL,
+    loads=load_cached_response
 )
 
 # 活跃请求池 - 将作为活跃请求管理器的内部存储
@@ -105,45 +135,65 @@ SKIP_CHECK_API_KEY = os.environ.get("SKIP_CHECK_API_KEY", "").lower() == "true"
 #     response = await call_next(request)
 #     return response
 
-async def check_remaining_keys_async(keys_to_check: list, initial_invalid_keys: list):
+def restore_key_states(key_states: dict):
     """
-    在后台异步检查剩余的 API 密钥。
+    恢复重启前的熔断冷却、最近 24 小时的用量和本配额日的每日请求数。
+    """
+    now = time.time()
+    reset_hour = current_hour(last_reset_time())
+    cooling = 0
+    for api_key, state in key_states.items():
+        if state.cooldown_until > now:
+            key_breaker.restore(api_key, state.error_class, state.cooldown_until - now, state.last_error)
+            cooling += 1
+        for model, hours in state.usage.items():
+            daily_calls = 0
+            for hour, (calls, tokens) in hours.items():
+                api_stats_manager.restore_usage(api_key, model, hour, calls, tokens)
+                if hour >= reset_hour:
+                    daily_calls += calls
+            key_rate_ledger.restore_daily(api_key, model, daily_calls)
+    if cooling:
+        log('info', f"恢复 {cooling} 个密钥的熔断冷却")
+
+def merge_invalid_keys(invalid_keys: list):
+    """
+    将检测出的无效密钥合并到设置中的无效密钥列表，有变化时保存。
     """
-    local_invalid_keys = []
-    found_valid_keys =False
-
-    log('info', f" 开始在后台检查剩余 API Key 是否有效")
-    for key in keys_to_check:
-        is_valid = await test_api_key(key)
-        if is_valid:
-            if key not in key_manager.api_keys: # 避免重复添加
-                key_manager.api_keys.append(key)
-                found_valid_keys = True
-            # log('info', f"API Key {key[:8]}... 有效")
-        else:
-            local_invalid_keys.append(key)
-            log('warning', f" API Key {key[:8]}... 无效")
-        
-        await asyncio.sleep(0.05) # 短暂休眠，避免请求过于密集
-
-    if found_valid_keys:
-        key_manager._reset_key_stack() # 如果找到新的有效key，重置栈
-
-    # 合并所有无效密钥 (初始无效 + 后台检查出的无效)
-    combined_invalid_keys = list(set(initial_invalid_keys + local_invalid_keys))
-
-    # 获取当前设置中的无效密钥
     current_invalid_keys_str = settings.INVALID_API_KEYS or ""
     current_invalid_keys_set = set(k.strip() for k in current_invalid_keys_str.split(',') if k.strip())
-
-    # 更新无效密钥集合
-    new_invalid_keys_set = current_invalid_keys_set.union(set(combined_invalid_keys))
+    new_invalid_keys_set = current_invalid_keys_set.union(set(invalid_keys))
 
     # 只有当无效密钥列表发生变化时才保存
     if new_invalid_keys_set != current_invalid_keys_set:
         settings.INVALID_API_KEYS = ','.join(sorted(list(new_invalid_keys_set)))
         save_settings()
+        log('info', f"更新无效密钥列表完成，总无效密钥数: {len(new_invalid_keys_set)}")
+
+async def check_keys_async(keys_to_check: list, first_valid: asyncio.Future, checked_invalid_keys: list):
+    """
+    并发检查启动时的 API 密钥，有效密钥检测完成后立即加入密钥管理器，无效密钥记入 checked_invalid_keys。
+    找到第一个有效密钥（或全部检测完仍没有有效密钥）时设置 first_valid。
+    """
+    def on_result(key, is_valid):
+        if not is_valid:
+            checked_invalid_keys.append(key)
+            return
+        if key not in key_manager.api_keys: # 避免重复添加
+            key_manager.api_keys.append(key)
+        if not first_valid.done():
+            log('info', f"找到第一个有效密钥: {key[:8]}...")
+            key_manager._reset_key_stack()
+            first_valid.set_result(key)
 
+    try:
+        await key_validator.run(keys_to_check, on_result=on_result)
+    finally:
+        if not first_valid.done():
+            first_valid.set_result(None)
+
+    key_manager._reset_key_stack() # 检测完成，用全部有效密钥重置栈
+    merge_invalid_keys(checked_invalid_keys)
     log('info', f"密钥检查任务完成。当前总可用密钥数量: {len(key_manager.api_keys)}")
 
 # 设置全局异常处理
@@ -168,37 +218,45 @@ async def startup_event():
     # 添加到应用程序状态
     app.state.credential_manager = credential_manager_instance
     
+    # 按最新的网络配置创建上游共享连接池
+    get_http_client()
+    
+    # 后台预热磁盘缓存，不阻塞启动
+    if disk_cache_tier is not None:
+        asyncio.create_task(disk_cache_tier.warm_start())
+    
     # 初始化Vertex AI服务
     await init_vertex_ai(credential_manager=credential_manager_instance)
     schedule_cache_cleanup(response_cache_manager, active_requests_manager)
     # 检查版本
     await check_version()
     
-    # 密钥检查 
+    # 加载持久化的密钥状态
+    key_states = {}
+    if settings.ENABLE_STORAGE:
+        try:
+            pathlib.Path(settings.STORAGE_DIR).mkdir(parents=True, exist_ok=True)
+            key_states = await key_state_store.open(str(pathlib.Path(settings.STORAGE_DIR) / "key_state.sqlite3"))
+            restore_key_states(key_states)
+        except Exception as e:
+            log('error', f"加载密钥状态失败: {str(e)}")
+
+    # 密钥检查（包括运行中加入、已持久化到密钥状态库的客户端密钥）
     initial_keys = key_manager.api_keys.copy()
+    initial_keys.extend(key for key, state in key_states.items() if state.pooled and key not in key_manager.api_keys)
     key_manager.api_keys = [] # 清空，等待检查结果
-    first_valid_key = None
-    initial_invalid_keys = []
-    keys_to_check_later = []
-
-    # 阻塞式查找第一个有效密钥
-    for index, key in enumerate(initial_keys):
-        is_valid = await test_api_key(key)
-        if is_valid:
-            log('info', f"找到第一个有效密钥: {key[:8]}...")
-            first_valid_key = key
-            key_manager.api_keys.append(key) # 添加到管理器
-            key_manager._reset_key_stack()
-            # 将剩余的key放入后台检查列表
-            keys_to_check_later = initial_keys[index + 1:]
-            break # 找到即停止
-        else:
-            log('warning', f"密钥 {key[:8]}... 无效")
-            initial_invalid_keys.append(key)
-    
+    # 上次检测有效的密钥先检查，上次检测无效的密钥最后检查
+    validity_order = {True: 0, None: 1, False: 2}
+    initial_keys.sort(key=lambda key: validity_order[key_states[key].valid] if key in key_states else 1)
+
+    # 并发检查所有密钥，等到第一个有效密钥出现，其余密钥在后台继续检查
+    first_valid = asyncio.get_running_loop().create_future()
+    checked_invalid_keys = []
+    check_task = asyncio.create_task(check_keys_async(initial_keys, first_valid, checked_invalid_keys))
+    first_valid_key = await first_valid
+
     if not first_valid_key:
         log('error', "启动时未能找到任何有效 API 密钥！")
-        keys_to_check_later = [] # 没有有效key，无需后台检查
     else:
         # 使用第一个有效密钥加载模型
         try:
@@ -208,23 +266,13 @@ async def startup_event():
         except Exception as e:
             log('warning', f"使用密钥 {first_valid_key[:8]}... 加载可用模型失败",extra={'error_message': str(e)})
 
-    if not SKIP_CHECK_API_KEY:
-        # 创建后台任务检查剩余密钥
-        if keys_to_check_later:
-            asyncio.create_task(check_remaining_keys_async(keys_to_check_later, initial_invalid_keys))
-        else:
-            # 如果没有需要后台检查的key，也要处理初始无效key
-            current_invalid_keys_str = settings.INVALID_API_KEYS or ""
-            current_invalid_keys_set = set(k.strip() for k in current_invalid_keys_str.split(',') if k.strip())
-            new_invalid_keys_set = current_invalid_keys_set.union(set(initial_invalid_keys))
-            if new_invalid_keys_set != current_invalid_keys_set:
-                 settings.INVALID_API_KEYS = ','.join(sorted(list(new_invalid_keys_set)))
-                 save_settings()
-                 log('info', f"更新初始无效密钥列表完成，总无效密钥数: {len(new_invalid_keys_set)}")
-
-    else: # 跳过检查
+    if SKIP_CHECK_API_KEY and first_valid_key: # 跳过检查
         log('info',"跳过 API 密钥检查")
-        key_manager.api_keys.extend(keys_to_check_later)
+        check_task.cancel()
+        # 已确认有效的密钥保持在前，除已检测出无效和上次检测无效的密钥外，其余密钥不经检查直接加入
+        skipped = set(key_manager.api_keys).union(checked_invalid_keys)
+        skipped.update(key for key, state in key_states.items() if state.valid is False)
+        key_manager.api_keys.extend(key for key in dict.fromkeys(initial_keys) if key not in skipped)
         key_manager._reset_key_stack()
 
     # 初始化路由器
@@ -253,6 +301,16 @@ async def startup_event():
     # 启动浏览器
     open_browser()
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 关闭上游共享连接池
+    await close_http_clients()
+    # 等待磁盘缓存写入完成后关闭
+    if disk_cache_tier is not None:
+        await disk_cache_tier.close()
+    # 写入剩余的密钥状态后关闭
+    await key_state_store.close()
+
 # --------------- 异常处理 ---------------
 
 @app.exception_handler(Exception)
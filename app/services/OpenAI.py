@@ -1,4 +1,3 @@
-import json
 import os
 import asyncio
 from app.models.schemas import ChatCompletionRequest
@@ -12,7 +11,8 @@ from app.utils import format_log_message
 import app.config.settings as settings
 
 from app.utils.logging import log
-from app.utils.http_client import create_http_client
+from app.utils.http_client import get_http_client
+from app.utils.sse import aiter_sse_json
 
 def generate_secure_random_string(length):
     all_characters = string.ascii_letters + string.digits
@@ -72,37 +72,15 @@ class OpenAIClient:
             "Authorization": f"Bearer {self.api_key}"
         }
         
-        async with create_http_client() as client:
-            async with client.stream("POST", url, headers=headers, json=data, timeout=600) as response:
-                buffer = b"" # 用于累积可能不完整的 JSON 数据
-                try:
-                    async for line in response.aiter_lines():
-                        if not line.strip(): # 跳过空行 (SSE 消息分隔符)
-                            continue
-                        if line.startswith("data: "):
-                            line = line[len("data: "):].strip() # 去除 "data: " 前缀
-                        
-                        # 检查是否是结束标志，如果是，结束循环
-                        if line == "[DONE]":
-                            break 
-                        
-                        buffer += line.encode('utf-8')
-                        try:
-                            # 尝试解析整个缓冲区
-                            data = json.loads(buffer.decode('utf-8'))
-                            # 解析成功，清空缓冲区
-                            buffer = b"" 
-                            
-                            yield data
-
-                        except json.JSONDecodeError:
-                            # JSON 不完整，继续累积到 buffer
-                            continue 
-                        except Exception as e:
-                            log('ERROR', f"流式处理期间发生错误", 
-                                extra={'key': self.api_key[:8], 'request_type': 'stream', 'model': request.model})
-                            raise e
-                except Exception as e:
-                    raise e
-                finally:
-                    log('info', "流式请求结束")
+        client = get_http_client()
+        async with client.stream("POST", url, headers=headers, json=data, timeout=600) as response:
+            try:
+                # 按 SSE 事件边界增量解析，每个事件只解析一次
+                async for data in aiter_sse_json(response.aiter_bytes()):
+                    yield data
+            except Exception as e:
+                log('ERROR', f"流式处理期间发生错误", 
+                    extra={'key': self.api_key[:8], 'request_type': 'stream', 'model': request.model})
+                raise e
+            finally:
+                log('info', "流式请求结束")
@@ -1,9 +1,10 @@
-from app.services.gemini import GeminiClient, GeminiResponseWrapper, GeneratedText
+from app.services.gemini import GeminiClient, GeminiResponseWrapper, GeminiStreamResponse, GeneratedText
 from app.services.OpenAI import OpenAIClient
 
 __all__ = [
     'GeminiClient',
     'OpenAIClient',
     'GeminiResponseWrapper',
+    'GeminiStreamResponse',
     'GeneratedText'
 ]
\ No newline at end of file
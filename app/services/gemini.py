@@ -6,14 +6,18 @@ from typing import Optional, Dict, Any, List, Union
 import httpx
 import secrets
 import string
+import time
 import app.config.settings as settings
 
 from app.utils.logging import log
-from app.utils.http_client import create_http_client
+from app.utils.http_client import get_http_client
+from app.utils.key_scheduler import key_scheduler
+from app.utils.sse import SSEEvent, aiter_sse_events, aiter_sse_json
 from app.utils.encryption import (
     apply_encrypt_full_processing, 
     apply_encrypt_full_processing_ai_request,
     deobfuscate_text, 
+    deobfuscate_gemini_response,
     message_has_image,
     get_encrypt_full_system_instruction
 )
@@ -29,19 +33,29 @@ class GeneratedText:
     finish_reason: Optional[str] = None
 
 
+# 惰性属性尚未计算的标记
+_UNSET = object()
+
+
 class GeminiResponseWrapper:
+    """
+    Gemini 响应的轻量包装，所有派生字段在首次访问时才计算并缓存。
+    流式场景下每个 chunk 都会创建一个实例，因此不在构造时做任何提取或序列化。
+    """
+    __slots__ = (
+        '_data', '_model', '_is_encrypt_full',
+        '_text', '_thoughts', '_function_call', '_usage', '_json_dumps',
+    )
+
     def __init__(self, data: Dict[Any, Any], model_name: str = "gemini"):  
         self._data = data
         self._model = model_name
         self._is_encrypt_full = model_name.endswith("-encrypt-full")
-        self._text = self._extract_text()
-        self._finish_reason = self._extract_finish_reason()
-        self._prompt_token_count = self._extract_prompt_token_count()
-        self._candidates_token_count = self._extract_candidates_token_count()
-        self._total_token_count = self._extract_total_token_count()
-        self._thoughts = self._extract_thoughts()
-        self._function_call = self._extract_function_call()
-        self._json_dumps = json.dumps(self._data, indent=4, ensure_ascii=False)
+        self._text = _UNSET
+        self._thoughts = _UNSET
+        self._function_call = _UNSET
+        self._usage = _UNSET
+        self._json_dumps = _UNSET
 
     def _extract_thoughts(self) -> Optional[str]:
         try:
@@ -89,23 +103,9 @@ class GeminiResponseWrapper:
         except (KeyError, IndexError):
             return None
 
-    def _extract_prompt_token_count(self) -> Optional[int]:
-        try:
-            return self._data['usageMetadata'].get('promptTokenCount')
-        except (KeyError):
-            return None
-
-    def _extract_candidates_token_count(self) -> Optional[int]:
-        try:
-            return self._data['usageMetadata'].get('candidatesTokenCount')
-        except (KeyError):
-            return None
-
-    def _extract_total_token_count(self) -> Optional[int]:
-        try:
-            return self._data['usageMetadata'].get('totalTokenCount')
-        except (KeyError):
-            return None
+    def _extract_usage(self) -> Dict[str, Any]:
+        usage = self._data.get('usageMetadata')
+        return usage if isinstance(usage, dict) else {}
 
     def set_model(self,model) -> Optional[str]:
         self._model = model
@@ -116,30 +116,42 @@ class GeminiResponseWrapper:
 
     @property
     def text(self) -> str:
+        if self._text is _UNSET:
+            self._text = self._extract_text()
         return self._text
 
     @property
     def finish_reason(self) -> Optional[str]:
-        return self._finish_reason
+        return self._extract_finish_reason()
+
+    @property
+    def usage(self) -> Dict[str, Any]:
+        if self._usage is _UNSET:
+            self._usage = self._extract_usage()
+        return self._usage
 
     @property
     def prompt_token_count(self) -> Optional[int]:
-        return self._prompt_token_count
+        return self.usage.get('promptTokenCount')
 
     @property
     def candidates_token_count(self) -> Optional[int]:
-        return self._candidates_token_count
+        return self.usage.get('candidatesTokenCount')
 
     @property
     def total_token_count(self) -> Optional[int]:
-        return self._total_token_count
+        return self.usage.get('totalTokenCount')
 
     @property
     def thoughts(self) -> Optional[str]:
+        if self._thoughts is _UNSET:
+            self._thoughts = self._extract_thoughts()
         return self._thoughts
 
     @property
     def json_dumps(self) -> str:
+        if self._json_dumps is _UNSET:
+            self._json_dumps = json.dumps(self._data, indent=4, ensure_ascii=False)
         return self._json_dumps
 
     @property
@@ -148,9 +160,134 @@ class GeminiResponseWrapper:
 
     @property
     def function_call(self) -> Optional[List[Dict[str, Any]]]:
+        if self._function_call is _UNSET:
+            self._function_call = self._extract_function_call()
         return self._function_call
 
 
+def _is_plain_text_part(part: Dict[str, Any]) -> bool:
+    return 'text' in part and all(key in ('text', 'thought') for key in part)
+
+
+def merge_gemini_stream_chunks(chunks: List[Dict[Any, Any]]) -> Dict[Any, Any]:
+    """
+    把流式响应的各个 chunk 合并为一个完整响应。
+    相邻的同类文本 part（正文或思考）拼接为一个，其余 part 按顺序保留；
+    finishReason、usageMetadata 等字段取自最后一个 chunk。
+    """
+    if not chunks:
+        return {}
+    parts = []
+    texts = []  # 与 parts 中最后一个文本 part 对应的待拼接片段
+    for chunk in chunks:
+        try:
+            chunk_parts = chunk['candidates'][0]['content']['parts']
+        except (KeyError, IndexError, TypeError):
+            continue
+        for part in chunk_parts:
+            if not isinstance(part, dict):
+                continue
+            if (_is_plain_text_part(part) and texts and
+                    parts[-1].get('thought') == part.get('thought')):
+                texts.append(part['text'])
+                continue
+            if texts:
+                parts[-1]['text'] = ''.join(texts)
+            parts.append(dict(part))
+            texts = [part['text']] if _is_plain_text_part(part) else []
+    if texts:
+        parts[-1]['text'] = ''.join(texts)
+
+    merged = dict(chunks[-1])
+    candidates = merged.get('candidates')
+    if not isinstance(candidates, list) or not candidates:
+        merged['candidates'] = candidates = [{}]
+    candidate = dict(candidates[0])
+    content = dict(candidate.get('content') or {})
+    content['parts'] = parts
+    content.setdefault('role', 'model')
+    candidate['content'] = content
+    merged['candidates'] = [candidate] + candidates[1:]
+    return merged
+
+
+class GeminiStreamResponse:
+    """
+    真流式响应的缓存形式：按顺序保存上游返回的全部 chunk，命中时可逐块重放。
+    非流式读取（data、text 等）使用合并后的完整响应，接口与 GeminiResponseWrapper 一致。
+    """
+    __slots__ = ('_chunks', '_model', '_merged')
+
+    def __init__(self, chunks: List[Dict[Any, Any]], model_name: str = "gemini"):
+        self._chunks = chunks
+        self._model = model_name
+        self._merged = None
+
+    def set_model(self, model) -> Optional[str]:
+        self._model = model
+        if self._merged is not None:
+            self._merged.set_model(model)
+
+    @property
+    def chunks(self) -> List[Dict[Any, Any]]:
+        return self._chunks
+
+    def iter_chunk_responses(self):
+        """逐个返回各 chunk 的 GeminiResponseWrapper，用于重放"""
+        for chunk in self._chunks:
+            yield GeminiResponseWrapper(chunk, self._model)
+
+    @property
+    def merged(self) -> GeminiResponseWrapper:
+        if self._merged is None:
+            self._merged = GeminiResponseWrapper(merge_gemini_stream_chunks(self._chunks), self._model)
+        return self._merged
+
+    @property
+    def data(self) -> Dict[Any, Any]:
+        return self.merged.data
+
+    @property
+    def model(self) -> str:
+        return self._model
+
+    @property
+    def text(self) -> str:
+        return self.merged.text
+
+    @property
+    def thoughts(self) -> Optional[str]:
+        return self.merged.thoughts
+
+    @property
+    def function_call(self) -> Optional[List[Dict[str, Any]]]:
+        return self.merged.function_call
+
+    @property
+    def finish_reason(self) -> Optional[str]:
+        return self.merged.finish_reason
+
+    @property
+    def usage(self) -> Dict[str, Any]:
+        return self.merged.usage
+
+    @property
+    def prompt_token_count(self) -> Optional[int]:
+        return self.merged.prompt_token_count
+
+    @property
+    def candidates_token_count(self) -> Optional[int]:
+        return self.merged.candidates_token_count
+
+    @property
+    def total_token_count(self) -> Optional[int]:
+        return self.merged.total_token_count
+
+    @property
+    def json_dumps(self) -> str:
+        return self.merged.json_dumps
+
+
 class GeminiClient:
 
     AVAILABLE_MODELS = []
@@ -343,52 +480,115 @@ class GeminiClient:
             "Content-Type": "application/json",
         }
         
-        async with create_http_client() as client:
+        client = get_http_client()
+        # 记录首个数据块的延迟和调用结果，供密钥调度器使用
+        started = time.monotonic()
+        latency = error = None
+        # 在打开连接前开始计数，连接阶段的错误（连接失败、超时、代理错误）也计入该密钥
+        key_scheduler.begin(self.api_key, request.model)
+        try:
             async with client.stream("POST", url, headers=headers, json=data, timeout=600) as response:
                 try:
                     # 检查响应状态码，如果不是成功，则先消费响应体再抛出异常
                     if response.status_code != 200:
                         await response.aread()
                         response.raise_for_status()
-                        
-                    buffer = b"" # 用于累积可能不完整的 JSON 数据
-                    async for line in response.aiter_lines():
-                        if not line.strip(): # 跳过空行 (SSE 消息分隔符)
-                            continue
-                        if line.startswith("data: "):
-                            line = line[len("data: "):].strip() # 去除 "data: " 前缀
-                        
-                        # 检查是否是结束标志，如果是，结束循环
-                        if line == "[DONE]":
+                    
+                    # 按 SSE 事件边界增量解析，每个事件只解析一次
+                    async for data in aiter_sse_json(response.aiter_bytes()):
+                        # 记录到累积日志系统
+                        log_stream_chunk(stream_request_id, data)
+                    
+                        if latency is None:
+                            latency = time.monotonic() - started
+                        yield GeminiResponseWrapper(data)
+                    
+                except Exception:
+                    # 在重新抛出异常之前，确保响应体被完全读取
+                    if not response.is_closed:
+                        await response.aread()
+                    raise
+        except Exception as e:
+            error = e
+            # 异常情况下也要结束日志记录
+            log_stream_request_end(stream_request_id)
+            raise e
+        finally:
+            # 出错时不计入延迟样本
+            key_scheduler.end(self.api_key, request.model, latency if error is None else None, error)
+            log('info', "流式请求结束")
+            # 正常结束时完成日志记录
+            log_stream_request_end(stream_request_id)
+
+    # 原生 Gemini 流式请求：直接透传上游 SSE 事件
+    async def stream_chat_passthrough(self, request, contents, safety_settings, system_instruction):
+        """
+        产出上游原始 SSE 事件（SSEEvent），不做 JSON 解析和重新序列化。
+        仅在 encrypt-full 模式下需要去混淆时，才解析并重写事件内容。
+        """
+        extra_log = {'key': self.api_key[:8], 'request_type': 'stream', 'model': request.model}
+        log('INFO', "流式请求开始（透传）", extra=extra_log)
+        
+        # 初始化流式响应的累积日志
+        from app.utils.logging import log_stream_request_start, log_stream_chunk, log_stream_request_end
+        stream_request_id = log_stream_request_start(self.api_key, request.model)
+        is_encrypt_full = request.model.endswith("-encrypt-full")
+        
+        api_version, model, data = self._convert_request_data(request, contents, safety_settings, system_instruction)
+        
+        url = f"{settings.GEMINI_API_BASE_URL}/{api_version}/models/{model}:streamGenerateContent?key={self.api_key}&alt=sse"
+        headers = {
+            "Content-Type": "application/json",
+        }
+        
+        client = get_http_client()
+        # 记录首个数据块的延迟和调用结果，供密钥调度器使用
+        started = time.monotonic()
+        latency = error = None
+        # 在打开连接前开始计数，连接阶段的错误（连接失败、超时、代理错误）也计入该密钥
+        key_scheduler.begin(self.api_key, request.model)
+        try:
+            async with client.stream("POST", url, headers=headers, json=data, timeout=600) as response:
+                try:
+                    # 检查响应状态码，如果不是成功，则先消费响应体再抛出异常
+                    if response.status_code != 200:
+                        await response.aread()
+                        response.raise_for_status()
+                
+                    async for event in aiter_sse_events(response.aiter_bytes()):
+                        if event.is_done:
                             break
-                        
-                        buffer += line.encode('utf-8')
-                        try:
-                            # 尝试解析整个缓冲区
-                            data = json.loads(buffer.decode('utf-8'))
-                            # 解析成功，清空缓冲区
-                            buffer = b""
-                            
-                            # 记录到累积日志系统
-                            log_stream_chunk(stream_request_id, data)
-                            
-                            yield GeminiResponseWrapper(data)
-
-                        except json.JSONDecodeError:
-                            # JSON 不完整，继续累积到 buffer
-                            continue
-                        
-                except Exception as e:
+                    
+                        if is_encrypt_full:
+                            # encrypt-full 模式需要去混淆，只有这里才解析事件
+                            payload = deobfuscate_gemini_response(json.loads(event.data))
+                            event_data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                            event = SSEEvent(b"data: " + event_data, event_data)
+                    
+                        # 仅在开启上游日志时才解析事件用于记录
+                        if stream_request_id:
+                            log_stream_chunk(stream_request_id, json.loads(event.data))
+                    
+                        if latency is None:
+                            latency = time.monotonic() - started
+                        yield event
+                    
+                except Exception:
                     # 在重新抛出异常之前，确保响应体被完全读取
                     if not response.is_closed:
                         await response.aread()
-                    # 异常情况下也要结束日志记录
-                    log_stream_request_end(stream_request_id)
-                    raise e
-                finally:
-                    log('info', "流式请求结束")
-                    # 正常结束时完成日志记录
-                    log_stream_request_end(stream_request_id)
+                    raise
+        except Exception as e:
+            error = e
+            # 异常情况下也要结束日志记录
+            log_stream_request_end(stream_request_id)
+            raise e
+        finally:
+            # 出错时不计入延迟样本
+            key_scheduler.end(self.api_key, request.model, latency if error is None else None, error)
+            log('info', "流式请求结束")
+            # 正常结束时完成日志记录
+            log_stream_request_end(stream_request_id)
 
     # 非流式处理
     async def complete_chat(self, request, contents, safety_settings, system_instruction, log_response=True):
@@ -400,12 +600,17 @@ class GeminiClient:
             "Content-Type": "application/json",
         }
         
+        # 记录本次调用的延迟和结果，供密钥调度器使用
+        started = time.monotonic()
+        latency = error = None
+        key_scheduler.begin(self.api_key, request.model)
         try:
-            async with create_http_client() as client:
-                response = await client.post(url, headers=headers, json=data, timeout=600) 
-                response.raise_for_status() # 检查 HTTP 错误状态
+            client = get_http_client()
+            response = await client.post(url, headers=headers, json=data, timeout=600) 
+            response.raise_for_status() # 检查 HTTP 错误状态
             
             response_json = response.json()
+            latency = time.monotonic() - started
             
             # 记录完整的上游响应（动态检查环境变量）
             if log_response:
@@ -414,7 +619,10 @@ class GeminiClient:
             
             return GeminiResponseWrapper(response_json, request.model)
         except Exception as e:
+            error = e
             raise
+        finally:
+            key_scheduler.end(self.api_key, request.model, latency, error)
 
     # OpenAI 格式请求转换为 gemini 格式请求
     def convert_messages(self, messages, use_system_prompt=False, model=None):
@@ -539,18 +747,18 @@ class GeminiClient:
     async def list_available_models(api_key) -> list:
         url = "{}/v1beta/models?key={}".format(
             settings.GEMINI_API_BASE_URL, api_key)
-        async with create_http_client() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            data = response.json()
-            models = []
-            for model in data.get("models", []):
-                models.append(model["name"])
-                if model["name"].startswith("models/gemini-2") and settings.search["search_mode"]:
-                    models.append(model["name"] + "-search")
-            models.extend(GeminiClient.EXTRA_MODELS)
-                
-            return models
+        client = get_http_client()
+        response = await client.get(url)
+        response.raise_for_status()
+        data = response.json()
+        models = []
+        for model in data.get("models", []):
+            models.append(model["name"])
+            if model["name"].startswith("models/gemini-2") and settings.search["search_mode"]:
+                models.append(model["name"] + "-search")
+        models.extend(GeminiClient.EXTRA_MODELS)
+            
+        return models
 
     @staticmethod
     async def list_native_models(api_key):
@@ -559,8 +767,8 @@ class GeminiClient:
         """
         url = "{}/v1beta/models?key={}".format(
             settings.GEMINI_API_BASE_URL, api_key)
-        async with create_http_client() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            return response.json()
+        client = get_http_client()
+        response = await client.get(url)
+        response.raise_for_status()
+        return response.json()
 
@@ -6,27 +6,33 @@ import asyncio
 from datetime import datetime, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 from app.utils.logging import format_log_message
+from app.utils.circuit_breaker import key_breaker
+from app.utils.key_scheduler import key_scheduler
+from app.utils.key_limits import key_rate_ledger
+from app.utils.key_pool import KeyPool
+from app.utils.key_store import key_state_store
+from app.utils.stats import api_stats_manager
 import app.config.settings as settings
 logger = logging.getLogger("my_logger")
 
+API_KEY_PATTERN = re.compile(r"AIzaSy[a-zA-Z0-9_-]{33}")
+# 客户端密钥加入密钥池后延迟保存设置的秒数，期间加入的多个密钥只保存一次
+POOLED_KEYS_SAVE_DELAY = 5
+
+def parse_api_keys(text: str) -> list:
+    """解析逗号分隔的密钥；启用存储时使用严格格式检查（保持原逻辑），禁用存储时使用宽松解析"""
+    if settings.ENABLE_STORAGE:
+        return API_KEY_PATTERN.findall(text)
+    return [key.strip() for key in text.split(',') if key.strip()]
+
 class APIKeyManager:
     def __init__(self):
-        # 检查是否启用存储，如果禁用存储则跳过格式检查
-        if settings.ENABLE_STORAGE:
-            # 启用存储时使用严格格式检查（保持原逻辑）
-            self.api_keys = re.findall(
-                r"AIzaSy[a-zA-Z0-9_-]{33}", settings.GEMINI_API_KEYS)
-        else:
-            # 禁用存储时使用宽松解析（解决当前问题）
-            self.api_keys = [key.strip() for key in settings.GEMINI_API_KEYS.split(',') if key.strip()]
+        self._pool = KeyPool(parse_api_keys(settings.GEMINI_API_KEYS))
         
         # 加载更多 GEMINI_API_KEYS，应用同样的逻辑
         for i in range(1, 99):
             if keys := os.environ.get(f"GEMINI_API_KEYS_{i}", ""):
-                if settings.ENABLE_STORAGE:
-                    self.api_keys += re.findall(r"AIzaSy[a-zA-Z0-9_-]{33}", keys)
-                else:
-                    self.api_keys += [key.strip() for key in keys.split(',') if key.strip()]
+                self._pool.extend(parse_api_keys(keys))
             else:
                 break
 
@@ -35,72 +41,127 @@ class APIKeyManager:
         self.scheduler = BackgroundScheduler()
         self.scheduler.start()
         self.lock = asyncio.Lock() # Added lock
+        self._save_task = None
+
+    @property
+    def api_keys(self) -> KeyPool:
+        return self._pool
+
+    @api_keys.setter
+    def api_keys(self, keys):
+        """整体替换密钥池（如检测完成后），保留同一个 KeyPool 对象"""
+        if keys is not self._pool:
+            self._pool.replace(keys)
 
     def _reset_key_stack(self):
         """创建并随机化密钥栈"""
-        shuffled_keys = self.api_keys[:]  # 创建 api_keys 的副本以避免直接修改原列表
+        shuffled_keys = self.api_keys.copy()  # 创建 api_keys 的副本以避免直接修改原列表
         random.shuffle(shuffled_keys)
         self.key_stack = shuffled_keys
 
+    def _push_stack_key(self, api_key):
+        """把新密钥放到密钥栈的随机位置，无需重新生成整个栈"""
+        self.key_stack.append(api_key)
+        position = random.randrange(len(self.key_stack))
+        self.key_stack[position], self.key_stack[-1] = self.key_stack[-1], self.key_stack[position]
+
     async def add_successful_client_key(self, client_key: str):
         """在请求成功后将客户端密钥添加到池中（去重），并持久化保存"""
         async with self.lock:
-            if client_key not in self.api_keys:
-                # 添加到内存中的密钥池
-                self.api_keys.append(client_key)
-                self._reset_key_stack()
-                
-                # 更新settings中的GEMINI_API_KEYS并持久化
-                current_keys = settings.GEMINI_API_KEYS.split(',') if settings.GEMINI_API_KEYS else []
-                current_keys = [key.strip() for key in current_keys if key.strip()]
-                
-                if client_key not in current_keys:
-                    current_keys.append(client_key)
-                    settings.GEMINI_API_KEYS = ','.join(current_keys)
-                    
-                    # 调用持久化保存
-                    try:
-                        from app.config.persistence import save_settings
-                        save_settings()
-                        log_msg = format_log_message('INFO', f"已添加成功验证的客户端API密钥到池中并持久化: {client_key[:8]}...")
-                        logger.info(log_msg)
-                    except Exception as e:
-                        log_msg = format_log_message('WARNING', f"客户端API密钥已添加到内存池，但持久化失败: {str(e)}")
-                        logger.warning(log_msg)
-                
-                return True
-            return False
-
-    async def get_available_key(self, priority_key: str = None):
-        """从栈顶获取密钥，若栈空则重新生成
+            if not self.api_keys.add(client_key):
+                return False
+            self._push_stack_key(client_key)
+            # 同步更新内存中的 GEMINI_API_KEYS，仪表盘和重新检测密钥时都能看到该密钥
+            settings.GEMINI_API_KEYS = f"{settings.GEMINI_API_KEYS},{client_key}" if settings.GEMINI_API_KEYS else client_key
+            self._schedule_save()
+            # 启用存储时同时记入密钥状态库，启动时合并回密钥池
+            key_state_store.record_pooled(client_key)
+            log_msg = format_log_message('INFO', f"已添加成功验证的客户端API密钥到池中: {client_key[:8]}...")
+            logger.info(log_msg)
+            return True
+
+    def _schedule_save(self):
+        """延迟保存设置，短时间内加入的多个客户端密钥合并为一次写入"""
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._save_after_delay())
+
+    async def _save_after_delay(self):
+        await asyncio.sleep(POOLED_KEYS_SAVE_DELAY)
+        try:
+            from app.config.persistence import save_settings
+            # 在线程中写入 settings.json，不阻塞事件循环
+            await asyncio.to_thread(save_settings)
+            log_msg = format_log_message('INFO', "已持久化加入密钥池的客户端API密钥")
+            logger.info(log_msg)
+        except Exception as e:
+            log_msg = format_log_message('WARNING', f"客户端API密钥已添加到内存池，但持久化失败: {str(e)}")
+            logger.warning(log_msg)
+
+    async def get_available_key(self, priority_key: str = None, exclude=None, model: str = None):
+        """获取一个可用密钥
         
         实现负载均衡：
-        1. 维护一个随机排序的栈存储apikey
-        2. 每次调用从栈顶取出一个key返回
-        3. 栈空时重新随机生成栈
+        1. KEY_SCHEDULER 为 weighted/best 时由密钥调度器按健康状况选择，跳过 exclude 中的密钥
+        2. 指定 model 时跳过会被上游限流的密钥；所有密钥都会被限流时，预计等待不超过
+           KEY_RATE_LIMIT_MAX_WAIT 秒则等待后再选一次，否则返回 None
+        3. 调度器没有可选密钥（如全部达到每日限制）或 KEY_SCHEDULER 为 random 时，使用随机排序的密钥栈，
+           每次调用从栈顶取出一个key返回，栈空时重新随机生成栈
         4. 确保异步和并发安全
         5. 支持优先密钥，如果提供则直接返回
         """
         # 如果有优先密钥，直接返回
         if priority_key:
             return priority_key
+        
+        for attempt in range(2):
+            async with self.lock:
+                wait = None
+                if settings.KEY_SCHEDULER != "random":
+                    # 密钥池被直接修改过时才会重新同步
+                    key_scheduler.sync(self.api_keys, api_stats_manager.key_calls_24h)
+                    api_key, wait = key_scheduler.acquire(exclude, model)
+                    if api_key:
+                        if attempt:
+                            key_rate_ledger.record_admission("delayed")
+                        elif model and settings.KEY_RATE_LIMIT_ENABLED:
+                            key_rate_ledger.record_admission("admitted")
+                        return api_key
+                if wait is None:
+                    return self._pop_stack_key()
             
-        async with self.lock:
+            # 所有可选密钥都会被限流，按预计等待时间决定延迟发送还是拒绝
+            if attempt or wait > settings.KEY_RATE_LIMIT_MAX_WAIT:
+                key_rate_ledger.record_admission("rejected")
+                log_msg = format_log_message('WARNING', f"所有API密钥对模型 {model} 均已达到速率限制，预计需等待 {wait:.1f} 秒，拒绝请求")
+                logger.warning(log_msg)
+                return None
+            log_msg = format_log_message('INFO', f"所有API密钥对模型 {model} 均已达到速率限制，等待 {wait:.1f} 秒后发送")
+            logger.info(log_msg)
+            await asyncio.sleep(wait)
+
+    def _pop_stack_key(self):
+        """从随机密钥栈顶取出key，跳过处于熔断状态的密钥，最多检查一轮全部密钥（需持有 self.lock）"""
+        for _ in range(len(self.key_stack) + len(self.api_keys)):
             # 如果栈为空，重新生成
             if not self.key_stack:
                 self._reset_key_stack()
-            
-            # 从栈顶取出key
-            if self.key_stack:
-                return self.key_stack.pop()
-            
-            # 如果没有可用的API密钥，记录错误
-            if not self.api_keys:
-                log_msg = format_log_message('ERROR', "没有配置任何 API 密钥！")
-                logger.error(log_msg)
-            log_msg = format_log_message('ERROR', "没有可用的API密钥！")
+            if not self.key_stack:
+                break
+            api_key = self.key_stack.pop()
+            # 栈中可能残留已从密钥池删除的密钥
+            if api_key in self.api_keys and key_breaker.allow(api_key):
+                return api_key
+        
+        # 如果没有可用的API密钥，记录错误
+        if not self.api_keys:
+            log_msg = format_log_message('ERROR', "没有配置任何 API 密钥！")
+            logger.error(log_msg)
+        else:
+            log_msg = format_log_message('ERROR', "所有API密钥均处于熔断状态！")
             logger.error(log_msg)
-            return None
+        log_msg = format_log_message('ERROR', "没有可用的API密钥！")
+        logger.error(log_msg)
+        return None
 
     def show_all_keys(self):
         log_msg = format_log_message('INFO', f"当前可用API key个数: {len(self.api_keys)} ")
@@ -120,14 +181,23 @@ async def test_api_key(api_key: str) -> bool:
     """
     测试 API 密钥是否有效。
     """
+    return await check_api_key(api_key) is True
+
+async def check_api_key(api_key: str):
+    """
+    检查 API 密钥是否有效：有效返回 True，上游明确拒绝（400/401/403）返回 False，
+    超时、连接错误、429、5xx 等无法判断的情况返回 None。
+    """
     try:
-        import httpx
         import app.config.settings as settings
-        from app.utils.http_client import create_http_client
+        from app.utils.http_client import get_http_client
         url = "{}/v1beta/models?key={}".format(settings.GEMINI_API_BASE_URL, api_key)
-        async with create_http_client() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            return True
+        client = get_http_client()
+        response = await client.get(url)
     except Exception:
+        return None
+    if response.is_success:
+        return True
+    if response.status_code in (400, 401, 403):
         return False
+    return None
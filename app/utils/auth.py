@@ -2,7 +2,7 @@ from typing import Optional, Tuple
 from fastapi import HTTPException, Header, Query
 import app.config.settings as settings
 import re
-from app.utils.api_key import test_api_key
+from app.utils.auth_cache import validated_key_cache
 
 # 自定义密码校验依赖函数
 async def custom_verify_password(
@@ -49,9 +49,13 @@ async def verify_gemini_auth(
     if client_key:
         # 检测是否为 Gemini API key 格式
         if re.match(r"AIzaSy[a-zA-Z0-9_-]{33}", client_key):
-            # 验证 API key 有效性
-            if await test_api_key(client_key):
+            # 验证 API key 有效性，结果按密钥缓存
+            is_valid = await validated_key_cache.validate(client_key)
+            if is_valid:
                 return ("gemini_key", client_key)
+            elif is_valid is None:
+                # 上游暂时异常，无法判断密钥是否有效，不按无效密钥拒绝
+                raise HTTPException(status_code=503, detail="Unable to verify Gemini API key, please retry")
             else:
                 raise HTTPException(status_code=401, detail="Invalid Gemini API key")
         
@@ -0,0 +1,83 @@
+"""
+客户端 Gemini API 密钥的验证结果缓存
+
+verify_gemini_auth 需要确认客户端提供的 AIzaSy... 密钥有效，每次都请求上游 /v1beta/models 会给每个请求增加一次往返。
+验证结果按密钥缓存：
+- 有效的密钥缓存 GEMINI_KEY_AUTH_TTL 秒，上游明确拒绝（400/401/403）的密钥缓存 GEMINI_KEY_AUTH_NEGATIVE_TTL 秒；
+  超时、连接错误、429、5xx 等无法判断的结果不缓存，下一个请求重新验证
+- 同一密钥同时到达的多个验证请求只向上游发送一次，其余请求等待同一个结果
+- 之后该密钥在上游返回无效密钥（400）或权限被拒绝（403）时，由 handle_gemini_error 清除缓存
+最多保存 MAX_ENTRIES 个密钥，超出时淘汰最久未使用的；只在事件循环中调用，无需加锁。
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from app.utils.api_key import check_api_key
+import app.config.settings as settings
+
+MAX_ENTRIES = 10000
+
+
+class ValidatedKeyCache:
+    """客户端密钥 -> (是否有效, 过期时间)"""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._pending = {}  # 密钥 -> 正在进行的验证任务
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "unverified": 0}
+
+    async def validate(self, api_key):
+        """有效返回 True，无效返回 False，暂时无法验证（上游异常）时返回 None"""
+        entry = self._entries.get(api_key)
+        if entry is not None:
+            is_valid, expires = entry
+            if time.monotonic() < expires:
+                self._entries.move_to_end(api_key)
+                self.stats["hits"] += 1
+                return is_valid
+            del self._entries[api_key]
+
+        task = self._pending.get(api_key)
+        if task is None:
+            self.stats["misses"] += 1
+            task = self._pending[api_key] = asyncio.create_task(self._check(api_key))
+        else:
+            self.stats["coalesced"] += 1
+        # 单个请求被取消时不影响其他等待同一结果的请求
+        return await asyncio.shield(task)
+
+    async def _check(self, api_key):
+        task = asyncio.current_task()
+        try:
+            is_valid = await check_api_key(api_key)
+        finally:
+            # 验证期间该密钥已被清除时，结果不再缓存
+            current = self._pending.get(api_key) is task
+            if current:
+                del self._pending[api_key]
+        if is_valid is None:
+            self.stats["unverified"] += 1
+            return None
+        ttl = settings.GEMINI_KEY_AUTH_TTL if is_valid else settings.GEMINI_KEY_AUTH_NEGATIVE_TTL
+        if current and ttl > 0:
+            self._entries[api_key] = (is_valid, time.monotonic() + ttl)
+            self._entries.move_to_end(api_key)
+            while len(self._entries) > MAX_ENTRIES:
+                self._entries.popitem(last=False)
+        return is_valid
+
+    def invalidate(self, api_key):
+        """密钥在上游返回 400/403 后清除缓存，下一个请求重新验证"""
+        self._entries.pop(api_key, None)
+        self._pending.pop(api_key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._pending.clear()
+
+    def snapshot(self):
+        return {"size": len(self._entries), **self.stats}
+
+
+validated_key_cache = ValidatedKeyCache()
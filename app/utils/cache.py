@@ -1,213 +1,375 @@
 import time
 import xxhash 
 import asyncio
-from typing import Dict, Any, Optional, Tuple
+import itertools
+from typing import Dict, Any, Optional, Tuple, List
 import logging
-from collections import deque
+from collections import deque, OrderedDict
 from app.utils.logging import log
 logger = logging.getLogger("my_logger")
 import heapq
+import sys
+import json
+import zlib
 
-# 定义缓存项的结构
-CacheItem = Dict[str, Any]
+def estimate_size(obj: Any) -> int:
+    """
+    估算对象及其引用的容器、字符串占用的字节数（近似值）。
+    遍历 dict/list/tuple/set、带 __slots__ 或 __dict__ 的对象，共享对象只计算一次。
+    """
+    total = 0
+    seen = set()
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if current is None or id(current) in seen:
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+        if isinstance(current, (str, bytes, bytearray, int, float, bool)):
+            continue
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset, deque)):
+            stack.extend(current)
+        else:
+            for cls in type(current).__mro__:
+                for slot in getattr(cls, '__slots__', ()):
+                    value = getattr(current, slot, None)
+                    if value is not None:
+                        stack.append(value)
+            if hasattr(current, '__dict__'):
+                stack.append(current.__dict__)
+    return total
+
+# 超过该大小的压缩/解压放到线程中执行，避免阻塞事件循环
+_COMPRESS_OFFLOAD_BYTES = 256 * 1024
+
+def cache_payload(response: Any) -> Any:
+    """
+    返回用于序列化（压缩、写入磁盘）的原始响应数据：
+    真流式响应为 chunk 列表，其余响应为单个响应字典；无法序列化时返回 None。
+    """
+    chunks = getattr(response, 'chunks', None)
+    if chunks is not None:
+        return chunks
+    return getattr(response, 'data', None)
+
+class CompressedResponse:
+    """压缩后的响应：保存原始响应数据的 zlib 压缩结果，命中时再还原"""
+    __slots__ = ('model', 'blob', 'raw_size')
+
+    def __init__(self, model: str, blob: bytes, raw_size: int):
+        self.model = model
+        self.blob = blob
+        self.raw_size = raw_size
+
+class CacheItem:
+    """单个缓存项，被 key 对应的 deque、LRU 索引和过期堆共同引用"""
+    __slots__ = ('key', 'response', 'expiry_time', 'created_at', 'size', 'removed', 'disk_id')
+
+    def __init__(self, key: str, response: Any, expiry_time: float, created_at: float, size: int = 0):
+        self.key = key
+        self.response = response
+        self.expiry_time = expiry_time
+        self.created_at = created_at
+        self.size = size  # 估算的字节数
+        self.removed = False  # 已被取出、过期或淘汰；堆中的引用会被延迟丢弃
+        self.disk_id = None  # 磁盘缓存中对应记录的ID（未启用磁盘缓存时为 None）
 
 class ResponseCacheManager:
-    """管理API响应缓存的类，一个键可以对应多个缓存项（使用deque）"""
+    """
+    管理API响应缓存的类，一个键可以对应多个缓存项（使用deque）
     
-    def __init__(self, expiry_time: int, max_entries: int, 
-                 cache_dict: Dict[str, deque[CacheItem]] = None):
+    除按键存放的 deque 外，另外维护两个索引，使各操作均为 O(1) 或 O(log n)：
+    - LRU 索引（OrderedDict）：按最近使用顺序排列，用于容量淘汰
+    - 过期堆（heapq）：按过期时间排列，用于清理过期项；被提前移除的项延迟丢弃
+    
+    可选的磁盘层（DiskCacheTier）：写入时同时落盘，内存未命中时再查磁盘。
+    内存因容量淘汰的项仍保留在磁盘上，直到被取出或过期。
+    """
+    
+    def __init__(self, expiry_time: int, max_entries: int, max_bytes: int = 0,
+                 cache_dict: Dict[str, deque[CacheItem]] = None, disk_tier=None,
+                 compress_threshold: int = 0, compress_level: int = 6, loads=None):
         """
         初始化缓存管理器。
         
         Args:
             expiry_time (int): 缓存项的过期时间（秒）。
             max_entries (int): 缓存中允许的最大总条目数。
+            max_bytes (int, optional): 缓存估算占用字节数上限，0 表示不限制。
             cache_dict (Dict[str, deque[CacheItem]], optional): 初始缓存字典。默认为 None。
+            disk_tier (DiskCacheTier, optional): 磁盘二级缓存。默认为 None（仅使用内存）。
+            compress_threshold (int, optional): 响应数据序列化后超过该字节数时压缩存储，0 表示不压缩。
+            compress_level (int, optional): zlib 压缩级别（1-9）。
+            loads (callable, optional): 由 (模型名, 原始响应数据) 重建响应对象的函数，启用压缩时必需。
         """
         self.cache: Dict[str, deque[CacheItem]] = cache_dict if cache_dict is not None else {}
         self.expiry_time = expiry_time
         self.max_entries = max_entries # 总条目数限制
         self.cur_cache_num = 0 # 当前条目数
+        self.max_bytes = max_bytes # 总字节数限制（估算）
+        self.cur_cache_bytes = 0 # 当前估算字节数
+        self.evicted_bytes = 0 # 因容量限制累计淘汰的字节数
         self.lock = asyncio.Lock() # Added lock
+        self._lru: "OrderedDict[CacheItem, None]" = OrderedDict() # 最久未使用的在最前
+        self._expiry_heap: List[Tuple[float, int, CacheItem]] = [] # (过期时间, 序号, 缓存项)
+        self._seq = itertools.count()
+        self.disk_tier = disk_tier
+        self.compress_threshold = compress_threshold if loads is not None else 0
+        self.compress_level = compress_level
+        self.loads = loads
+        # 压缩统计
+        self.compressed_entries = 0 # 累计压缩的条目数
+        self.compressed_raw_bytes = 0 # 压缩前累计字节数
+        self.compressed_bytes = 0 # 压缩后累计字节数
+        self.compress_seconds = 0.0 # 累计压缩耗时
+        self.decompress_seconds = 0.0 # 累计解压耗时
+
+    def _discard(self, item: CacheItem):
+        """从所有索引中移除一个缓存项（调用方需持有锁）"""
+        if item.removed:
+            return
+        item.removed = True
+        item.response = None # 尽早释放响应对象
+        self._lru.pop(item, None)
+        self.cur_cache_num = max(0, self.cur_cache_num - 1)
+        self.cur_cache_bytes = max(0, self.cur_cache_bytes - item.size)
+        cache_deque = self.cache.get(item.key)
+        if cache_deque is not None:
+            # 被移除的项只在到达队头时才真正出队，队中间的项保持原位
+            while cache_deque and cache_deque[0].removed:
+                cache_deque.popleft()
+            if not cache_deque:
+                del self.cache[item.key]
+
+    def _first_valid(self, cache_key: str, now: float) -> Optional[CacheItem]:
+        """返回键对应的第一个有效缓存项，顺带移除队头的过期项（调用方需持有锁）"""
+        cache_deque = self.cache.get(cache_key)
+        while cache_deque:
+            item = cache_deque[0]
+            if item.removed:
+                cache_deque.popleft()
+            elif now >= item.expiry_time:
+                self._discard(item)
+                cache_deque = self.cache.get(cache_key)
+            else:
+                return item
+        if cache_deque is not None and not cache_deque:
+            del self.cache[cache_key]
+        return None
+
+    def count(self, cache_key: str) -> int:
+        """返回键在内存中的有效缓存项数量"""
+        now = time.time()
+        return sum(1 for item in self.cache.get(cache_key, ()) if not item.removed and now < item.expiry_time)
+
+    def _over_capacity(self) -> bool:
+        """条目数或估算字节数是否超出限制"""
+        if self.cur_cache_num > self.max_entries:
+            return True
+        return self.max_bytes > 0 and self.cur_cache_bytes > self.max_bytes
+
+    def _evict_overflow(self) -> int:
+        """
+        按 LRU 顺序淘汰超出容量的项，返回淘汰数量（调用方需持有锁）。
+        最近写入的一项始终保留，否则单个超大响应会在被读取前就被淘汰。
+        """
+        evicted = 0
+        while self._over_capacity() and len(self._lru) > 1:
+            item = next(iter(self._lru))
+            self.evicted_bytes += item.size
+            self._discard(item)
+            evicted += 1
+        return evicted
+
+    def _compact_expiry_heap(self):
+        """过期堆中失效引用过多时重建堆，保证其大小与有效条目数同阶（调用方需持有锁）"""
+        if len(self._expiry_heap) > 2 * self.cur_cache_num + 64:
+            self._expiry_heap = [entry for entry in self._expiry_heap if not entry[2].removed]
+            heapq.heapify(self._expiry_heap)
+
+    def _compress(self, response: Any) -> Tuple[Optional[CompressedResponse], float]:
+        """序列化并压缩响应数据，未达到阈值时返回 None；同时返回耗时（可在线程中执行）"""
+        start = time.perf_counter()
+        raw = json.dumps(cache_payload(response), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        if len(raw) < self.compress_threshold:
+            return None, time.perf_counter() - start
+        blob = zlib.compress(raw, self.compress_level)
+        return CompressedResponse(getattr(response, 'model', ''), blob, len(raw)), time.perf_counter() - start
+
+    def _decompress(self, payload: CompressedResponse) -> Tuple[Any, float]:
+        """解压并重建响应对象，同时返回耗时（可在线程中执行）"""
+        start = time.perf_counter()
+        data = json.loads(zlib.decompress(payload.blob))
+        return self.loads(payload.model, data), time.perf_counter() - start
+
+    async def _maybe_compress(self, response: Any, size: int) -> Any:
+        """响应足够大时返回压缩后的对象，否则原样返回"""
+        if self.compress_threshold <= 0 or size < self.compress_threshold or cache_payload(response) is None:
+            return response
+        try:
+            if size >= _COMPRESS_OFFLOAD_BYTES:
+                compressed, elapsed = await asyncio.to_thread(self._compress, response)
+            else:
+                compressed, elapsed = self._compress(response)
+        except (TypeError, ValueError) as e:
+            log('warning', f"缓存压缩失败，按原样存储: {str(e)}")
+            return response
+        self.compress_seconds += elapsed
+        if compressed is None:
+            return response
+        self.compressed_entries += 1
+        self.compressed_raw_bytes += compressed.raw_size
+        self.compressed_bytes += len(compressed.blob)
+        return compressed
+
+    async def _restore(self, payload: Any) -> Any:
+        """命中时还原压缩的响应"""
+        if not isinstance(payload, CompressedResponse):
+            return payload
+        if payload.raw_size >= _COMPRESS_OFFLOAD_BYTES:
+            response, elapsed = await asyncio.to_thread(self._decompress, payload)
+        else:
+            response, elapsed = self._decompress(payload)
+        self.decompress_seconds += elapsed
+        return response
+
+    @property
+    def compression_ratio(self) -> float:
+        """压缩前后的字节数之比"""
+        if not self.compressed_bytes:
+            return 0.0
+        return self.compressed_raw_bytes / self.compressed_bytes
 
     async def get(self, cache_key: str) -> Tuple[Optional[Any], bool]: # Made async
         """获取指定键的第一个有效缓存项（不删除）"""
         now = time.time()
         async with self.lock:
-            if cache_key in self.cache:
-                cache_deque = self.cache[cache_key]
-                # 查找第一个未过期的项，且不删除
-                for item in cache_deque:
-                    if now < item.get('expiry_time', 0):
-                        response = item.get('response',None)
-                        return response, True
+            item = self._first_valid(cache_key, now)
+            payload = None
+            if item is not None:
+                # 标记为最近使用
+                self._lru.move_to_end(item)
+                payload = item.response
+
+        if payload is not None:
+            return await self._restore(payload), True
+
+        # 内存未命中时按需查询磁盘（不加载进内存，避免与磁盘记录重复）
+        if self.disk_tier is not None and self.disk_tier.may_contain(cache_key):
+            record = await self.disk_tier.take(cache_key, remove=False)
+            if record is not None:
+                return record[1], True
             
-            return None, False
+        return None, False
 
     async def get_and_remove(self, cache_key: str) -> Tuple[Optional[Any], bool]:
         """获取并删除指定键的第一个有效缓存项。"""
         now = time.time()
         async with self.lock:
-            if cache_key in self.cache:
-                cache_deque = self.cache[cache_key]
-
-                # 查找第一个有效项并收集过期项
-                valid_item_to_remove = None
-                response_to_return = None
-                new_deque = deque()
-                items_removed_count = 0
-
-                for item in cache_deque:
-                    if now < item.get('expiry_time', 0):
-                        if valid_item_to_remove is None: # 找到第一个有效项
-                            valid_item_to_remove = item
-                            response_to_return = item.get('response', None)
-                            items_removed_count += 1 # 计数此项为移除
-                            
-                        else:
-                            new_deque.append(item) # 保留后续有效项
-                    else:
-                        items_removed_count += 1 # 计数过期项为移除
-
-                # 更新缓存状态
-                if items_removed_count > 0:
-                    self.cur_cache_num = max(0, self.cur_cache_num - items_removed_count)
-                    if not new_deque:
-                        # 如果所有项都被移除（过期或我们取的那个）
-                        del self.cache[cache_key]
-                    else:
-                        self.cache[cache_key] = new_deque
-
-                if valid_item_to_remove:
-                    return response_to_return, True # 返回找到的有效项
-
-            # 如果键不存在或未找到有效项
-            return None, False
+            item = self._first_valid(cache_key, now)
+            payload = None
+            if item is not None:
+                payload = item.response
+                if item.disk_id is not None:
+                    self.disk_tier.remove(item.disk_id, cache_key)
+                self._discard(item)
+
+        if payload is not None:
+            # 在锁外解压
+            return await self._restore(payload), True # 返回找到的有效项
+
+        # 内存未命中时按需查询磁盘（例如重启前写入或已被内存淘汰的项）
+        if self.disk_tier is not None and self.disk_tier.may_contain(cache_key):
+            record = await self.disk_tier.take(cache_key, remove=True)
+            if record is not None:
+                log('info', f"磁盘缓存命中: {cache_key[:8]}...")
+                return record[1], True
+
+        # 如果键不存在或未找到有效项
+        return None, False
 
     async def store(self, cache_key: str, response: Any):
         """存储响应到缓存（追加到键对应的deque）"""
         now = time.time()
-        new_item: CacheItem = {
-            'response': response,
-            'expiry_time': now + self.expiry_time,
-            'created_at': now,
-        }
+        # 在锁外估算大小，较大的响应压缩后存储
+        size = estimate_size(response)
+        payload = await self._maybe_compress(response, size)
+        if payload is not response:
+            size = estimate_size(payload)
+        new_item = CacheItem(cache_key, payload, now + self.expiry_time, now, size)
 
-        needs_cleaning = False
         async with self.lock:
             if cache_key not in self.cache:
                 self.cache[cache_key] = deque()
             
             self.cache[cache_key].append(new_item) # 追加到deque末尾
+            self._lru[new_item] = None
+            heapq.heappush(self._expiry_heap, (new_item.expiry_time, next(self._seq), new_item))
             self.cur_cache_num += 1
-            needs_cleaning = self.cur_cache_num > self.max_entries
+            self.cur_cache_bytes += new_item.size
+
+            if self.disk_tier is not None:
+                # 在锁内提交写入，保证与之后的删除按顺序执行
+                new_item.disk_id = self.disk_tier.next_id()
+                self.disk_tier.put(new_item.disk_id, cache_key, response, now, new_item.expiry_time)
 
-        if needs_cleaning:
-             # 在锁外调用清理，避免长时间持有锁
-             await self.clean_if_needed()
+            # 超出容量时立即淘汰最久未使用的项，每项 O(1)
+            evicted = self._evict_overflow()
+            self._compact_expiry_heap()
+
+        if evicted:
+            log('info', f"缓存超过容量限制（{self.max_entries} 条 / {self.max_bytes} 字节），清理了 {evicted} 个最久未使用的缓存项。当前占用约 {self.cur_cache_bytes} 字节")
 
     async def clean_expired(self):
         """清理所有缓存项中已过期的项。"""
         now = time.time()
-        keys_to_remove = []
         total_cleaned = 0
         async with self.lock:
-            # 迭代 cache 的副本以允许在循环中安全地修改 cache
-            for key, cache_deque in list(self.cache.items()):
-                original_len = len(cache_deque)
-                # 创建一个新的 deque，只包含未过期的项
-                valid_items = deque(item for item in cache_deque if now < item.get('expiry_time', 0))
-                cleaned_count = original_len - len(valid_items)
-
-                if cleaned_count > 0:
-                    log('info', f"清理键 {key[:8]}... 的过期缓存项 {cleaned_count} 个。")
-                    total_cleaned += cleaned_count
-
-                if not valid_items:
-                    keys_to_remove.append(key) # 标记此键以便稍后删除
-                    # 在持有锁时直接删除键
-                    if key in self.cache:
-                         del self.cache[key]
-                         log('info', f"缓存键 {key[:8]}... 的所有项均已过期，移除该键。")
-                elif cleaned_count > 0:
-                    # 替换为只包含有效项的 deque
-                    self.cache[key] = valid_items
-
-            # 统一更新缓存计数
-            if total_cleaned > 0:
-                 self.cur_cache_num = max(0, self.cur_cache_num - total_cleaned)
+            # 只弹出堆顶已过期的项，O(k log n)
+            while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                _, _, item = heapq.heappop(self._expiry_heap)
+                if not item.removed:
+                    self._discard(item)
+                    total_cleaned += 1
+            self._compact_expiry_heap()
+
+        if total_cleaned > 0:
+            log('info', f"清理过期缓存项 {total_cleaned} 个，剩余缓存数: {self.cur_cache_num}")
+
+        if self.disk_tier is not None:
+            disk_cleaned = await self.disk_tier.clean_expired()
+            if disk_cleaned > 0:
+                log('info', f"清理磁盘过期缓存项 {disk_cleaned} 个，剩余: {self.disk_tier.entry_count}")
 
     async def clean_if_needed(self):
-        """如果缓存总条目数超过限制，清理全局最旧的项目。"""
-
+        """如果缓存总条目数超过限制，按 LRU 顺序清理最久未使用的项目。"""
         async with self.lock: 
-            if self.cur_cache_num <= self.max_entries:
-                return
-
-            # 计算目标大小和需要移除的数量
-            target_size = max(self.max_entries - 10, 10)
-            if self.cur_cache_num <= target_size:
-                return
-
-            items_to_remove_count = self.cur_cache_num - target_size
-            log('info', f"缓存总数 {self.cur_cache_num} 超过限制 {self.max_entries}，需要清理 {items_to_remove_count} 个")
-
-            # 收集所有缓存项及其元数据
-            all_items_meta = []
-            for key, cache_deque in self.cache.items():
-                for item in cache_deque:
-                    all_items_meta.append({'key': key, 'created_at': item.get('created_at', 0), 'item': item})
-
-            # 找出最旧的 N 项
-            actual_remove_count = min(items_to_remove_count, len(all_items_meta))
-            if actual_remove_count <= 0:
-                return # 没有项目可移除或无需移除
-
-            items_to_remove = heapq.nsmallest(actual_remove_count, all_items_meta, key=lambda x: x['created_at'])
-
-            # 执行移除
-            items_actually_removed = 0
-            keys_potentially_empty = set()
-            for item_meta in items_to_remove:
-                key_to_clean = item_meta['key']
-                item_to_clean = item_meta['item']
-
-                if key_to_clean in self.cache:
-                    try:
-                        # 直接从 deque 中移除指定的 item 对象
-                        self.cache[key_to_clean].remove(item_to_clean)
-                        items_actually_removed += 1
-                        # 计数器在最后统一更新
-                        log('info', f"因容量限制，删除键 {key_to_clean[:8]}... 的旧缓存项 (创建于 {item_meta['created_at']})。")
-                        keys_potentially_empty.add(key_to_clean)
-                    except (KeyError, ValueError):
-                        log('warning', f"尝试因容量限制删除缓存项时未找到 (可能已被提前移除): {key_to_clean[:8]}...")
-                        pass
-
-            # 检查是否有 deque 因本次清理变空
-            for key in keys_potentially_empty:
-                 if key in self.cache and not self.cache[key]:
-                     del self.cache[key]
-                     log('info', f"因容量限制清理后，键 {key[:8]}... 的deque已空，移除该键。")
-
-            # 统一更新缓存计数
-            if items_actually_removed > 0:
-                 self.cur_cache_num = max(0, self.cur_cache_num - items_actually_removed)
-                 log('info', f"因容量限制，共清理了 {items_actually_removed} 个旧缓存项。清理后缓存数: {self.cur_cache_num}")
+            evicted = self._evict_overflow()
+        if evicted:
+            log('info', f"因容量限制，共清理了 {evicted} 个旧缓存项。清理后缓存数: {self.cur_cache_num}")
+
+def _encode(value: str) -> bytes:
+    return value.encode('utf-8', errors='surrogateescape')
+
 
 def generate_cache_key(chat_request, last_n_messages: int = 65536, is_gemini=False) -> str:
     """
     根据模型名称和最后 N 条消息生成请求的唯一缓存键。
+    所有消息在一次 xxh3 计算中增量哈希；图像数据按完整内容参与计算，避免仅比较前缀导致的键冲突。
     Args:
         chat_request: 包含模型和消息列表的请求对象 (符合OpenAI格式)。
         last_n_messages: 需要包含在缓存键计算中的最后消息的数量。
     Returns:
-        一个代表该请求的唯一缓存键字符串 (xxhash64哈希值)。
+        一个代表该请求的唯一缓存键字符串 (xxh3_64哈希值)。
     """
-    h = xxhash.xxh64()
+    h = xxhash.xxh3_64()
     
     # 1. 哈希模型名称
-    h.update(chat_request.model.encode('utf-8', errors='surrogateescape'))
+    h.update(_encode(chat_request.model))
 
     if last_n_messages <= 0:
         # 如果不考虑消息，直接返回基于模型的哈希
@@ -217,15 +379,13 @@ def generate_cache_key(chat_request, last_n_messages: int = 65536, is_gemini=Fal
     
     # 2. 增量哈希最后 N 条消息 (从后往前)
     if is_gemini:    
-        # log('INFO', f"开启增量哈希gemini格式内容")
         for content_item in reversed(chat_request.payload.contents):
             if messages_processed >= last_n_messages:
                 break
             role = content_item.get('role')
             if role is not None and isinstance(role, str):
                 h.update(b'role:')
-                h.update(role.encode('utf-8', errors='surrogateescape'))
-            # log('INFO', f"哈希gemini格式角色{role}")
+                h.update(_encode(role))
             parts = content_item.get('parts', [])
             if not isinstance(parts, list):
                 parts = []
@@ -233,25 +393,19 @@ def generate_cache_key(chat_request, last_n_messages: int = 65536, is_gemini=Fal
                 text_content = part.get('text')
                 if text_content is not None and isinstance(text_content, str):
                     h.update(b'text:')
-                    h.update(text_content.encode('utf-8', errors='surrogateescape'))
-                    # log('INFO', f"哈希gemini格式文本内容{text_content}")
+                    h.update(_encode(text_content))
                 
                 inline_data_obj = part.get('inline_data')
                 if inline_data_obj is not None and isinstance(inline_data_obj, dict):
-                    h.update(b'inline_data:')
                     data_payload = inline_data_obj.get('data', '')
-                    # log('INFO', f"哈希gemini格式非文本内容{data_payload[:32]}")
-                    if isinstance(data_payload, str):
-                        h.update(b'data_prefix:')
-                        h.update(data_payload[:32].encode('utf-8', errors='surrogateescape'))
+                    h.update(b'inline_data:')
+                    h.update(_encode(data_payload if isinstance(data_payload, str) else ''))
 
                 file_data_obj = part.get('file_data')
                 if file_data_obj is not None and isinstance(file_data_obj, dict):
-                    h.update(b'file_data:')
                     file_uri = file_data_obj.get('file_uri', '')
-                    if isinstance(file_uri, str):
-                        h.update(b'file_uri:')
-                        h.update(file_uri.encode('utf-8', errors='surrogateescape'))
+                    h.update(b'file_data:')
+                    h.update(_encode(file_uri if isinstance(file_uri, str) else ''))
             messages_processed += 1
     
     else :
@@ -261,31 +415,27 @@ def generate_cache_key(chat_request, last_n_messages: int = 65536, is_gemini=Fal
 
             # 哈希角色
             h.update(b'role:')
-            h.update(msg.get('role', '').encode('utf-8', errors='surrogateescape'))
+            h.update(_encode(msg.get('role', '')))
 
             # 哈希内容
             content = msg.get('content')
             if isinstance(content, str):
                 h.update(b'text:')
-                h.update(content.encode('utf-8', errors='surrogateescape'))
+                h.update(_encode(content))
             elif isinstance(content, list):
                 # 处理图文混合内容
                 for item in content:
                     item_type = item.get('type') if hasattr(item, 'get') else None
                     if item_type == 'text':
                         text = item.get('text', '') if hasattr(item, 'get') else ''
-                        h.update(b'text:') 
-                        h.update(text.encode('utf-8', errors='surrogateescape'))
+                        h.update(b'text:')
+                        h.update(_encode(text))
                     elif item_type == 'image_url':
                         image_url = item.get('image_url', {}) if hasattr(item, 'get') else {}
                         image_data = image_url.get('url', '') if hasattr(image_url, 'get') else ''
-                        
-                        h.update(b'image_url:') # 加入类型标识符
-                        if image_data.startswith('data:image/'):
-                            # 对于base64图像，使用前32字符作为标识符
-                            h.update(image_data[:32].encode('utf-8', errors='surrogateescape'))
-                        else:
-                            h.update(image_data.encode('utf-8', errors='surrogateescape'))
+                        # base64 图像同样对完整数据计算哈希
+                        h.update(b'image_url:')
+                        h.update(_encode(image_data))
 
             messages_processed += 1
     return h.hexdigest()
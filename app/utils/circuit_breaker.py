@@ -0,0 +1,146 @@
+"""
+API密钥熔断器
+
+每个密钥有三种状态：
+- closed: 正常使用
+- open: 熔断中，冷却结束前 get_available_key 会跳过该密钥
+- half_open: 冷却结束后放行一次试探请求，成功则恢复 closed，失败则按更长的冷却时间重新熔断
+
+冷却时间按上游错误类型决定：
+- invalid（400 无效密钥）/ forbidden（403）：BREAKER_AUTH_COOLDOWN
+- quota（429）：BREAKER_QUOTA_COOLDOWN 起按连续次数指数退避，最长 BREAKER_QUOTA_MAX_COOLDOWN
+- server（500/503）：连续 BREAKER_SERVER_THRESHOLD 次后熔断 BREAKER_SERVER_COOLDOWN
+只在事件循环中调用，无需加锁；正常密钥不占用状态，判断是否可用为 O(1)。
+"""
+
+import time
+from app.utils.logging import log
+from app.utils.key_store import key_state_store
+import app.config.settings as settings
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+ERROR_CLASSES = ("invalid", "forbidden", "quota", "server")
+
+
+class _KeyState:
+    __slots__ = ('state', 'until', 'error_class', 'failures', 'trips', 'last_error')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.until = 0.0
+        self.error_class = None
+        self.failures = 0   # 同类错误的连续次数
+        self.trips = 0      # 熔断次数
+        self.last_error = None
+
+
+class KeyCircuitBreaker:
+    """按密钥记录上游错误并决定是否暂时停用该密钥"""
+
+    def __init__(self):
+        # 只保存出现过错误的密钥，请求成功后移除
+        self._keys = {}
+
+    def _cooldown(self, error_class, failures):
+        """返回熔断时间（秒），None 表示暂不熔断"""
+        if error_class in ("invalid", "forbidden"):
+            return settings.BREAKER_AUTH_COOLDOWN
+        if error_class == "quota":
+            return min(settings.BREAKER_QUOTA_COOLDOWN * 2 ** (failures - 1), settings.BREAKER_QUOTA_MAX_COOLDOWN)
+        if failures >= settings.BREAKER_SERVER_THRESHOLD:
+            return settings.BREAKER_SERVER_COOLDOWN
+        return None
+
+    def allow(self, api_key) -> bool:
+        """密钥当前是否可用；熔断冷却结束时放行一次半开试探"""
+        key_state = self._keys.get(api_key)
+        if key_state is None or key_state.state == CLOSED or not settings.BREAKER_ENABLED:
+            return True
+        now = time.monotonic()
+        if now < key_state.until:
+            return False
+        # 冷却结束（或上一次试探超时仍未返回结果），放行一次试探请求
+        key_state.state = HALF_OPEN
+        key_state.until = now + settings.BREAKER_TRIAL_TIMEOUT
+        log('info', f"密钥 {api_key[:8]}... 熔断冷却结束，进入半开状态进行试探",
+            extra={'key': api_key[:8], 'request_type': 'breaker'})
+        return True
+
+    def record_success(self, api_key):
+        """请求成功，密钥恢复正常"""
+        key_state = self._keys.pop(api_key, None)
+        if key_state is not None and key_state.state != CLOSED:
+            log('info', f"密钥 {api_key[:8]}... 试探成功，解除熔断",
+                extra={'key': api_key[:8], 'request_type': 'breaker'})
+            key_state_store.clear_cooldown(api_key)
+
+    def record_failure(self, api_key, error_class, error_message=None):
+        """记录一次上游错误，按错误类型决定是否熔断"""
+        if not settings.BREAKER_ENABLED or error_class not in ERROR_CLASSES:
+            return
+        key_state = self._keys.get(api_key)
+        if key_state is None:
+            key_state = self._keys[api_key] = _KeyState()
+        if key_state.error_class == error_class:
+            key_state.failures += 1
+        else:
+            key_state.error_class = error_class
+            key_state.failures = 1
+        key_state.last_error = error_message
+        cooldown = self._cooldown(error_class, key_state.failures)
+        if cooldown is None and key_state.state == HALF_OPEN:
+            # 半开试探失败，重新熔断
+            cooldown = settings.BREAKER_SERVER_COOLDOWN
+        key_state_store.record_error(api_key, error_class, error_message, cooldown)
+        if cooldown is None:
+            return
+        key_state.state = OPEN
+        key_state.until = time.monotonic() + cooldown
+        key_state.trips += 1
+        log('warning', f"密钥 {api_key[:8]}... 因 {error_class} 错误熔断 {cooldown:g} 秒",
+            extra={'key': api_key[:8], 'request_type': 'breaker'})
+
+    def restore(self, api_key, error_class, remaining, last_error=None):
+        """恢复重启前的熔断状态，剩余 remaining 秒后进入半开试探"""
+        key_state = self._keys[api_key] = _KeyState()
+        key_state.state = OPEN
+        key_state.until = time.monotonic() + remaining
+        key_state.error_class = error_class
+        key_state.failures = 1
+        key_state.trips = 1
+        key_state.last_error = last_error
+
+    def state(self, api_key) -> str:
+        key_state = self._keys.get(api_key)
+        return key_state.state if key_state is not None else CLOSED
+
+    def retry_at(self, api_key) -> float:
+        """熔断中的密钥可再次试探的时间（time.monotonic）"""
+        key_state = self._keys.get(api_key)
+        return key_state.until if key_state is not None else 0.0
+
+    def snapshot(self):
+        """非正常状态的密钥，用于仪表盘展示"""
+        now = time.monotonic()
+        return [
+            {
+                "api_key": api_key[:8],
+                "state": key_state.state,
+                "error_class": key_state.error_class,
+                "failures": key_state.failures,
+                "trips": key_state.trips,
+                "remaining": max(0, round(key_state.until - now, 1)) if key_state.state == OPEN else 0,
+                "last_error": key_state.last_error,
+            }
+            for api_key, key_state in list(self._keys.items())
+            if key_state.state != CLOSED
+        ]
+
+    def reset(self):
+        self._keys.clear()
+
+
+key_breaker = KeyCircuitBreaker()
@@ -0,0 +1,108 @@
+"""
+按模型自适应调整并发请求数（AIMD）
+
+启用 ADAPTIVE_CONCURRENCY 后，每批并发调用数不再使用 CONCURRENT_REQUESTS、
+INCREASE_CONCURRENT_ON_FAILURE、MAX_CONCURRENT_REQUESTS，而是由本模块按模型维护：
+- 最近调用中 empty / too_short / unclosed_tags 的比例达到 ADAPTIVE_FAILURE_THRESHOLD 时，并发数加 1（加性增加）
+- 最近请求中第一批即成功的比例达到 ADAPTIVE_SUCCESS_THRESHOLD 时，并发数减半（乘性减少）
+并发数限制在 1 到 ADAPTIVE_MAX_CONCURRENCY 之间，每个请求第一批结束时调整一次。
+"""
+
+import threading
+from collections import deque
+from app.utils.logging import log
+import app.config.settings as settings
+
+# 每个模型统计的最近调用数和请求数
+WINDOW_SIZE = 50
+# 样本少于该数量时不调整
+MIN_SAMPLES = 10
+ADDITIVE_INCREASE = 1
+MULTIPLICATIVE_DECREASE = 0.5
+
+# 视为内容失败、可通过提高并发缓解的调用结果
+CONTENT_FAILURES = ("empty", "too_short", "unclosed_tags")
+
+
+class _ModelConcurrency:
+    __slots__ = ('concurrency', 'attempts', 'first_batches', 'increases', 'decreases')
+
+    def __init__(self):
+        self.concurrency = 1.0
+        self.attempts = deque(maxlen=WINDOW_SIZE)       # True 表示内容失败
+        self.first_batches = deque(maxlen=WINDOW_SIZE)  # True 表示第一批即成功
+        self.increases = 0
+        self.decreases = 0
+
+
+class AdaptiveConcurrency:
+    """进程内共享的按模型并发数控制器"""
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _state(self, model):
+        state = self._models.get(model)
+        if state is None:
+            state = self._models[model] = _ModelConcurrency()
+        return state
+
+    def limit(self, model) -> int:
+        """当前每批并发调用数"""
+        with self._lock:
+            concurrency = self._state(model).concurrency
+        return max(1, min(int(concurrency), settings.ADAPTIVE_MAX_CONCURRENCY))
+
+    def record_attempt(self, model, status):
+        """记录一次上游调用的结果，仅统计成功和内容失败"""
+        if not settings.ADAPTIVE_CONCURRENCY or status not in ("success",) + CONTENT_FAILURES:
+            return
+        with self._lock:
+            self._state(model).attempts.append(status in CONTENT_FAILURES)
+
+    def record_first_batch(self, model, success: bool):
+        """每个请求第一批调用结束时调用一次，并据此调整该模型的并发数"""
+        if not settings.ADAPTIVE_CONCURRENCY:
+            return
+        with self._lock:
+            state = self._state(model)
+            state.first_batches.append(success)
+            before = state.concurrency
+            if (len(state.attempts) >= MIN_SAMPLES and
+                    sum(state.attempts) / len(state.attempts) >= settings.ADAPTIVE_FAILURE_THRESHOLD):
+                state.concurrency = min(state.concurrency + ADDITIVE_INCREASE, settings.ADAPTIVE_MAX_CONCURRENCY)
+            elif (len(state.first_batches) >= MIN_SAMPLES and
+                    sum(state.first_batches) / len(state.first_batches) >= settings.ADAPTIVE_SUCCESS_THRESHOLD):
+                state.concurrency = max(1.0, state.concurrency * MULTIPLICATIVE_DECREASE)
+            if int(state.concurrency) > int(before):
+                state.increases += 1
+            elif int(state.concurrency) < int(before):
+                state.decreases += 1
+            else:
+                return
+            concurrency = int(state.concurrency)
+        log('info', f"自适应并发：模型 {model} 的并发数调整为 {concurrency}",
+            extra={'request_type': 'concurrency', 'model': model})
+
+    def snapshot(self):
+        """各模型的并发状态，用于仪表盘展示"""
+        with self._lock:
+            return {
+                model: {
+                    "concurrency": max(1, min(int(state.concurrency), settings.ADAPTIVE_MAX_CONCURRENCY)),
+                    "failure_rate": round(sum(state.attempts) / len(state.attempts), 3) if state.attempts else None,
+                    "first_batch_success_rate": round(sum(state.first_batches) / len(state.first_batches), 3) if state.first_batches else None,
+                    "samples": len(state.first_batches),
+                    "increases": state.increases,
+                    "decreases": state.decreases,
+                }
+                for model, state in self._models.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._models.clear()
+
+
+concurrency_controller = AdaptiveConcurrency()
@@ -0,0 +1,233 @@
+"""
+响应缓存的磁盘二级缓存（SQLite WAL）
+
+内存缓存（ResponseCacheManager）写入时同步追加到磁盘，取出时同时删除磁盘记录；
+内存因容量限制淘汰的项仍保留在磁盘上，直到过期。服务重启后，内存未命中的查找
+会按需从磁盘加载，从而避免重启后缓存命中率归零。
+
+所有 SQLite 操作都在单个后台线程中按提交顺序执行，不阻塞事件循环。
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+from app.utils.logging import log
+from app.utils.cache import cache_payload
+
+# 从磁盘取出的记录：(记录ID, 模型名, 原始响应数据, 创建时间, 过期时间)
+# 原始响应数据为单个响应字典，或真流式响应的 chunk 列表
+DiskCacheRecord = Tuple[int, str, Any, float, float]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS response_cache (
+    id INTEGER PRIMARY KEY,
+    cache_key TEXT NOT NULL,
+    model TEXT NOT NULL,
+    data BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    expiry_time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_response_cache_key ON response_cache (cache_key, id);
+CREATE INDEX IF NOT EXISTS idx_response_cache_expiry ON response_cache (expiry_time);
+"""
+
+
+class DiskCacheTier:
+    """基于 SQLite 的响应缓存磁盘层"""
+
+    def __init__(self, db_path: str, expiry_time: int, loads: Callable[[str, Any], Any]):
+        """
+        Args:
+            db_path: SQLite 数据库文件路径
+            expiry_time: 缓存过期时间（秒），对重启前写入的记录同样生效
+            loads: 由 (模型名, 原始响应数据) 重建响应对象的函数
+        """
+        self.db_path = db_path
+        self.expiry_time = expiry_time
+        self.loads = loads
+        self.ready = False  # 预热完成前，内存未命中时不查询磁盘
+        self._conn: Optional[sqlite3.Connection] = None
+        # 单线程执行器保证写入与删除按提交顺序执行
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk-cache")
+        # 磁盘上各缓存键的记录数，只在执行器线程中修改，用于快速跳过不存在的键
+        self._key_counts: Dict[str, int] = {}
+        self.entry_count = 0
+        self._last_id = 0
+        self._id_lock = threading.Lock()
+
+    def next_id(self) -> int:
+        """生成单调递增的记录ID（纳秒时间戳），重启后依然保持递增"""
+        with self._id_lock:
+            self._last_id = max(time.time_ns(), self._last_id + 1)
+            return self._last_id
+
+    def _submit(self, func, *args) -> asyncio.Future:
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # ---------- 以下方法在执行器线程中运行 ----------
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        conn.commit()
+        self._conn = conn
+
+    def _warm_start(self) -> int:
+        if self._conn is None:
+            self._open()
+        now = time.time()
+        self._conn.execute(
+            "DELETE FROM response_cache WHERE expiry_time <= ? OR created_at <= ?",
+            (now, now - self.expiry_time)
+        )
+        self._conn.commit()
+        rows = self._conn.execute(
+            "SELECT cache_key, COUNT(*) FROM response_cache GROUP BY cache_key"
+        ).fetchall()
+        self._key_counts = {key: count for key, count in rows}
+        self.entry_count = sum(self._key_counts.values())
+        return self.entry_count
+
+    def _put(self, record_id: int, cache_key: str, model: str, data: Any, created_at: float, expiry_time: float):
+        try:
+            if self._conn is None:
+                self._open()
+            # 紧凑序列化原始响应数据
+            payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (id, cache_key, model, data, created_at, expiry_time) VALUES (?, ?, ?, ?, ?, ?)",
+                (record_id, cache_key, model, payload, created_at, expiry_time)
+            )
+            self._conn.commit()
+            self._key_counts[cache_key] = self._key_counts.get(cache_key, 0) + 1
+            self.entry_count += 1
+        except Exception as e:
+            log('error', f"写入磁盘缓存失败: {str(e)}")
+
+    def _delete(self, record_id: int, cache_key: str):
+        try:
+            if self._conn is None:
+                return
+            deleted = self._conn.execute("DELETE FROM response_cache WHERE id = ?", (record_id,)).rowcount
+            self._conn.commit()
+            if deleted:
+                self._decrement_key(cache_key, deleted)
+        except Exception as e:
+            log('error', f"删除磁盘缓存失败: {str(e)}")
+
+    def _decrement_key(self, cache_key: str, count: int = 1):
+        self.entry_count = max(0, self.entry_count - count)
+        remaining = self._key_counts.get(cache_key, 0) - count
+        if remaining > 0:
+            self._key_counts[cache_key] = remaining
+        else:
+            self._key_counts.pop(cache_key, None)
+
+    def _take(self, cache_key: str, now: float, remove: bool) -> Optional[DiskCacheRecord]:
+        if self._conn is None:
+            return None
+        row = self._conn.execute(
+            "SELECT id, model, data, created_at, expiry_time FROM response_cache "
+            "WHERE cache_key = ? AND expiry_time > ? AND created_at > ? ORDER BY id LIMIT 1",
+            (cache_key, now, now - self.expiry_time)
+        ).fetchone()
+        if row is None:
+            # 只剩过期记录，顺带清理
+            deleted = self._conn.execute("DELETE FROM response_cache WHERE cache_key = ?", (cache_key,)).rowcount
+            self._conn.commit()
+            self._decrement_key(cache_key, deleted)
+            return None
+        record_id, model, payload, created_at, expiry_time = row
+        if remove:
+            self._conn.execute("DELETE FROM response_cache WHERE id = ?", (record_id,))
+            self._conn.commit()
+            self._decrement_key(cache_key)
+        return record_id, model, json.loads(payload), created_at, expiry_time
+
+    def _clean_expired(self, now: float) -> int:
+        if self._conn is None:
+            return 0
+        condition = "expiry_time <= ? OR created_at <= ?"
+        params = (now, now - self.expiry_time)
+        rows = self._conn.execute(
+            f"SELECT cache_key, COUNT(*) FROM response_cache WHERE {condition} GROUP BY cache_key", params
+        ).fetchall()
+        if not rows:
+            return 0
+        self._conn.execute(f"DELETE FROM response_cache WHERE {condition}", params)
+        self._conn.commit()
+        for key, count in rows:
+            self._decrement_key(key, count)
+        return sum(count for _, count in rows)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # ---------- 以下方法在事件循环中调用 ----------
+
+    async def warm_start(self):
+        """打开数据库、清理过期记录并加载键索引，应在后台任务中调用"""
+        try:
+            count = await self._submit(self._warm_start)
+            self.ready = True
+            log('info', f"磁盘缓存预热完成，共 {count} 条有效记录: {self.db_path}")
+        except Exception as e:
+            log('error', f"磁盘缓存预热失败，将仅使用内存缓存: {str(e)}")
+
+    def put(self, record_id: int, cache_key: str, response: Any, created_at: float, expiry_time: float):
+        """异步写入一条缓存记录（不等待完成）"""
+        data = cache_payload(response)
+        if data is None:
+            return
+        model = getattr(response, 'model', '') or ''
+        self._submit(self._put, record_id, cache_key, model, data, created_at, expiry_time)
+
+    def remove(self, record_id: int, cache_key: str):
+        """异步删除一条缓存记录（不等待完成）"""
+        self._submit(self._delete, record_id, cache_key)
+
+    def may_contain(self, cache_key: str) -> bool:
+        return self.ready and cache_key in self._key_counts
+
+    async def take(self, cache_key: str, remove: bool) -> Optional[Tuple[int, Any, float, float]]:
+        """
+        从磁盘查找键对应的最早一条有效记录。
+
+        Returns:
+            (记录ID, 重建的响应对象, 创建时间, 过期时间)，未找到时返回 None
+        """
+        if not self.may_contain(cache_key):
+            return None
+        try:
+            record = await self._submit(self._take, cache_key, time.time(), remove)
+        except Exception as e:
+            log('error', f"读取磁盘缓存失败: {str(e)}")
+            return None
+        if record is None:
+            return None
+        record_id, model, data, created_at, expiry_time = record
+        return record_id, self.loads(model, data), created_at, expiry_time
+
+    async def clean_expired(self) -> int:
+        if not self.ready:
+            return 0
+        try:
+            return await self._submit(self._clean_expired, time.time())
+        except Exception as e:
+            log('error', f"清理磁盘缓存失败: {str(e)}")
+            return 0
+
+    async def close(self):
+        """等待已提交的操作完成后关闭数据库"""
+        try:
+            await self._submit(self._close)
+        finally:
+            self._executor.shutdown(wait=True)
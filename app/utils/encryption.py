@@ -42,6 +42,20 @@ def deobfuscate_text(text: str) -> str:
     return text
 
 
+def deobfuscate_gemini_response(data: dict) -> dict:
+    """
+    Removes obfuscation characters from every text part of a Gemini response in place.
+    """
+    for candidate in data.get('candidates') or []:
+        content = candidate.get('content') if isinstance(candidate, dict) else None
+        if not isinstance(content, dict):
+            continue
+        for part in content.get('parts') or []:
+            if isinstance(part, dict) and isinstance(part.get('text'), str):
+                part['text'] = deobfuscate_text(part['text'])
+    return data
+
+
 def message_has_image(messages: List) -> bool:
     """
     Check if any message contains image content.
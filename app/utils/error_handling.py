@@ -5,6 +5,8 @@ import asyncio
 from fastapi import HTTPException, status
 from app.utils.logging import format_log_message
 from app.utils.logging import log
+from app.utils.circuit_breaker import key_breaker
+from app.utils.auth_cache import validated_key_cache
 
 logger = logging.getLogger("my_logger")
 
@@ -16,11 +18,13 @@ def handle_gemini_error(error, current_api_key) -> str:
             try:
                 error_data = error.response.json()
                 if 'error' in error_data:
-                    if error_data['error'].get('code') == "invalid_argument":
+                    if (error_data['error'].get('code') == "invalid_argument" or
+                            "API key" in str(error_data['error'].get('message', ''))):
                         error_message = "无效的 API 密钥"
                         log('ERROR', f"{current_api_key[:8]} ... {current_api_key[-3:]} → 无效，可能已过期或被删除", 
                             extra={'key': current_api_key[:8], 'status_code': status_code, 'error_message': error_message})
-                        # key_manager.blacklist_key(current_api_key)
+                        key_breaker.record_failure(current_api_key, "invalid", error_message)
+                        validated_key_cache.invalidate(current_api_key)
                         
                         return error_message
                     error_message = error_data['error'].get('message', 'Bad Request')
@@ -38,7 +42,8 @@ def handle_gemini_error(error, current_api_key) -> str:
             error_message = f"权限被拒绝"
             log('ERROR', error_message, 
                 extra={'key': current_api_key[:8], 'status_code': status_code})
-            # key_manager.blacklist_key(current_api_key)
+            key_breaker.record_failure(current_api_key, "forbidden", error_message)
+            validated_key_cache.invalidate(current_api_key)
             
             return error_message
         
@@ -46,7 +51,7 @@ def handle_gemini_error(error, current_api_key) -> str:
             error_message = f"API 密钥配额已用尽或其他原因"
             log('WARNING', error_message, 
                 extra={'key': current_api_key[:8], 'status_code': status_code})
-            # key_manager.blacklist_key(current_api_key)
+            key_breaker.record_failure(current_api_key, "quota", error_message)
              
             return error_message
         
@@ -54,12 +59,14 @@ def handle_gemini_error(error, current_api_key) -> str:
             error_message = f'Gemini API 内部错误' 
             log('WARNING', error_message, 
                 extra={'key': current_api_key[:8], 'status_code': status_code})
+            key_breaker.record_failure(current_api_key, "server", error_message)
             return error_message
   
         if status_code == 503:
             error_message = f"Gemini API 服务繁忙"
             log('WARNING', error_message, 
                 extra={'key': current_api_key[:8], 'status_code': status_code})
+            key_breaker.record_failure(current_api_key, "server", error_message)
             return error_message
         
         else:
@@ -116,7 +123,7 @@ async def handle_api_error(e: Exception, api_key: str, key_manager, request_type
             error_message = "API 密钥配额已用尽或其他原因"
             log('WARNING', f"429 官方资源耗尽或其他原因", 
                 extra={'key': api_key[:8], 'status_code': status_code, 'error_message': error_message})
-            # key_manager.blacklist_key(api_key)
+            key_breaker.record_failure(api_key, "quota", error_message)
                      
             return {'remove_cache': False,'error': error_message, 'should_switch_key': True}             
 
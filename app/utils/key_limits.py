@@ -0,0 +1,229 @@
+"""
+按（密钥, 模型）的限流账本
+
+Gemini 的配额按密钥和模型分别计算：每分钟请求数（RPM）、每分钟 token 数（TPM）和每日请求数（RPD）。
+每个（密钥, 模型）维护：
+- RPM、TPM：按秒分槽的 60 秒滑动窗口（最多 60 个槽），任意 60 秒内都不会超过限额。
+  连续补充的令牌桶在突发用完配额后 60/RPM 秒就会再次放行，而上游按分钟窗口计数时仍会返回 429
+- RPD：自上次上游配额重置（太平洋时间 0 点）以来的请求数，由 maintenance 中的定时任务在同一时间清零；
+  用尽后等到下一次重置才再放行
+每次上游调用开始时计入 1 个请求，响应返回后按 total_token_count 计入 token；
+上游返回 429 时说明本分钟的配额已用完，把当前窗口计满，一整分钟后才会再次放行该密钥。
+
+密钥调度器据此计算一个请求在该密钥上需要等待的时间，跳过会被限流的密钥；
+所有密钥都需要等待时，等待时间不超过 KEY_RATE_LIMIT_MAX_WAIT 则延迟发送，否则拒绝。
+
+模型限额配置 MODEL_RATE_LIMITS 格式为逗号分隔的 模型前缀=RPM/TPM/RPD，按最长前缀匹配，
+0 表示该项不限制；default 用于未匹配的模型，同一前缀下的模型（如 -search 变体）共用配额。
+"""
+
+import math
+import time
+from collections import Counter, deque
+from app.utils.key_store import seconds_until_reset
+import app.config.settings as settings
+
+DEFAULT_PROFILE = "default"
+# token 用量估计值的 EWMA 平滑系数
+TOKEN_ALPHA = 0.2
+
+
+def parse_rate_limits(text: str) -> dict:
+    """解析 MODEL_RATE_LIMITS，格式错误时抛出 ValueError"""
+    profiles = {}
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        model, sep, limits = item.partition('=')
+        parts = limits.split('/')
+        if not sep or not model.strip() or len(parts) != 3:
+            raise ValueError(f"无法解析模型限额 '{item}'，格式应为 模型前缀=RPM/TPM/RPD")
+        rpm, tpm, rpd = (int(x) for x in parts)
+        if min(rpm, tpm, rpd) < 0:
+            raise ValueError(f"模型限额不能为负数：'{item}'")
+        profiles[model.strip()] = (rpm, tpm, rpd)
+    return profiles
+
+
+class _MinuteWindow:
+    """按秒分槽的 60 秒滑动窗口计数"""
+    __slots__ = ('slots', 'total')
+
+    def __init__(self):
+        self.slots = deque()   # (秒, 数量)
+        self.total = 0
+
+    def _expire(self, now):
+        # 第 s 秒内的计数在 s+61 秒时完全离开窗口
+        while self.slots and self.slots[0][0] + 61 <= now:
+            self.total -= self.slots.popleft()[1]
+
+    def add(self, amount, now):
+        second = math.floor(now)
+        if self.slots and self.slots[-1][0] == second:
+            self.slots[-1] = (second, self.slots[-1][1] + amount)
+        else:
+            self.slots.append((second, amount))
+        self.total += amount
+
+    def wait(self, amount, limit, now) -> float:
+        """再计入 amount 后不超过 limit 需要等待的秒数"""
+        self._expire(now)
+        excess = self.total + amount - limit
+        if excess <= 0:
+            return 0.0
+        for second, count in self.slots:
+            excess -= count
+            if excess <= 0:
+                return second + 61 - now
+        # 单次用量超过限额时，等到窗口清空
+        return self.slots[-1][0] + 61 - now if self.slots else 0.0
+
+
+class _Buckets:
+    __slots__ = ('requests', 'tokens', 'daily')
+
+    def __init__(self):
+        self.requests = _MinuteWindow()
+        self.tokens = _MinuteWindow()
+        self.daily = 0  # 本配额日已发送的请求数
+
+
+class KeyRateLedger:
+    """记录每个（密钥, 模型）的配额用量，只在事件循环中调用，无需加锁"""
+
+    def __init__(self):
+        self._buckets = {}            # (api_key, 配额模型) -> _Buckets
+        self._token_estimates = {}    # 配额模型 -> 单次请求 token 数的 EWMA
+        self._profiles = {}
+        self._profiles_text = None
+        self._resolved = {}           # 模型 -> (配额模型, (rpm, tpm, rpd)) 或 None
+        # admitted 直接放行、delayed 延迟后放行、rejected 拒绝、throttled 上游返回 429
+        self.admission_stats = Counter()
+
+    def _profile(self, model):
+        """返回 (配额模型, (rpm, tpm, rpd))，没有适用的限额时返回 None"""
+        if self._profiles_text != settings.MODEL_RATE_LIMITS:
+            self._profiles = parse_rate_limits(settings.MODEL_RATE_LIMITS)
+            self._profiles_text = settings.MODEL_RATE_LIMITS
+            self._resolved.clear()
+        if model in self._resolved:
+            return self._resolved[model]
+        prefix = max((p for p in self._profiles if p != DEFAULT_PROFILE and model.startswith(p)), key=len, default=None)
+        if prefix is not None:
+            resolved = (prefix, self._profiles[prefix])
+        elif DEFAULT_PROFILE in self._profiles:
+            resolved = (model, self._profiles[DEFAULT_PROFILE])
+        else:
+            resolved = None
+        self._resolved[model] = resolved
+        return resolved
+
+    def quota_model(self, model):
+        """模型计入哪一组配额；未启用限流或没有适用的限额时返回 None"""
+        if not settings.KEY_RATE_LIMIT_ENABLED or not model:
+            return None
+        profile = self._profile(model)
+        return profile[0] if profile is not None else None
+
+    def _buckets_for(self, api_key, model, create=False):
+        profile = self._profile(model)
+        if profile is None:
+            return None, (0, 0, 0), None
+        quota_model, (rpm, tpm, rpd) = profile
+        buckets = self._buckets.get((api_key, quota_model))
+        if buckets is None:
+            if not create:
+                return quota_model, (rpm, tpm, rpd), None
+            buckets = self._buckets[(api_key, quota_model)] = _Buckets()
+        return quota_model, (rpm, tpm, rpd), buckets
+
+    def wait_time(self, api_key, model) -> float:
+        """在该密钥上发送一个请求前预计需要等待的秒数，0 表示可以立即发送"""
+        if not settings.KEY_RATE_LIMIT_ENABLED or not model:
+            return 0.0
+        now = time.monotonic()
+        quota_model, (rpm, tpm, rpd), buckets = self._buckets_for(api_key, model)
+        if buckets is None:
+            return 0.0
+        wait = 0.0
+        if rpm:
+            wait = buckets.requests.wait(1, rpm, now)
+        if tpm:
+            needed = min(self._token_estimates.get(quota_model, 0.0), tpm)
+            wait = max(wait, buckets.tokens.wait(needed, tpm, now))
+        if rpd and buckets.daily >= rpd:
+            wait = max(wait, seconds_until_reset())
+        return wait
+
+    def record_request(self, api_key, model):
+        """上游调用开始，计入 1 个请求"""
+        if not settings.KEY_RATE_LIMIT_ENABLED or not model:
+            return
+        now = time.monotonic()
+        _, _, buckets = self._buckets_for(api_key, model, create=True)
+        if buckets is not None:
+            buckets.requests.add(1, now)
+            buckets.daily += 1
+
+    def record_tokens(self, api_key, model, tokens):
+        """响应返回后计入实际使用的 token，并更新该模型单次请求的 token 估计值"""
+        if not settings.KEY_RATE_LIMIT_ENABLED or not model or not tokens:
+            return
+        now = time.monotonic()
+        quota_model, _, buckets = self._buckets_for(api_key, model, create=True)
+        if buckets is None:
+            return
+        buckets.tokens.add(tokens, now)
+        estimate = self._token_estimates.get(quota_model)
+        self._token_estimates[quota_model] = tokens if estimate is None else \
+            TOKEN_ALPHA * tokens + (1 - TOKEN_ALPHA) * estimate
+
+    def record_throttled(self, api_key, model):
+        """上游返回 429，说明该密钥本分钟的配额已用完，把当前窗口计满，一整分钟内不再放行"""
+        if not settings.KEY_RATE_LIMIT_ENABLED or not model:
+            return
+        now = time.monotonic()
+        _, (rpm, _, _), buckets = self._buckets_for(api_key, model, create=True)
+        if buckets is not None:
+            buckets.requests._expire(now)
+            if rpm and buckets.requests.total < rpm:
+                buckets.requests.add(rpm - buckets.requests.total, now)
+            self.admission_stats["throttled"] += 1
+
+    def restore_daily(self, api_key, model, calls):
+        """恢复重启前本配额日已发送的请求数"""
+        if not settings.KEY_RATE_LIMIT_ENABLED or not model or not calls:
+            return
+        _, _, buckets = self._buckets_for(api_key, model, create=True)
+        if buckets is not None:
+            buckets.daily += calls
+
+    def record_admission(self, result):
+        self.admission_stats[result] += 1
+
+    def snapshot(self):
+        """准入统计、各模型的 token 估计值和当前需要等待的（密钥, 模型）数，用于仪表盘展示"""
+        limited = Counter()
+        for api_key, quota_model in list(self._buckets):
+            if self.wait_time(api_key, quota_model) > 0:
+                limited[quota_model] += 1
+        return {
+            "admission": dict(self.admission_stats),
+            "token_estimates": {model: round(tokens) for model, tokens in self._token_estimates.items()},
+            "limited_keys": dict(limited),
+        }
+
+    def reset_daily(self):
+        """上游每日配额重置，清零所有（密钥, 模型）的 RPD 计数"""
+        for buckets in self._buckets.values():
+            buckets.daily = 0
+
+    def reset(self):
+        self._buckets.clear()
+        self._token_estimates.clear()
+        self.admission_stats.clear()
+
+
+key_rate_ledger = KeyRateLedger()
@@ -0,0 +1,99 @@
+"""
+API密钥池
+
+APIKeyManager.api_keys 使用的去重密钥集合，兼容原来的列表用法（in、len、迭代、append、extend、copy）：
+- 成员判断、添加、删除均为 O(1)：列表保存密钥，字典保存密钥在列表中的位置，删除时与末尾元素交换
+- 每次修改递增 version，并在有限长度的变更日志中记录 (version, 是否添加, 密钥)，
+  密钥调度器据此增量同步，不必每次都与整个密钥池比较
+"""
+
+from collections import deque
+
+# 变更日志保留的最近修改数，落后更多时调用方需要全量同步
+JOURNAL_SIZE = 4096
+
+
+class KeyPool:
+    """去重的密钥集合，不保证顺序"""
+
+    def __init__(self, keys=()):
+        self._keys = []
+        self._index = {}    # 密钥 -> 在 self._keys 中的位置
+        self.version = 0
+        self._journal = deque(maxlen=JOURNAL_SIZE)
+        self._journal_start = 0  # 变更日志能覆盖的最早版本
+        self.extend(keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, api_key):
+        return api_key in self._index
+
+    def __getitem__(self, index):
+        return self._keys[index]
+
+    def __repr__(self):
+        return f"KeyPool({len(self._keys)} keys)"
+
+    def add(self, api_key) -> bool:
+        """添加密钥，已存在时返回 False"""
+        if api_key in self._index:
+            return False
+        self._index[api_key] = len(self._keys)
+        self._keys.append(api_key)
+        self._log(True, api_key)
+        return True
+
+    # 兼容列表用法
+    append = add
+
+    def extend(self, keys) -> int:
+        """添加多个密钥，返回实际新增的数量"""
+        return sum(self.add(api_key) for api_key in keys)
+
+    def discard(self, api_key) -> bool:
+        """删除密钥，不存在时返回 False"""
+        position = self._index.pop(api_key, None)
+        if position is None:
+            return False
+        last = self._keys.pop()
+        if position < len(self._keys):
+            self._keys[position] = last
+            self._index[last] = position
+        self._log(False, api_key)
+        return True
+
+    def replace(self, keys):
+        """整体替换密钥集合，之后的调用方需要全量同步"""
+        self._keys = []
+        self._index = {}
+        self.extend(keys)
+        self.version += 1
+        self._journal.clear()
+        self._journal_start = self.version
+
+    def copy(self) -> list:
+        return list(self._keys)
+
+    def _log(self, added, api_key):
+        self.version += 1
+        if len(self._journal) == self._journal.maxlen:
+            self._journal_start = self._journal[0][0]
+        self._journal.append((self.version, added, api_key))
+
+    def changes_since(self, version):
+        """
+        返回 version 之后的变更 [(是否添加, 密钥), ...]；
+        变更日志已不能覆盖该版本时返回 None，调用方需要全量同步
+        """
+        if version == self.version:
+            return []
+        if version < self._journal_start or version > self.version:
+            return None
+        # 日志中的版本号连续，最近 count 条即为所需的变更
+        count = self.version - version
+        return [self._journal[-i][1:] for i in range(count, 0, -1)]
@@ -0,0 +1,406 @@
+"""
+按健康状况加权的API密钥调度器
+
+每个密钥维护四项指标：最近 24 小时的剩余配额、上游延迟的 EWMA、近期错误率（EWMA）和进行中的调用数，
+并合成一个权重：
+
+    权重 = 剩余配额比例 × 1/(1+延迟秒数) × (1 - ERROR_PENALTY×错误率) / (1+进行中调用数)
+
+未测得延迟的密钥按 0 秒计（优先试探新密钥）；配额用尽或处于熔断状态的密钥权重为 0。
+已用次数随调用实时增加，每进入新的一小时从调用统计的滑动窗口重新读取有调用记录的密钥，使 24 小时前的调用不再计入。
+权重保存在一棵同时维护区间和与区间最大值的线段树中，更新单个密钥、取权重最大的密钥
+（KEY_SCHEDULER=best）和按权重随机抽取（KEY_SCHEDULER=weighted）均为 O(log n)。
+KEY_SCHEDULER=random 时仍使用 APIKeyManager 原有的随机密钥栈。
+
+启用按（密钥, 模型）限流时，每个配额模型另有一棵线段树：被选中但会被限流的密钥在该树中权重置 0，
+预计等待时间过后再恢复，其他模型不受影响，因此大部分密钥被限流时选取仍为 O(log n)。
+
+只在事件循环中调用，无需加锁。
+"""
+
+import heapq
+import random
+import time
+import httpx
+from app.utils.logging import log
+from app.utils.circuit_breaker import key_breaker
+from app.utils.key_limits import key_rate_ledger
+from app.utils.key_store import current_hour
+import app.config.settings as settings
+
+SCHEDULER_MODES = ("weighted", "best", "random")
+
+# 延迟和错误率的 EWMA 平滑系数
+LATENCY_ALPHA = 0.3
+ERROR_ALPHA = 0.2
+# 错误率为 1 时权重降为原来的 10%，而不是 0，使密钥仍有机会恢复
+ERROR_PENALTY = 0.9
+
+
+class _WeightTree:
+    """同时维护区间和与区间最大值的线段树，叶子为各密钥的权重"""
+    __slots__ = ('size', 'sum', 'max')
+
+    def __init__(self, size, leaves=None):
+        self.size = size
+        self.sum = [0.0] * (2 * size)
+        self.max = [0.0] * (2 * size)
+        for slot, weight in leaves or ():
+            self.sum[size + slot] = self.max[size + slot] = weight
+        for node in range(size - 1, 0, -1):
+            self.sum[node] = self.sum[2 * node] + self.sum[2 * node + 1]
+            self.max[node] = max(self.max[2 * node], self.max[2 * node + 1])
+
+    def copy(self):
+        tree = _WeightTree.__new__(_WeightTree)
+        tree.size, tree.sum, tree.max = self.size, self.sum[:], self.max[:]
+        return tree
+
+    def leaf(self, slot):
+        return self.sum[self.size + slot]
+
+    def set(self, slot, weight):
+        node = self.size + slot
+        self.sum[node] = self.max[node] = weight
+        node //= 2
+        while node:
+            left, right = 2 * node, 2 * node + 1
+            self.sum[node] = self.sum[left] + self.sum[right]
+            self.max[node] = self.max[left] if self.max[left] >= self.max[right] else self.max[right]
+            node //= 2
+
+    def pick_best(self):
+        if self.max[1] <= 0:
+            return None
+        node = 1
+        while node < self.size:
+            left, right = 2 * node, 2 * node + 1
+            if self.max[left] == self.max[right]:
+                # 权重相同时随机选择，避免总是选中位置靠前的密钥
+                node = left if random.random() < 0.5 else right
+            else:
+                node = left if self.max[left] > self.max[right] else right
+        return node - self.size
+
+    def pick_weighted(self):
+        total = self.sum[1]
+        if total <= 0:
+            return None
+        target = random.random() * total
+        node = 1
+        while node < self.size:
+            left = 2 * node
+            if target < self.sum[left]:
+                node = left
+            else:
+                target -= self.sum[left]
+                node = left + 1
+        # 浮点误差可能落到权重为 0 的叶子上
+        if self.sum[node] <= 0:
+            return self.pick_best()
+        return node - self.size
+
+
+class _ModelView:
+    """某个配额模型的调度视图：被限流的密钥在 tree 中权重为 0"""
+    __slots__ = ('tree', 'throttled', 'ready')
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.throttled = set()  # 被限流的叶子位置
+        self.ready = []         # (预计可用的时间, 叶子位置)
+
+
+class _KeyHealth:
+    __slots__ = ('api_key', 'slot', 'latency', 'error_rate', 'in_flight', 'usage', 'parked')
+
+    def __init__(self, api_key, slot, usage=0):
+        self.api_key = api_key
+        self.slot = slot
+        self.latency = None     # 上游延迟 EWMA（秒），流式为首个数据块的时间
+        self.error_rate = 0.0   # 失败率 EWMA
+        self.in_flight = 0      # 进行中的上游调用数
+        self.usage = usage      # 最近 24 小时计入 API_KEY_DAILY_LIMIT 的调用次数
+        self.parked = False     # 处于熔断状态，暂不参与调度
+
+
+class KeyScheduler:
+    """按权重调度API密钥，密钥集合通过 sync 与 APIKeyManager.api_keys 保持一致"""
+
+    def __init__(self):
+        self._keys = {}       # api_key -> _KeyHealth
+        self._slots = []      # 叶子位置 -> _KeyHealth 或 None
+        self._free_slots = []
+        self._tree = _WeightTree(1)
+        self._views = {}      # 配额模型 -> _ModelView
+        # 熔断中的密钥：(可再次试探的时间, api_key)
+        self._parked = []
+        self._synced_list = None
+        self._synced_version = -1
+        self._daily_limit = settings.API_KEY_DAILY_LIMIT
+        self._usage = None        # 密钥 -> 最近 24 小时的调用次数，由 sync 传入
+        self._usage_hour = current_hour()
+
+    # ---------- 线段树 ----------
+
+    def _resize(self, capacity):
+        size = 1
+        while size < capacity:
+            size *= 2
+        self._slots.extend([None] * (size - len(self._slots)))
+        leaves = [(health.slot, self._weight(health)) for health in self._keys.values()]
+        self._tree = _WeightTree(size, leaves)
+        for view in self._views.values():
+            view.tree = _WeightTree(size, [(slot, 0.0 if slot in view.throttled else weight) for slot, weight in leaves])
+
+    def _set_weight(self, slot, weight):
+        """更新基础树和各模型视图中的权重"""
+        self._tree.set(slot, weight)
+        for view in self._views.values():
+            view.tree.set(slot, 0.0 if slot in view.throttled else weight)
+
+    # ---------- 权重 ----------
+
+    def _weight(self, health):
+        if health.parked:
+            return 0.0
+        limit = self._daily_limit
+        if limit > 0:
+            remaining = limit - health.usage
+            if remaining <= 0:
+                return 0.0
+            quota = remaining / limit
+        else:
+            quota = 1.0
+        latency = 1.0 / (1.0 + health.latency) if health.latency is not None else 1.0
+        return quota * latency * (1.0 - ERROR_PENALTY * health.error_rate) / (1 + health.in_flight)
+
+    def _refresh(self, health):
+        self._set_weight(health.slot, self._weight(health))
+
+    def _refresh_all(self):
+        self._resize(max(len(self._slots), 1))
+
+    # ---------- 密钥集合 ----------
+
+    def sync(self, api_keys, usage=None):
+        """
+        与密钥池保持一致，usage(api_key) 返回密钥最近 24 小时的调用次数（如 api_stats_manager.key_calls_24h）。
+        api_keys 为 KeyPool 时按其变更日志增量同步，未变化时为 O(1)；为列表时在列表对象或长度变化后全量比较
+        """
+        if usage is not None:
+            self._usage = usage
+        version = getattr(api_keys, 'version', None)
+        if version is None:
+            version = len(api_keys)
+        if api_keys is self._synced_list and version == self._synced_version:
+            return
+        changes = None
+        if api_keys is self._synced_list and hasattr(api_keys, 'changes_since'):
+            changes = api_keys.changes_since(self._synced_version)
+        if changes is not None:
+            touched = {api_key for _, api_key in changes}
+            removed = [k for k in touched if k in self._keys and k not in api_keys]
+            new_keys = [k for k in touched if k not in self._keys and k in api_keys]
+        else:
+            current = set(api_keys)
+            removed = [k for k in self._keys if k not in current]
+            new_keys = [k for k in current if k not in self._keys]
+        for api_key in removed:
+            health = self._keys.pop(api_key)
+            self._slots[health.slot] = None
+            self._free_slots.append(health.slot)
+            self._set_weight(health.slot, 0.0)
+            for view in self._views.values():
+                view.throttled.discard(health.slot)
+        if len(self._keys) + len(new_keys) > self._tree.size:
+            for api_key in new_keys:
+                self._add(api_key)
+            self._resize(len(self._slots))
+        else:
+            for api_key in new_keys:
+                self._refresh(self._add(api_key))
+        self._synced_list = api_keys
+        self._synced_version = version
+
+    def _add(self, api_key):
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            slot = len(self._keys)
+            while slot < len(self._slots) and self._slots[slot] is not None:
+                slot += 1
+            if slot >= len(self._slots):
+                self._slots.append(None)
+        health = _KeyHealth(api_key, slot, self._usage(api_key) if self._usage else 0)
+        self._slots[slot] = health
+        self._keys[api_key] = health
+        return health
+
+    # ---------- 调度 ----------
+
+    def _expire_usage(self):
+        """进入新的一小时后，从滑动窗口重新读取有调用记录的密钥的已用次数"""
+        hour = current_hour()
+        if hour == self._usage_hour:
+            return
+        self._usage_hour = hour
+        if self._usage is None:
+            return
+        changed = False
+        for health in self._keys.values():
+            if health.usage:
+                usage = self._usage(health.api_key)
+                changed = changed or usage != health.usage
+                health.usage = usage
+        if changed and self._daily_limit > 0:
+            self._refresh_all()
+
+    def _unpark_due(self):
+        now = time.monotonic()
+        while self._parked and self._parked[0][0] <= now:
+            _, api_key = heapq.heappop(self._parked)
+            health = self._keys.get(api_key)
+            if health is not None and health.parked:
+                health.parked = False
+                self._refresh(health)
+
+    def _park(self, health):
+        health.parked = True
+        self._set_weight(health.slot, 0.0)
+        heapq.heappush(self._parked, (key_breaker.retry_at(health.api_key), health.api_key))
+
+    def _view(self, quota_model):
+        view = self._views.get(quota_model)
+        if view is None:
+            view = self._views[quota_model] = _ModelView(self._tree.copy())
+        return view
+
+    def _release_due(self, view):
+        """预计等待时间已过的密钥恢复到该模型的视图中"""
+        now = time.monotonic()
+        while view.ready and view.ready[0][0] <= now:
+            _, slot = heapq.heappop(view.ready)
+            if slot in view.throttled:
+                view.throttled.discard(slot)
+                view.tree.set(slot, self._tree.leaf(slot))
+
+    def _throttle(self, view, slot, wait):
+        view.throttled.add(slot)
+        view.tree.set(slot, 0.0)
+        heapq.heappush(view.ready, (time.monotonic() + wait, slot))
+
+    def acquire(self, exclude=None, model=None):
+        """
+        按当前调度模式选出一个密钥，跳过 exclude 中的密钥、处于熔断状态的密钥，
+        以及指定模型时会被限流的密钥。返回 (api_key, wait)：
+        - 选出密钥时 wait 为 0
+        - 可选的密钥都会被限流时 api_key 为 None，wait 为其中最短的预计等待秒数
+        - 没有可用密钥（全部配额用尽、熔断或被排除）时返回 (None, None)
+        """
+        if self._daily_limit != settings.API_KEY_DAILY_LIMIT:
+            self._daily_limit = settings.API_KEY_DAILY_LIMIT
+            self._refresh_all()
+        self._expire_usage()
+        self._unpark_due()
+        quota_model = key_rate_ledger.quota_model(model)
+        view = self._view(quota_model) if quota_model else None
+        if view is not None:
+            self._release_due(view)
+        tree = view.tree if view is not None else self._tree
+        pick = tree.pick_best if settings.KEY_SCHEDULER == "best" else tree.pick_weighted
+        hidden = [self._keys[k].slot for k in exclude or () if k in self._keys]
+        for slot in hidden:
+            tree.set(slot, 0.0)
+        try:
+            for _ in range(len(self._keys)):
+                slot = pick()
+                if slot is None:
+                    break
+                health = self._slots[slot]
+                if view is not None:
+                    wait = key_rate_ledger.wait_time(health.api_key, model)
+                    if wait > 0:
+                        self._throttle(view, slot, wait)
+                        continue
+                if key_breaker.allow(health.api_key):
+                    return health.api_key, 0.0
+                self._park(health)
+            if view is not None and view.throttled:
+                return None, max(0.0, view.ready[0][0] - time.monotonic())
+            return None, None
+        finally:
+            for slot in hidden:
+                throttled = view is not None and slot in view.throttled
+                tree.set(slot, 0.0 if throttled else self._weight(self._slots[slot]))
+
+    # ---------- 调用结果 ----------
+
+    def begin(self, api_key, model=None):
+        """上游调用开始"""
+        key_rate_ledger.record_request(api_key, model)
+        health = self._keys.get(api_key)
+        if health is not None:
+            health.in_flight += 1
+            self._refresh(health)
+
+    def end(self, api_key, model=None, latency=None, error=None):
+        """
+        上游调用结束。latency 不为空表示调用成功（流式为首个数据块的延迟）；
+        error 为上游错误，请求本身有误（400/404 等）不计入密钥错误率；
+        两者都为空表示调用被取消，只减少进行中调用数。
+        """
+        if isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429:
+            key_rate_ledger.record_throttled(api_key, model)
+        health = self._keys.get(api_key)
+        if health is None:
+            return
+        health.in_flight = max(0, health.in_flight - 1)
+        if latency is not None:
+            health.latency = latency if health.latency is None else \
+                LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * health.latency
+            health.error_rate *= (1 - ERROR_ALPHA)
+            if health.parked:
+                # 半开试探成功，立即恢复调度
+                health.parked = False
+        elif error is not None and _is_key_error(error):
+            health.error_rate = ERROR_ALPHA + (1 - ERROR_ALPHA) * health.error_rate
+        self._refresh(health)
+
+    def record_usage(self, api_key, model=None, tokens=0):
+        """一次调用计入该密钥的 API_KEY_DAILY_LIMIT，tokens 计入该（密钥, 模型）的 TPM"""
+        key_rate_ledger.record_tokens(api_key, model, tokens)
+        health = self._keys.get(api_key)
+        if health is not None:
+            health.usage += 1
+            self._refresh(health)
+
+    def reset_usage(self):
+        """手动重置调用统计后清空各密钥的已用次数"""
+        for health in self._keys.values():
+            health.usage = 0
+        self._refresh_all()
+        log('info', "密钥调度器的已用次数已重置", extra={'request_type': 'scheduler'})
+
+    def health(self, api_key):
+        """单个密钥的调度指标，用于仪表盘展示"""
+        health = self._keys.get(api_key)
+        if health is None:
+            return None
+        return {
+            "latency": round(health.latency, 3) if health.latency is not None else None,
+            "error_rate": round(health.error_rate, 3),
+            "in_flight": health.in_flight,
+            "weight": round(self._weight(health), 4),
+        }
+
+
+def _is_key_error(error) -> bool:
+    """上游错误是否与密钥有关：4xx 中只有 403/429 计入，连接错误和 5xx 都计入"""
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return status_code >= 500 or status_code in (403, 429)
+    return True
+
+
+key_scheduler = KeyScheduler()
@@ -0,0 +1,291 @@
+"""
+API密钥状态的持久化存储（SQLite WAL）
+
+每个密钥一行，保存：
+- valid: 最近一次检测的结果（1 有效，0 无效，NULL 未检测）
+- cooldown_until / error_class: 熔断冷却的结束时间（time.time）和触发熔断的错误类型
+- last_error: 最近一次上游错误
+- usage: 最近 24 小时按模型、按小时统计的调用次数和 token 用量（JSON）
+- pooled: 运行中加入密钥池的密钥（如请求成功的客户端密钥），启动时合并回密钥池
+
+状态变化只修改内存并标记为待写入，每隔 KEY_STATE_FLUSH_INTERVAL 秒由后台任务在一个事务中批量写入；
+启动时用一次查询加载全部密钥的状态，恢复熔断冷却和最近 24 小时的用量，使重启后不会重新使用已耗尽配额的密钥。
+所有 SQLite 操作都在单个后台线程中按提交顺序执行，不阻塞事件循环。
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from zoneinfo import ZoneInfo
+from app.utils.logging import log
+import app.config.settings as settings
+
+# 上游每日请求配额（RPD）的重置时间：太平洋时间 0 点（随夏令时变化），maintenance 中的定时重置任务使用同一时间
+DAILY_RESET_TZ = ZoneInfo("America/Los_Angeles")
+DAILY_RESET_HOUR = 0
+# 调用次数和 token 用量按小时分桶，统计最近 USAGE_WINDOW_HOURS 小时
+USAGE_WINDOW_HOURS = 24
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS key_state (
+    api_key TEXT PRIMARY KEY,
+    valid INTEGER,
+    cooldown_until REAL NOT NULL DEFAULT 0,
+    error_class TEXT,
+    last_error TEXT,
+    usage TEXT,
+    pooled INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+"""
+
+_UPSERT = (
+    "INSERT OR REPLACE INTO key_state "
+    "(api_key, valid, cooldown_until, error_class, last_error, usage, pooled, updated_at) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def current_hour(now: Optional[float] = None) -> int:
+    """从 Unix 纪元起的小时数，用作用量分桶的编号"""
+    return int((time.time() if now is None else now) // 3600)
+
+
+def last_reset_time(now: Optional[datetime] = None) -> float:
+    """最近一次上游每日配额重置的时间（time.time）"""
+    now = now or datetime.now(DAILY_RESET_TZ)
+    reset = now.replace(hour=DAILY_RESET_HOUR, minute=0, second=0, microsecond=0)
+    if reset > now:
+        reset -= timedelta(days=1)
+    return reset.timestamp()
+
+
+def seconds_until_reset() -> float:
+    """距离下一次上游每日配额重置的秒数"""
+    now = datetime.now(DAILY_RESET_TZ)
+    last = datetime.fromtimestamp(last_reset_time(now), DAILY_RESET_TZ)
+    return max(0.0, (last + timedelta(days=1)).timestamp() - now.timestamp())
+
+
+def _load_usage(text, hour) -> dict:
+    """解析 usage 列，只保留仍在统计窗口内的小时"""
+    usage = {}
+    for model, hours in json.loads(text).items():
+        if not isinstance(hours, dict):
+            continue  # 旧版本按配额日保存的总量，无法分到小时
+        kept = {int(h): counts for h, counts in hours.items() if int(h) > hour - USAGE_WINDOW_HOURS}
+        if kept:
+            usage[model] = kept
+    return usage
+
+
+class KeyState:
+    __slots__ = ('valid', 'cooldown_until', 'error_class', 'last_error', 'usage', 'pooled')
+
+    def __init__(self):
+        self.valid = None
+        self.cooldown_until = 0.0
+        self.error_class = None
+        self.last_error = None
+        self.usage = {}  # 模型 -> {小时: [调用次数, token 用量]}
+        self.pooled = False
+
+
+class KeyStateStore:
+    """密钥状态的内存副本 + 批量写入的 SQLite 表"""
+
+    def __init__(self):
+        self.db_path = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._states: Dict[str, KeyState] = {}
+        self._dirty = set()
+        # reset_usage 可在任意线程中调用，内存状态用线程锁保护
+        self._lock = threading.Lock()
+        self._flush_task = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._executor is not None
+
+    # ---------- 以下方法在执行器线程中运行 ----------
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(key_state)")}
+        if "pooled" not in columns:
+            conn.execute("ALTER TABLE key_state ADD COLUMN pooled INTEGER NOT NULL DEFAULT 0")
+        conn.commit()
+        self._conn = conn
+        return conn.execute(
+            "SELECT api_key, valid, cooldown_until, error_class, last_error, usage, pooled FROM key_state"
+        ).fetchall()
+
+    def _write(self, rows):
+        try:
+            with self._conn:
+                self._conn.executemany(_UPSERT, rows)
+        except Exception as e:
+            log('error', f"写入密钥状态失败: {str(e)}")
+
+    def _clear_usage(self):
+        try:
+            with self._conn:
+                self._conn.execute("UPDATE key_state SET usage = NULL")
+        except Exception as e:
+            log('error', f"清除密钥用量失败: {str(e)}")
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # ---------- 以下方法在事件循环中调用 ----------
+
+    async def open(self, db_path: str) -> Dict[str, KeyState]:
+        """打开数据库并加载全部密钥状态，返回 密钥 -> KeyState（已丢弃过期的冷却和用量）"""
+        self.db_path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="key-store")
+        rows = await asyncio.wrap_future(self._executor.submit(self._open))
+        now = time.time()
+        hour = current_hour(now)
+        with self._lock:
+            for api_key, valid, cooldown_until, error_class, last_error, usage, pooled in rows:
+                state = KeyState()
+                state.valid = None if valid is None else bool(valid)
+                state.pooled = bool(pooled)
+                if cooldown_until > now:
+                    state.cooldown_until = cooldown_until
+                    state.error_class = error_class
+                state.last_error = last_error
+                if usage:
+                    state.usage = _load_usage(usage, hour)
+                self._states[api_key] = state
+            states = dict(self._states)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        log('info', f"已加载 {len(states)} 个密钥的持久化状态: {db_path}")
+        return states
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(max(0.1, settings.KEY_STATE_FLUSH_INTERVAL))
+            self.flush()
+
+    def flush(self):
+        """把待写入的状态提交给执行器，在一个事务中写入"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if not self._dirty:
+                return None
+            now = time.time()
+            rows = []
+            for api_key in self._dirty:
+                state = self._states[api_key]
+                rows.append((
+                    api_key, None if state.valid is None else int(state.valid),
+                    state.cooldown_until, state.error_class, state.last_error,
+                    json.dumps(state.usage, separators=(',', ':')) if state.usage else None,
+                    int(state.pooled), now
+                ))
+            self._dirty.clear()
+        return self._executor.submit(self._write, rows)
+
+    def _state(self, api_key) -> KeyState:
+        # 调用方需持有 self._lock
+        state = self._states.get(api_key)
+        if state is None:
+            state = self._states[api_key] = KeyState()
+        self._dirty.add(api_key)
+        return state
+
+    def record_validity(self, api_key, is_valid: bool):
+        if not self.enabled:
+            return
+        with self._lock:
+            state = self._states.get(api_key)
+            if state is not None and state.valid == is_valid:
+                return
+            self._state(api_key).valid = is_valid
+
+    def record_pooled(self, api_key):
+        """运行中加入密钥池的密钥，重启后合并回密钥池"""
+        if not self.enabled:
+            return
+        with self._lock:
+            state = self._states.get(api_key)
+            if state is not None and state.pooled:
+                return
+            self._state(api_key).pooled = True
+
+    def record_error(self, api_key, error_class, error_message, cooldown: Optional[float] = None):
+        """记录上游错误；cooldown 不为 None 时表示密钥因此熔断 cooldown 秒"""
+        if not self.enabled:
+            return
+        with self._lock:
+            state = self._state(api_key)
+            state.last_error = error_message
+            if cooldown is not None:
+                state.cooldown_until = time.time() + cooldown
+                state.error_class = error_class
+
+    def clear_cooldown(self, api_key):
+        if not self.enabled:
+            return
+        with self._lock:
+            state = self._states.get(api_key)
+            if state is None or not state.cooldown_until:
+                return
+            state = self._state(api_key)
+            state.cooldown_until = 0.0
+            state.error_class = None
+
+    def record_usage(self, api_key, model, tokens):
+        if not self.enabled:
+            return
+        hour = current_hour()
+        with self._lock:
+            hours = self._state(api_key).usage.setdefault(model, {})
+            usage = hours.get(hour)
+            if usage is None:
+                # 进入新的小时时丢弃离开统计窗口的小时，每个模型最多保留 USAGE_WINDOW_HOURS 个
+                for expired in [h for h in hours if h <= hour - USAGE_WINDOW_HOURS]:
+                    del hours[expired]
+                usage = hours[hour] = [0, 0]
+            usage[0] += 1
+            usage[1] += tokens
+
+    def reset_usage(self):
+        """手动重置统计数据时清除所有密钥的用量，可在任意线程中调用"""
+        if not self.enabled:
+            return
+        with self._lock:
+            for state in self._states.values():
+                state.usage = {}
+            # 执行器按提交顺序执行，之前提交的写入先完成，之后的写入使用已清空的内存状态
+            self._executor.submit(self._clear_usage)
+
+    async def close(self):
+        """写入剩余状态后关闭数据库"""
+        if not self.enabled:
+            return
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        self.flush()
+        executor = self._executor
+        try:
+            await asyncio.wrap_future(executor.submit(self._close))
+        finally:
+            self._executor = None
+            executor.shutdown(wait=True)
+
+
+key_state_store = KeyStateStore()
@@ -0,0 +1,102 @@
+"""
+API密钥批量检测
+
+启动时的密钥检查和仪表盘的"检测API密钥"共用同一个检测引擎：
+- 最多 KEY_CHECK_CONCURRENCY 个密钥同时检测
+- 同一上游主机的相邻两次检测请求至少间隔 KEY_CHECK_INTERVAL 秒，避免检测本身触发上游限流
+- 每检测完一个密钥就更新进度并回调，调用方可以边检测边使用已确认有效的密钥
+所有检测请求都通过上游共享连接池发送，只在事件循环中调用，无需加锁。
+"""
+
+import asyncio
+import time
+from urllib.parse import urlsplit
+from app.utils.api_key import test_api_key
+from app.utils.key_store import key_state_store
+from app.utils.logging import log
+import app.config.settings as settings
+
+
+def new_progress(total=0) -> dict:
+    """检测进度，字段与仪表盘 /test-api-keys/progress 的返回值一致"""
+    return {
+        "is_running": False,
+        "completed": 0,
+        "total": total,
+        "valid": 0,
+        "invalid": 0,
+        "is_completed": False
+    }
+
+
+class HostPacer:
+    """按上游主机限制检测请求的发送间隔"""
+
+    def __init__(self):
+        self._next_slot = {}  # 主机 -> 下一个可发送请求的时间（time.monotonic）
+
+    async def wait(self, host, interval):
+        if interval <= 0:
+            return
+        now = time.monotonic()
+        slot = max(now, self._next_slot.get(host, 0.0))
+        # 先占位再等待，并发的检测任务依次排到后面的时间点
+        self._next_slot[host] = slot + interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class KeyValidator:
+    """并发检测一批密钥"""
+
+    def __init__(self):
+        self.pacer = HostPacer()
+
+    async def run(self, keys, progress=None, on_result=None):
+        """
+        检测 keys 中的所有密钥（去重，保持原有顺序）。
+
+        Args:
+            keys: 需要检测的密钥
+            progress: 进度字典（见 new_progress），检测过程中实时更新
+            on_result: 每个密钥检测完成后的回调 on_result(key, is_valid)
+
+        Returns:
+            (有效密钥列表, 无效密钥列表)，均按 keys 中的顺序排列
+        """
+        keys = list(dict.fromkeys(keys))
+        if progress is None:
+            progress = new_progress()
+        progress.update(new_progress(len(keys)), is_running=True)
+
+        results = {}
+        host = urlsplit(settings.GEMINI_API_BASE_URL).netloc
+        semaphore = asyncio.Semaphore(max(1, settings.KEY_CHECK_CONCURRENCY))
+
+        async def check(key):
+            async with semaphore:
+                await self.pacer.wait(host, settings.KEY_CHECK_INTERVAL)
+                is_valid = await test_api_key(key)
+            results[key] = is_valid
+            key_state_store.record_validity(key, is_valid)
+            progress["completed"] += 1
+            progress["valid" if is_valid else "invalid"] += 1
+            if not is_valid:
+                log('warning', f"API密钥 {key[:8]}... 无效")
+            if on_result is not None:
+                on_result(key, is_valid)
+
+        started = time.monotonic()
+        try:
+            await asyncio.gather(*(check(key) for key in keys))
+        finally:
+            progress.update({"is_running": False, "is_completed": True})
+
+        valid_keys = [key for key in keys if results.get(key)]
+        invalid_keys = [key for key in keys if key in results and not results[key]]
+        log('info', f"密钥检测完成，共 {len(keys)} 个，有效 {len(valid_keys)} 个，无效 {len(invalid_keys)} 个，"
+                    f"耗时 {time.monotonic() - started:.1f} 秒")
+        return valid_keys, invalid_keys
+
+
+key_validator = KeyValidator()
@@ -3,8 +3,9 @@ import sys,asyncio
 from apscheduler.schedulers.asyncio import AsyncIOScheduler  # 替换为异步调度器
 from app.utils.logging import log
 from app.utils.stats import api_stats_manager
+from app.utils.key_store import DAILY_RESET_HOUR, DAILY_RESET_TZ
+from app.utils.key_limits import key_rate_ledger
 from app.utils import check_version
-from zoneinfo import ZoneInfo
 from app.config import settings,persistence
 import copy  # 添加copy模块导入
 
@@ -30,8 +31,7 @@ def schedule_cache_cleanup(response_cache_manager, active_requests_manager):
         response_cache_manager: 响应缓存管理器实例
         active_requests_manager: 活跃请求管理器实例
     """
-    beijing_tz = ZoneInfo("Asia/Shanghai")
-    scheduler = AsyncIOScheduler(timezone=beijing_tz)  # 使用 AsyncIOScheduler 替代 BackgroundScheduler
+    scheduler = AsyncIOScheduler(timezone=DAILY_RESET_TZ)  # 使用 AsyncIOScheduler 替代 BackgroundScheduler
     
     # 添加任务时直接传递异步函数（无需额外包装）
     scheduler.add_job(response_cache_manager.clean_expired, 'interval', minutes=1)
@@ -56,25 +56,22 @@ def schedule_cache_cleanup(response_cache_manager, active_requests_manager):
     # 添加同步的清理任务
     scheduler.add_job(run_cleanup, 'interval', minutes=5)
     
-    # 同样修改定时重置函数
-    def run_reset():
-        try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(api_call_stats_clean())
-        except Exception as e:
-            log('error', f"重置统计数据时出错: {str(e)}")
-        finally:
-            loop.close()
-    
     scheduler.add_job(check_version, 'interval', hours=4)
-    scheduler.add_job(run_reset, 'cron', hour=15, minute=0)
+    # 调用统计为 24 小时滑动窗口，无需定时清空；只在上游每日配额重置时清零 RPD 计数
+    scheduler.add_job(reset_daily_quota, 'cron', hour=DAILY_RESET_HOUR, minute=0)
     scheduler.start()
     return scheduler
 
+async def reset_daily_quota():
+    """
+    上游每日配额重置（太平洋时间 0 点）时清零各（密钥, 模型）的每日请求数
+    """
+    key_rate_ledger.reset_daily()
+    log('info', "上游每日配额已重置，清零各密钥的每日请求数")
+
 async def api_call_stats_clean():
     """
-    每天定时重置API调用统计数据
+    手动重置API调用统计数据
     
     使用新的统计系统重置
     """
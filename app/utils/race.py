@@ -0,0 +1,115 @@
+"""
+并发请求的竞速策略
+
+CONCURRENT_REQUESTS > 1 时，同一请求会同时使用多个密钥调用上游，返回第一个成功的响应。
+其余落败调用按 RACE_POLICY 处理：
+- cancel: 胜者确定后立即取消
+- keep-for-swipes: 继续运行并缓存响应（供重新生成使用），每个缓存键最多保留
+  RACE_KEEP_PER_KEY 条，达到上限后取消剩余调用
+- keep-until-deadline: 胜者确定后最多再运行 RACE_LOSER_DEADLINE 秒，期间完成的响应写入缓存，
+  超时后取消
+
+统计（按策略）：races 竞速次数、losers 胜者确定时仍在运行的落败调用数、
+cancelled 被取消的调用数（即节省的配额）、stored 写入缓存的落败响应数、
+dropped 已完成但被丢弃的落败响应数。
+
+HEDGE_ENABLED 时改为延迟对冲：先发起一个调用，超过 hedge_delay() 仍未返回才发起下一个，
+此时落败调用总是按 cancel 处理。
+
+真流式模式下的首个数据块竞速（STREAM_RACE_COUNT）统计记录在 "first-token" 策略下：
+races 竞速次数、cancelled 被关闭的落败流数、ttft_timeouts 首个数据块超时次数。
+"""
+
+import asyncio
+from typing import Iterable, List, Optional
+from app.utils.logging import log
+from app.utils.request import cancel_pending
+from app.utils.stats import api_stats_manager
+import app.config.settings as settings
+
+RACE_POLICIES = ("cancel", "keep-for-swipes", "keep-until-deadline")
+DEFAULT_RACE_POLICY = "keep-for-swipes"
+
+
+class RequestRace:
+    """一次请求中多个并发上游调用的竞速状态"""
+
+    def __init__(self, cache_key: str, response_cache_manager, model: str = None, policy: str = None):
+        policy = policy or settings.RACE_POLICY
+        self.policy = policy if policy in RACE_POLICIES else DEFAULT_RACE_POLICY
+        self.cache_key = cache_key
+        self.response_cache_manager = response_cache_manager
+        self.model = model
+        self.winner_claimed = False
+        # 胜者的响应直接交给请求处理函数，不经过缓存（缓存中的响应可能已被相同内容的其他请求取走）
+        self.winner_response = None
+        self._losers: List[asyncio.Task] = []
+        # 持有期限任务的引用，防止其在运行中被垃圾回收
+        self._expire_task: Optional[asyncio.Task] = None
+
+    def claim(self, response=None) -> bool:
+        """调用得到有效响应时调用，第一个调用者成为胜者并返回 True，其响应保存在 winner_response"""
+        if self.winner_claimed:
+            return False
+        self.winner_claimed = True
+        self.winner_response = response
+        return True
+
+    def _record(self, **counts):
+        api_stats_manager.record_race(self.policy, **counts)
+
+    def _cancel_losers(self, reason: str):
+        # 落败调用写入缓存后触发上限时，不取消其自身
+        current = asyncio.current_task()
+        cancelled = cancel_pending(task for task in self._losers if task is not current)
+        if cancelled:
+            self._record(cancelled=cancelled)
+            log('info', f"竞速策略 {self.policy}：{reason}，取消 {cancelled} 个落败调用",
+                extra={'request_type': 'race', 'model': self.model})
+
+    def _swipe_cache_full(self) -> bool:
+        return self.response_cache_manager.count(self.cache_key) >= settings.RACE_KEEP_PER_KEY
+
+    async def store_loser(self, response):
+        """落败调用得到有效响应后，按策略决定是否写入缓存"""
+        if self.policy == "cancel" or (self.policy == "keep-for-swipes" and self._swipe_cache_full()):
+            self._record(dropped=1)
+            return
+        await self.response_cache_manager.store(self.cache_key, response)
+        self._record(stored=1)
+        if self.policy == "keep-for-swipes" and self._swipe_cache_full():
+            self._cancel_losers("该请求的备用响应已达上限")
+
+    def settle(self, tasks: Iterable[asyncio.Task]):
+        """胜者确定后调用，按策略处理仍在运行的落败调用"""
+        self._losers = [task for task in tasks if not task.done()]
+        self._record(races=1, losers=len(self._losers))
+        if not self._losers:
+            return
+        if self.policy == "cancel":
+            self._cancel_losers("已获得成功响应")
+        elif self.policy == "keep-for-swipes":
+            if self._swipe_cache_full():
+                self._cancel_losers("该请求的备用响应已达上限")
+        else:
+            self._expire_task = asyncio.create_task(self._expire_losers(settings.RACE_LOSER_DEADLINE))
+            self._expire_task.add_done_callback(self._clear_expire_task)
+
+    def _clear_expire_task(self, task: asyncio.Task):
+        if self._expire_task is task:
+            self._expire_task = None
+
+    async def _expire_losers(self, deadline: float):
+        await asyncio.wait(self._losers, timeout=max(0, deadline))
+        self._cancel_losers(f"超过 {deadline:g} 秒期限")
+
+
+def hedge_delay(model: str) -> float:
+    """发起对冲调用前的等待时间：该模型最近调用延迟的 HEDGE_PERCENTILE 分位数，样本不足时为 HEDGE_DEFAULT_DELAY"""
+    delay = api_stats_manager.latency_percentile(model, settings.HEDGE_PERCENTILE, settings.HEDGE_MIN_SAMPLES)
+    return settings.HEDGE_DEFAULT_DELAY if delay is None else delay
+
+
+def stream_race_enabled(model: str) -> bool:
+    """模型是否启用真流式首个数据块竞速及超时检测"""
+    return not settings.STREAM_RACE_MODELS or model in settings.STREAM_RACE_MODELS
@@ -1,19 +1,218 @@
 import asyncio
 import time
-from typing import Dict, Any
+from typing import AsyncIterator, Dict, Any, List, Optional
+from fastapi.responses import StreamingResponse
 from app.utils.logging import log
 
+# 等待请求任务期间检查客户端是否断开的间隔（秒）
+DISCONNECT_CHECK_INTERVAL = 1.0
+# 广播创建后等待首个订阅者的最长时间（秒），超时仍无人订阅则放弃该广播
+SUBSCRIBE_TIMEOUT = 30.0
+# 广播重放日志的大小上限（字符/字节数），超过后不再接受新订阅者，只保留尚未被所有订阅者读取的数据块
+REPLAY_MAX_SIZE = 1024 * 1024
+# 已被所有订阅者读取的数据块累积到该数量时再从日志中移除，避免每个数据块都移动列表
+REPLAY_TRIM_BATCH = 64
+
+
+class ClientDisconnectedError(Exception):
+    """等待请求结果期间客户端已断开连接"""
+
+
+def cancel_pending(tasks) -> int:
+    """取消尚未完成的任务，返回实际取消的数量"""
+    cancelled = 0
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+            cancelled += 1
+    return cancelled
+
+
+class StreamBroadcaster:
+    """
+    单次上游请求的流式响应广播器：一个响应流同时分发给多个订阅者。
+    用于真流式/假流式请求，以及带保活的非流式请求。
+
+    上游数据块按顺序追加到共享的重放日志中，每个订阅者只持有自己的读取位置，
+    因此中途加入的订阅者会先收到已产生的全部数据块，再继续接收后续数据；
+    慢速订阅者不会阻塞上游，也不会额外占用缓冲内存。
+    重放日志超过 REPLAY_MAX_SIZE 后不再接受新订阅者，日志只保留尚未被所有订阅者读取的数据块。
+    上游请求在首个订阅者开始读取时才发起，超过 SUBSCRIBE_TIMEOUT 无人订阅则直接结束；
+    所有订阅者都断开且流尚未结束时，取消上游请求。
+    """
+
+    def __init__(self, source: AsyncIterator[Any], media_type: str = "text/event-stream"):
+        self._source = source
+        self.media_type = media_type
+        self._chunks: List[Any] = []  # 重放日志
+        self._base = 0  # 日志首个数据块在整个流中的序号
+        self._replay_size = 0
+        self.replayable = True  # 日志是否仍从流的开头保存，否则新订阅者无法获得完整重放
+        self._positions: Dict[object, int] = {}  # 各订阅者下一个要读取的数据块序号
+        self._updated = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._on_done = None
+        self._expire_handle: Optional[asyncio.TimerHandle] = None
+        self._error: Optional[BaseException] = None
+        self.done = False
+        self.subscriber_count = 0
+        self.total_subscribers = 0
+        self.created_at = time.time()
+
+    def start(self, on_done=None):
+        """开始等待订阅者，on_done 在流结束（含失败、取消和无人订阅）后调用"""
+        self._on_done = on_done
+        self._expire_handle = asyncio.get_running_loop().call_later(SUBSCRIBE_TIMEOUT, self._expire)
+
+    def _ensure_pumping(self):
+        # 首个订阅者加入时启动上游读取任务
+        if self._task is not None or self.done:
+            return
+        if self._expire_handle is not None:
+            self._expire_handle.cancel()
+            self._expire_handle = None
+        self._task = asyncio.create_task(self._pump())
+        if self._on_done is not None:
+            self._task.add_done_callback(lambda _: self._on_done())
+
+    def _expire(self):
+        self._expire_handle = None
+        if self._task is not None or self.done:
+            return
+        self.done = True
+        self._notify()
+        log('info', f"广播创建后 {SUBSCRIBE_TIMEOUT:g} 秒内无人订阅，放弃上游请求")
+        if self._on_done is not None:
+            self._on_done()
+
+    def _notify(self):
+        # 唤醒所有等待中的订阅者，并为下一批数据准备新的事件
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def _pump(self):
+        try:
+            async for chunk in self._source:
+                self._chunks.append(chunk)
+                if self.replayable:
+                    self._replay_size += len(chunk) if isinstance(chunk, (str, bytes)) else 1
+                    if self._replay_size > REPLAY_MAX_SIZE:
+                        self.replayable = False
+                self._trim()
+                self._notify()
+        except asyncio.CancelledError:
+            self._error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            self._error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _trim(self):
+        # 日志不再用于重放后，移除已被所有订阅者读取的数据块
+        if self.replayable or not self._positions:
+            return
+        consumed = min(self._positions.values()) - self._base
+        if consumed >= REPLAY_TRIM_BATCH or (consumed > 0 and consumed * 2 >= len(self._chunks)):
+            del self._chunks[:consumed]
+            self._base += consumed
+
+    @property
+    def joinable(self) -> bool:
+        """流尚未结束且重放日志完整时才允许新的订阅者加入"""
+        return not self.done and self.replayable
+
+    def _register(self) -> object:
+        # 登记新订阅者的读取位置，此后日志不会裁剪该位置之后的数据块
+        token = object()
+        self._positions[token] = self._base
+        return token
+
+    def as_response(self) -> StreamingResponse:
+        """创建一个新订阅者的流式响应，读取位置在此时登记，响应开始发送前加入的数据块不会丢失"""
+        return StreamingResponse(self.subscribe(self._register()), media_type=self.media_type)
+
+    async def subscribe(self, token: object = None) -> AsyncIterator[Any]:
+        """订阅广播，先重放已产生的数据块，再实时接收后续数据块"""
+        if token is None:
+            token = self._register()
+        self.subscriber_count += 1
+        self.total_subscribers += 1
+        self._ensure_pumping()
+        position = self._positions[token]
+        try:
+            while True:
+                # 先取出当前事件，避免在检查与等待之间错过通知
+                updated = self._updated
+                while position < self._base + len(self._chunks):
+                    chunk = self._chunks[position - self._base]
+                    position += 1
+                    self._positions[token] = position
+                    yield chunk
+                self._trim()
+                if self.done:
+                    break
+                await updated.wait()
+            if self._error is not None and not isinstance(self._error, asyncio.CancelledError):
+                raise self._error
+        finally:
+            self._positions.pop(token, None)
+            self.subscriber_count -= 1
+            if self.subscriber_count == 0 and not self.done and self._task is not None:
+                # 没有订阅者需要该流了，取消上游请求
+                self._task.cancel()
+                log('info', "广播的所有订阅者均已断开，取消上游请求")
+
 class ActiveRequestsManager:
     """管理活跃API请求的类"""
     
     def __init__(self, requests_pool: Dict[str, asyncio.Task] = None):
         self.active_requests = requests_pool if requests_pool is not None else {}  # 存储活跃请求
+        self.active_streams: Dict[str, StreamBroadcaster] = {}  # 进行中的流式请求广播
+        self.stream_join_count = 0  # 加入已有广播（避免重复上游请求）的次数
     
     def add(self, key: str, task: asyncio.Task):
         """添加新的活跃请求任务"""
         task.creation_time = time.time()  # 添加创建时间属性
         self.active_requests[key] = task
     
+    async def wait_for_task(self, task: asyncio.Task, http_request=None, timeout: float = None):
+        """
+        等待请求任务完成并返回结果，期间定期检查客户端是否断开。
+        同一任务可以被多个相同请求共同等待；客户端断开、等待超时或被取消时，
+        只有在已没有其他请求等待该任务时才取消任务（及其进行中的上游请求）。
+
+        Raises:
+            ClientDisconnectedError: 客户端已断开
+            asyncio.TimeoutError: 等待超时
+        """
+        task.waiter_count = getattr(task, 'waiter_count', 0) + 1
+        deadline = None if timeout is None else time.monotonic() + timeout
+        abandoned = False
+        try:
+            while True:
+                interval = DISCONNECT_CHECK_INTERVAL
+                if deadline is not None:
+                    interval = max(0, min(interval, deadline - time.monotonic()))
+                done, _ = await asyncio.wait({task}, timeout=interval)
+                if done:
+                    return task.result()
+                if http_request is not None and await http_request.is_disconnected():
+                    abandoned = True
+                    raise ClientDisconnectedError()
+                if deadline is not None and time.monotonic() >= deadline:
+                    abandoned = True
+                    raise asyncio.TimeoutError()
+        except asyncio.CancelledError:
+            abandoned = True
+            raise
+        finally:
+            task.waiter_count -= 1
+            if abandoned and task.waiter_count <= 0 and not task.done():
+                task.cancel()
+                log('info', "请求已无等待者，取消进行中的任务", extra={'request_type': 'non-stream'})
+
     def get(self, key: str):
         """获取活跃请求任务"""
         return self.active_requests.get(key)
@@ -25,10 +224,30 @@ class ActiveRequestsManager:
             return True
         return False
     
+    def start_stream(self, key: str, source: AsyncIterator[Any], media_type: str = "text/event-stream") -> StreamBroadcaster:
+        """为流式响应创建并启动广播器，流结束后自动移除"""
+        broadcaster = StreamBroadcaster(source, media_type)
+        self.active_streams[key] = broadcaster
+        broadcaster.start(on_done=lambda: self.remove_stream(key, broadcaster))
+        return broadcaster
+
+    def join_stream(self, key: str) -> Optional[StreamBroadcaster]:
+        """返回可加入的进行中广播，不存在或已结束时返回 None"""
+        broadcaster = self.active_streams.get(key)
+        if broadcaster is None or not broadcaster.joinable:
+            return None
+        self.stream_join_count += 1
+        return broadcaster
+
+    def remove_stream(self, key: str, broadcaster: StreamBroadcaster = None):
+        """移除广播器；指定 broadcaster 时只在仍为同一对象时移除"""
+        if broadcaster is None or self.active_streams.get(key) is broadcaster:
+            self.active_streams.pop(key, None)
+
     def clean_completed(self):
         """清理所有已完成或已取消的任务"""
         
-        for key, task in self.active_requests.items():
+        for key, task in list(self.active_requests.items()):
             if task.done() or task.cancelled():
                 del self.active_requests[key]        
         
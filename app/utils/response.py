@@ -128,3 +128,19 @@ def openAI_from_Gemini(response,stream=True):
         # 非流式响应总是包含 usage 字段，以满足 response_model 验证
         formatted_chunk["usage"] = usage_data
         return formatted_chunk
+
+
+def stream_from_cached_response(response, is_gemini=False):
+    """
+    将缓存的响应重放为 SSE 数据块。
+    真流式缓存（带 chunks）逐块重放，其余响应作为单个数据块返回。
+    """
+    chunks = getattr(response, 'chunks', None)
+    if is_gemini:
+        for chunk in (chunks if chunks is not None else [response.data]):
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    elif chunks is not None:
+        for chunk_response in response.iter_chunk_responses():
+            yield openAI_from_Gemini(chunk_response, stream=True)
+    else:
+        yield openAI_from_Gemini(response, stream=True)
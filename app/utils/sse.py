@@ -0,0 +1,165 @@
+"""
+SSE（Server-Sent Events）增量解析工具
+直接在上游返回的字节流上按空行切分事件，每个完整事件只解析一次
+"""
+
+import json
+from typing import AsyncIterator, List, Optional, Any
+
+# SSE 事件之间的分隔符（换行统一规范为 \n 之后）
+_EVENT_SEPARATOR = b"\n\n"
+
+# 流结束标志
+DONE_MARKER = b"[DONE]"
+
+
+class SSEEvent:
+    """一个完整的 SSE 事件"""
+    __slots__ = ("raw", "data")
+
+    def __init__(self, raw: bytes, data: bytes):
+        self.raw = raw    # 事件原始字节（换行已规范为 \n，不含结尾空行）
+        self.data = data  # 所有 data 字段拼接后的内容
+
+    @property
+    def is_done(self) -> bool:
+        data = self.data
+        return len(data) < 16 and data.strip() == DONE_MARKER
+
+
+class SSEDecoder:
+    """
+    增量 SSE 解码器
+
+    通过 feed() 输入任意切分的字节块，返回其中已经完整的事件。
+    未完整的事件保留在内部缓冲区中，等待后续字节。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # 下次查找分隔符的起始位置，避免对大事件重复扫描
+        self._scan_from = 0
+        # 上一块以 \r 结尾时，需要等下一块确认是否为 \r\n
+        self._trailing_cr = False
+
+    def _normalize(self, chunk: bytes) -> bytes:
+        """将 \r\n 和 \r 统一为 \n，正确处理跨块的 \r\n"""
+        if self._trailing_cr:
+            self._trailing_cr = False
+            if chunk.startswith(b"\n"):
+                chunk = chunk[1:]
+        if b"\r" not in chunk:
+            return chunk
+        if chunk.endswith(b"\r"):
+            self._trailing_cr = True
+        return chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """输入一段字节，返回其中所有已完整的事件"""
+        if not chunk:
+            return []
+        buffer = self._buffer
+        buffer += self._normalize(chunk)
+        find = buffer.find
+        last = len(buffer) - 1
+        events = []
+        start = 0
+        # 单字节查找走 memchr，比直接查找 b"\n\n" 快得多
+        pos = find(b"\n", self._scan_from)
+        with memoryview(buffer) as view:
+            while pos != -1 and pos < last:
+                if buffer[pos + 1] != 0x0A:
+                    pos = find(b"\n", pos + 1)
+                    continue
+                if pos > start:
+                    event = _parse_event(bytes(view[start:pos]))
+                    if event is not None:
+                        events.append(event)
+                start = pos + 2
+                pos = find(b"\n", start)
+        if start:
+            # 一次性丢弃已消费的字节
+            del buffer[:start]
+        # 保留末尾可能被截断的分隔符部分
+        self._scan_from = max(0, len(buffer) - 1)
+        return events
+
+    def flush(self) -> List[SSEEvent]:
+        """流结束时调用，返回缓冲区中剩余的最后一个事件（如果有）"""
+        block = bytes(self._buffer).strip(b"\n")
+        self._buffer.clear()
+        self._scan_from = 0
+        self._trailing_cr = False
+        if not block:
+            return []
+        event = _parse_event(block)
+        return [event] if event is not None else []
+
+
+def _parse_event(block: bytes) -> Optional[SSEEvent]:
+    """解析单个事件块（不含结尾空行）中的字段，只保留 data 字段"""
+    # 快速路径：单行 "data: " 事件，这是上游最常见的格式
+    if block.startswith(b"data: ") and block.find(b"\n") == -1:
+        return SSEEvent(block, block[6:])
+    data_lines = []
+    for line in block.split(b"\n"):
+        if not line:
+            continue
+        if line.startswith(b"data:"):
+            value = line[5:]
+            if value.startswith(b" "):
+                value = value[1:]
+            data_lines.append(value)
+        elif line.startswith(b":"):
+            # 注释行（常用作保活）
+            continue
+        elif line.startswith((b"event:", b"id:", b"retry:")):
+            continue
+        else:
+            # 兼容不带 data: 前缀的上游实现
+            data_lines.append(line)
+    if not data_lines:
+        return None
+    return SSEEvent(block, b"\n".join(data_lines))
+
+
+async def aiter_sse_events(byte_stream: AsyncIterator[bytes]) -> AsyncIterator[SSEEvent]:
+    """从字节流中逐个产出完整的 SSE 事件"""
+    decoder = SSEDecoder()
+    async for chunk in byte_stream:
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.flush():
+        yield event
+
+
+async def aiter_sse_json(byte_stream: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    """
+    从字节流中逐个产出解析后的 JSON 事件数据，遇到 [DONE] 时结束
+
+    每个完整事件只调用一次 json.loads；若某个事件不是完整的 JSON，
+    则与后续事件拼接后再解析（兼容把一个 JSON 拆成多个事件的上游）。
+    """
+    decoder = SSEDecoder()
+    pending = b""
+    async for chunk in byte_stream:
+        for event in decoder.feed(chunk):
+            if event.is_done:
+                return
+            payload = pending + event.data if pending else event.data
+            try:
+                data = json.loads(payload.decode("utf-8"))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                # 不完整的 JSON（或被截断的多字节字符），与后续事件拼接后再解析
+                pending = payload
+                continue
+            pending = b""
+            yield data
+    for event in decoder.flush():
+        if event.is_done:
+            return
+        payload = pending + event.data if pending else event.data
+        try:
+            yield json.loads(payload.decode("utf-8"))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return
@@ -1,26 +1,88 @@
 import asyncio 
 from datetime import datetime, timedelta
 from app.utils.logging import log
+from app.utils.circuit_breaker import key_breaker
+from app.utils.key_scheduler import key_scheduler
+from app.utils.key_store import key_state_store, current_hour, USAGE_WINDOW_HOURS
 import app.config.settings as settings
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, deque
 import time
 import threading
 import queue
 import functools
+import heapq
+from array import array
+
+# 每个模型保留的最近延迟样本数
+LATENCY_WINDOW = 200
+
+
+class HourlyUsageWindow:
+    """最近 24 小时按小时分桶的调用次数和 token 用量：定长数组实现的环形缓冲区，同时维护窗口内的总量"""
+    __slots__ = ('hour', 'buckets', 'calls', 'tokens')
+
+    def __init__(self, hour=0):
+        self.hour = hour
+        # 第 h 小时的调用次数和 token 用量分别位于 2*(h%24) 和 2*(h%24)+1
+        self.buckets = array('q', bytes(16 * USAGE_WINDOW_HOURS))
+        self.calls = 0
+        self.tokens = 0
+
+    def _advance(self, hour):
+        """移动到第 hour 小时，离开窗口的桶清零并从总量中扣除（每次最多 24 个桶）"""
+        if hour <= self.hour:
+            return
+        if hour - self.hour >= USAGE_WINDOW_HOURS:
+            self.buckets = array('q', bytes(16 * USAGE_WINDOW_HOURS))
+            self.calls = self.tokens = 0
+        else:
+            buckets = self.buckets
+            for h in range(self.hour + 1, hour + 1):
+                i = 2 * (h % USAGE_WINDOW_HOURS)
+                self.calls -= buckets[i]
+                self.tokens -= buckets[i + 1]
+                buckets[i] = buckets[i + 1] = 0
+        self.hour = hour
+
+    def add(self, calls, tokens, hour):
+        self._advance(hour)
+        if hour <= self.hour - USAGE_WINDOW_HOURS:
+            return  # 已在窗口之外
+        i = 2 * (hour % USAGE_WINDOW_HOURS)
+        self.buckets[i] += calls
+        self.buckets[i + 1] += tokens
+        self.calls += calls
+        self.tokens += tokens
+
+    def totals(self, hour):
+        """截至第 hour 小时，最近 24 小时的 (调用次数, token 用量)"""
+        self._advance(hour)
+        return self.calls, self.tokens
+
 
 class ApiStatsManager:
     """API调用统计管理器，优化性能的新实现"""
     
     def __init__(self, enable_background=True, batch_interval=1.0):
-        # 使用Counter记录API密钥和模型的调用次数
-        self.api_key_counts = Counter()  # 记录每个API密钥的调用次数
-        self.model_counts = Counter()    # 记录每个模型的调用次数
-        self.api_model_counts = defaultdict(Counter)  # 记录每个API密钥对每个模型的调用次数
+        # 最近24小时的调用次数和token使用量（HourlyUsageWindow），只为有过调用的密钥和模型分配；
+        # 密钥的总用量为其各模型用量之和（通常只有一两个模型），不再单独维护
+        self.model_usage = {}                    # 模型 -> 用量窗口
+        self.key_model_usage = defaultdict(dict) # API密钥 -> {模型: 用量窗口}
         
-        # 记录token使用量
-        self.api_key_tokens = Counter()  # 记录每个API密钥的token使用量
-        self.model_tokens = Counter()    # 记录每个模型的token使用量
-        self.api_model_tokens = defaultdict(Counter)  # 记录每个API密钥对每个模型的token使用量
+        # 客户端断开后取消的请求（按请求类型）及随之取消的上游调用数
+        self.cancelled_requests = Counter()
+        self.cancelled_upstream_calls = 0
+        
+        # 并发竞速中落败调用的处理统计（按竞速策略）
+        self.race_stats = defaultdict(Counter)
+        
+        # 每个模型最近的上游调用延迟 (秒, 是否删失)，用于计算对冲请求的滚动分位数
+        self.model_latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        # 对冲请求统计（按模型）：hedged 发起的对冲调用数，won 对冲调用胜出次数
+        self.hedge_stats = defaultdict(Counter)
+        
+        # 真流式中途断流续写统计：errors 出错中断、stalls 超时中断、attempts 续写尝试、resumed 续写成功
+        self.stream_failover_stats = Counter()
         
         # 用于时间序列分析的数据结构（最近24小时，按分钟分组）
         self.time_buckets = {}  # 格式: {timestamp_minute: {"calls": count, "tokens": count}}
@@ -89,31 +151,50 @@ class ApiStatsManager:
                 log('error', f"后台处理线程错误: {str(e)}")
                 time.sleep(1)  # 发生错误时短暂休眠
     
+    def _record_usage(self, api_key, model, calls, tokens, hour):
+        """计入用量窗口（需持有 self._counters_lock）"""
+        for windows in (self.model_usage, self.key_model_usage[api_key]):
+            window = windows.get(model)
+            if window is None:
+                window = windows[model] = HourlyUsageWindow(hour)
+            window.add(calls, tokens, hour)
+    
+    def _key_totals(self, api_key, hour):
+        """API密钥最近24小时的 (调用次数, token使用量)（需持有 self._counters_lock）"""
+        calls = tokens = 0
+        for window in self.key_model_usage.get(api_key, {}).values():
+            model_calls, model_tokens = window.totals(hour)
+            calls += model_calls
+            tokens += model_tokens
+        return calls, tokens
+    
+    def _key_calls(self, api_key, hour):
+        """API密钥最近24小时的调用次数（需持有 self._counters_lock），仪表盘对全部密钥排序时使用"""
+        windows = self.key_model_usage.get(api_key)
+        if not windows:
+            return 0
+        calls = 0
+        for window in windows.values():
+            if window.hour < hour:
+                window._advance(hour)
+            calls += window.calls
+        return calls
+    
     def _process_batch(self, batch):
         """处理一批更新"""
         with self._counters_lock:
-            for api_key, model, tokens in batch:
-                self.api_key_counts[api_key] += 1
-                self.model_counts[model] += 1
-                self.api_model_counts[api_key][model] += 1
-                self.api_key_tokens[api_key] += tokens
-                self.model_tokens[model] += tokens
-                self.api_model_tokens[api_key][model] += tokens
+            for api_key, model, tokens, hour in batch:
+                self._record_usage(api_key, model, 1, tokens, hour)
     
     async def update_stats(self, api_key, model, tokens=0):
         """更新API调用统计"""
         if self.enable_background:
             # 将更新放入队列
-            self._update_queue.put((api_key, model, tokens))
+            self._update_queue.put((api_key, model, tokens, current_hour()))
         else:
             # 同步更新
             with self._counters_lock:
-                self.api_key_counts[api_key] += 1
-                self.model_counts[model] += 1
-                self.api_model_counts[api_key][model] += 1
-                self.api_key_tokens[api_key] += tokens
-                self.model_tokens[model] += tokens
-                self.api_model_tokens[api_key][model] += tokens
+                self._record_usage(api_key, model, 1, tokens, current_hour())
         
         # 更新时间序列数据
         now = datetime.now()
@@ -155,6 +236,13 @@ class ApiStatsManager:
                 if ts < day_ago_ts:
                     del self.time_buckets[ts]
         
+        # 释放24小时内没有调用的密钥的用量窗口
+        hour = current_hour()
+        with self._counters_lock:
+            for api_key, windows in list(self.key_model_usage.items()):
+                if not any(window.totals(hour)[0] for window in windows.values()):
+                    del self.key_model_usage[api_key]
+        
         self.last_cleanup = time.time()
     
     async def maybe_cleanup(self, force=False):
@@ -165,17 +253,23 @@ class ApiStatsManager:
             self.last_cleanup = now
     
     async def get_api_key_usage(self, api_key, model=None):
-        """获取API密钥的使用统计"""
+        """获取API密钥最近24小时的调用次数"""
         with self._counters_lock:
-            if model:
-                return self.api_model_counts[api_key][model]
-            else:
-                return self.api_key_counts[api_key]
+            if not model:
+                return self._key_calls(api_key, current_hour())
+            window = self.key_model_usage.get(api_key, {}).get(model)
+            return window.totals(current_hour())[0] if window is not None else 0
+    
+    def key_calls_24h(self, api_key):
+        """API密钥最近24小时的调用次数"""
+        with self._counters_lock:
+            return self._key_calls(api_key, current_hour())
     
     def get_calls_last_24h(self):
         """获取过去24小时的总调用次数"""
+        hour = current_hour()
         with self._counters_lock:
-            return sum(self.api_key_counts.values())
+            return sum(window.totals(hour)[0] for window in self.model_usage.values())
     
     def get_calls_last_hour(self, now=None):
         """获取过去一小时的总调用次数"""
@@ -226,23 +320,30 @@ class ApiStatsManager:
         
         return calls_series, tokens_series
     
-    def get_api_key_stats(self, api_keys):
-        """获取API密钥的详细统计信息"""
+    def get_api_key_stats(self, api_keys, offset=0, limit=None):
+        """获取API密钥的详细统计信息，按调用次数从高到低排列，只返回 [offset, offset + limit) 范围内的密钥"""
         stats = []
         
+        hour = current_hour()
         with self._counters_lock:
-            for api_key in api_keys:
+            # 先只按调用次数排序，只为当前页的密钥生成详细统计
+            calls_of = functools.partial(self._key_calls, hour=hour)
+            if limit is None:
+                page_keys = sorted(api_keys, key=calls_of, reverse=True)[offset:]
+            else:
+                page_keys = heapq.nlargest(offset + limit, api_keys, key=calls_of)[offset:]
+            for api_key in page_keys:
                 api_key_id = api_key[:8]
-                calls_24h = self.api_key_counts[api_key]
-                total_tokens = self.api_key_tokens[api_key]
+                calls_24h, total_tokens = self._key_totals(api_key, hour)
                 
                 model_stats = {}
-                for model, count in self.api_model_counts[api_key].items():
-                    tokens = self.api_model_tokens[api_key][model]
-                    model_stats[model] = {
-                        'calls': count,
-                        'tokens': tokens
-                    }
+                for model, window in self.key_model_usage.get(api_key, {}).items():
+                    count, tokens = window.totals(hour)
+                    if count:
+                        model_stats[model] = {
+                            'calls': count,
+                            'tokens': tokens
+                        }
                 
                 usage_percent = (calls_24h / settings.API_KEY_DAILY_LIMIT) * 100 if settings.API_KEY_DAILY_LIMIT > 0 else 0
                 
@@ -252,21 +353,81 @@ class ApiStatsManager:
                     'total_tokens': total_tokens,
                     'limit': settings.API_KEY_DAILY_LIMIT,
                     'usage_percent': round(usage_percent, 2),
+                    'breaker_state': key_breaker.state(api_key),
+                    'scheduler': key_scheduler.health(api_key),
                     'model_stats': model_stats
                 })
         
-        stats.sort(key=lambda x: x['usage_percent'], reverse=True)
         return stats
     
+    def restore_usage(self, api_key, model, hour, calls, tokens):
+        """恢复重启前第 hour 小时的调用次数和 token 用量"""
+        with self._counters_lock:
+            self._record_usage(api_key, model, calls, tokens, hour)
+    
+    def record_cancellation(self, request_type, upstream_calls=0):
+        """记录一次因客户端断开而取消的请求及其取消的上游调用数"""
+        with self._counters_lock:
+            self.cancelled_requests[request_type] += 1
+            self.cancelled_upstream_calls += upstream_calls
+    
+    def record_race(self, policy, **counts):
+        """累加竞速策略的统计项"""
+        with self._counters_lock:
+            self.race_stats[policy].update(counts)
+    
+    def record_latency(self, model, seconds, censored=False):
+        """
+        记录一次上游调用延迟。
+        censored 表示调用在返回前已被取消（如对冲中落败），seconds 只是其实际延迟的下界。
+        """
+        with self._counters_lock:
+            self.model_latencies[model].append((seconds, censored))
+    
+    def latency_percentile(self, model, percentile, min_samples=1):
+        """
+        返回模型最近调用延迟的分位数（秒），样本不足 min_samples 时返回 None。
+        被取消的调用按右删失样本处理（Kaplan-Meier 估计），避免只统计胜者导致分位数偏低；
+        删失样本过多、估计达不到该分位数时返回最大的样本值。
+        """
+        with self._counters_lock:
+            samples = sorted(self.model_latencies.get(model, ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        target = percentile / 100
+        survival = 1.0
+        at_risk = len(samples)
+        for seconds, censored in samples:
+            if not censored:
+                survival *= 1 - 1 / at_risk
+                if 1 - survival >= target:
+                    return seconds
+            at_risk -= 1
+        return samples[-1][0]
+    
+    def record_hedge(self, model, **counts):
+        """累加对冲请求的统计项"""
+        with self._counters_lock:
+            self.hedge_stats[model].update(counts)
+    
+    def record_stream_failover(self, **counts):
+        """累加真流式断流续写的统计项"""
+        with self._counters_lock:
+            self.stream_failover_stats.update(counts)
+    
     async def reset(self):
         """重置所有统计数据"""
         with self._counters_lock:
-            self.api_key_counts.clear()
-            self.model_counts.clear()
-            self.api_model_counts.clear()
-            self.api_key_tokens.clear()
-            self.model_tokens.clear()
-            self.api_model_tokens.clear()
+            self.stream_failover_stats.clear()
+            self.race_stats.clear()
+            self.model_latencies.clear()
+            self.hedge_stats.clear()
+            self.cancelled_requests.clear()
+            self.cancelled_upstream_calls = 0
+            self.model_usage.clear()
+            self.key_model_usage.clear()
+        key_scheduler.reset_usage()
+        key_state_store.reset_usage()
         
         with self._time_series_lock:
             self.time_buckets.clear()
@@ -293,6 +454,10 @@ async def update_api_call_stats(api_call_stats, endpoint=None, model=None, token
     """更新API调用统计的函数 (兼容旧接口)"""
     if endpoint and model:
         await api_stats_manager.update_stats(endpoint, model, token if token is not None else 0)
+        # 调用已得到上游响应，密钥恢复正常（解除熔断）
+        key_breaker.record_success(endpoint)
+        key_scheduler.record_usage(endpoint, model, token or 0)
+        key_state_store.record_usage(endpoint, model, token or 0)
 
 async def get_api_key_usage(api_call_stats, api_key, model=None):
     """获取API密钥的调用次数 (兼容旧接口)"""
@@ -0,0 +1,117 @@
+"""
+密钥池基准：原来的列表 vs KeyPool，以及密钥调度器同步、取密钥和仪表盘密钥统计的耗时
+
+用法（在仓库根目录运行）：
+    python benchmarks/bench_key_pool.py [密钥数]
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.CRITICAL)
+
+import app.config.settings as settings
+from app.utils.key_pool import KeyPool
+from app.utils.api_key import APIKeyManager
+from app.utils.key_scheduler import KeyScheduler
+from app.utils.stats import ApiStatsManager
+from app.utils.key_store import current_hour
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+keys = [f"AIzaSy{i:033d}" for i in range(N)]
+settings.ENABLE_STORAGE = False
+settings.BREAKER_ENABLED = False
+settings.KEY_RATE_LIMIT_ENABLED = False
+
+
+def bench(label, func, n):
+    started = time.perf_counter()
+    func(n)
+    print(f"{label}: {(time.perf_counter() - started) / n * 1e6:.2f} us/次")
+
+
+def list_add(n):
+    pool = list(keys)
+    for i in range(n):
+        key = f"x{i}"
+        if key not in pool:
+            pool.append(key)
+
+
+def pool_ops():
+    pool = KeyPool(keys)
+    bench("KeyPool 添加", lambda n: [pool.add(f"y{i}") for i in range(n)], 100_000)
+    bench("KeyPool 成员判断", lambda n: [keys[-1] in pool for _ in range(n)], 100_000)
+    bench("KeyPool 删除", lambda n: [pool.discard(f"y{i}") for i in range(n)], 100_000)
+
+
+def scheduler_sync():
+    settings.KEY_SCHEDULER = "weighted"
+    scheduler = KeyScheduler()
+    key_list = list(keys)
+    scheduler.sync(key_list)
+
+    def list_sync(n):
+        for i in range(n):
+            key_list.append(f"z{i}")
+            scheduler.sync(key_list)
+    bench("添加 1 个密钥后调度器同步（列表，全量比较）", list_sync, 20)
+
+    scheduler = KeyScheduler()
+    pool = KeyPool(keys)
+    scheduler.sync(pool)
+
+    def pool_sync(n):
+        for i in range(n):
+            pool.add(f"z{i}")
+            scheduler.sync(pool)
+    bench("添加 1 个密钥后调度器同步（KeyPool，变更日志）", pool_sync, 2000)
+
+
+async def manager():
+    settings.GEMINI_API_KEYS = ",".join(keys)
+    key_manager = APIKeyManager()
+    count = 2000
+    started = time.perf_counter()
+    for i in range(count):
+        await key_manager.add_successful_client_key(f"AIzaSy{'c' * 27}{i:06d}")
+    print(f"add_successful_client_key: {(time.perf_counter() - started) / count * 1e6:.2f} us/次")
+    for mode in ("weighted", "random"):
+        settings.KEY_SCHEDULER = mode
+        await key_manager.get_available_key()
+        started = time.perf_counter()
+        for _ in range(20000):
+            await key_manager.get_available_key()
+        print(f"get_available_key（{mode}）: {(time.perf_counter() - started) / 20000 * 1e6:.2f} us/次")
+    key_manager.scheduler.shutdown(wait=False)
+
+
+def dashboard_stats():
+    stats = ApiStatsManager(enable_background=False)
+    hour = current_hour()
+    for api_key in keys:
+        stats.restore_usage(api_key, "gemini-2.5-pro", hour, random.randint(1, 100), 1000)
+    started = time.perf_counter()
+    full = stats.get_api_key_stats(keys)
+    middle = time.perf_counter()
+    page = stats.get_api_key_stats(keys, 0, 100)
+    ended = time.perf_counter()
+    print(f"api_key_stats 全部: {(middle - started) * 1000:.0f} ms, {len(json.dumps(full, default=str)) / 1e6:.1f} MB；"
+          f"每页 100 个: {(ended - middle) * 1000:.0f} ms, {len(json.dumps(page, default=str)) / 1e3:.1f} KB")
+
+
+if __name__ == "__main__":
+    print(f"Python {sys.version.split()[0]}，{N} 个密钥")
+    lst = list(keys)
+    bench("列表 添加（先判断是否存在）", list_add, 200)
+    bench("列表 成员判断", lambda n: [keys[-1] in lst for _ in range(n)], 200)
+    pool_ops()
+    scheduler_sync()
+    asyncio.run(manager())
+    dashboard_stats()
@@ -0,0 +1,106 @@
+"""
+密钥调度器的离散事件模拟：原来的随机密钥栈 vs KeyScheduler 的 weighted / best 模式
+
+模拟 N 个密钥（延迟为中位数 3 秒的对数正态分布，10% 的密钥有 50% 的失败率），
+保持 200 个并发请求，失败的调用换一个密钥重试，统计请求平均延迟、调用失败率和每次选取密钥的耗时。
+原实现为随机打乱的密钥栈，逐个检查每日限额。
+
+用法（在仓库根目录运行）：
+    python benchmarks/bench_key_scheduler.py [请求数] [已用尽配额的密钥比例] [密钥数]
+例如 python benchmarks/bench_key_scheduler.py 200000 0.99
+"""
+
+import heapq
+import logging
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.CRITICAL)
+
+import app.config.settings as settings
+from app.utils.key_scheduler import KeyScheduler
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+EXHAUSTED = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+N = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+CONCURRENCY = 200
+DAILY_LIMIT = 100
+
+settings.BREAKER_ENABLED = False
+settings.KEY_RATE_LIMIT_ENABLED = False
+settings.API_KEY_DAILY_LIMIT = DAILY_LIMIT
+
+rng = random.Random(1)
+keys = [f"k{i:05d}" for i in range(N)]
+true_latency = {k: 3.0 * math.exp(rng.gauss(0, 0.6)) for k in keys}
+true_error = {k: (0.5 if rng.random() < 0.1 else 0.01) for k in keys}
+
+
+def run(mode):
+    random.seed(2)
+    r = random.Random(3)
+    settings.KEY_SCHEDULER = mode
+    usage = {k: (DAILY_LIMIT if i < EXHAUSTED * N else 0) for i, k in enumerate(keys)}
+    scheduler = KeyScheduler()
+    scheduler.sync(keys, usage.get)
+    stack = []
+
+    def legacy_pick():
+        # 原实现：随机栈 + 逐个检查每日限额
+        for _ in range(2 * N):
+            if not stack:
+                stack.extend(keys)
+                r.shuffle(stack)
+            api_key = stack.pop()
+            if usage[api_key] < DAILY_LIMIT:
+                return api_key
+        return None
+
+    now = 0.0
+    events = []
+    attempts = failures = done = started = picks = 0
+    total_latency = pick_time = 0.0
+
+    def start(request_started):
+        nonlocal pick_time, picks, attempts
+        t0 = time.perf_counter()
+        api_key = legacy_pick() if mode == "random" else scheduler.acquire()[0]
+        pick_time += time.perf_counter() - t0
+        picks += 1
+        if api_key is None:
+            return
+        scheduler.begin(api_key)
+        attempts += 1
+        duration = true_latency[api_key] * r.uniform(0.7, 1.3)
+        heapq.heappush(events, (now + duration, api_key, duration, request_started))
+
+    while started < min(CONCURRENCY, REQUESTS):
+        start(now)
+        started += 1
+    while events:
+        now, api_key, duration, request_started = heapq.heappop(events)
+        if r.random() < true_error[api_key]:
+            failures += 1
+            scheduler.end(api_key, error=RuntimeError())
+            start(request_started)
+        else:
+            scheduler.end(api_key, latency=duration)
+            scheduler.record_usage(api_key)
+            usage[api_key] += 1
+            done += 1
+            total_latency += now - request_started
+            if started < REQUESTS:
+                start(now)
+                started += 1
+    print(f"{mode:8s} 完成请求 {done}  调用失败率 {failures / max(attempts, 1):.3f}  "
+          f"请求平均延迟 {total_latency / max(done, 1):.2f}s  每次选取 {pick_time / max(picks, 1) * 1e6:.1f}us")
+
+
+if __name__ == "__main__":
+    print(f"Python {sys.version.split()[0]}，{N} 个密钥，{REQUESTS} 个请求，{EXHAUSTED:.0%} 的密钥已用尽每日配额")
+    for mode in ("random", "weighted", "best"):
+        run(mode)
@@ -0,0 +1,173 @@
+"""
+GeminiResponseWrapper 的 CPU 和内存基准：原来的立即计算实现 vs 现在的 __slots__ + 惰性属性实现
+
+使用 1000 个与真实流式响应结构相同的数据块（每块约 200 个字符的文本和 usageMetadata），分别测量：
+- 只构造包装对象
+- 构造后转换为 OpenAI 流式格式（openAI_from_Gemini，流式热路径）
+- 1000 个存活的包装对象额外占用的内存（tracemalloc，不含数据块本身）
+
+用法（在仓库根目录运行）：
+    python benchmarks/bench_response_wrapper.py [重复次数]
+"""
+
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.gemini import GeminiResponseWrapper
+from app.utils.response import openAI_from_Gemini
+
+REPEAT = int(sys.argv[1]) if len(sys.argv) > 1 else 9
+CHUNKS = 1000
+
+
+class EagerResponseWrapper:
+    """原实现（去掉 encrypt-full 去混淆分支）：构造时运行全部提取函数并生成缩进的 JSON 副本"""
+
+    def __init__(self, data, model_name="gemini"):
+        self._data = data
+        self._model = model_name
+        self._text = self._extract_text()
+        self._finish_reason = self._extract_finish_reason()
+        self._prompt_token_count = self._extract_usage('promptTokenCount')
+        self._candidates_token_count = self._extract_usage('candidatesTokenCount')
+        self._total_token_count = self._extract_usage('totalTokenCount')
+        self._thoughts = self._extract_thoughts()
+        self._function_call = self._extract_function_call()
+        self._json_dumps = json.dumps(self._data, indent=4, ensure_ascii=False)
+
+    def _extract_thoughts(self):
+        try:
+            thoughts_text = ""
+            for part in self._data['candidates'][0]['content']['parts']:
+                if 'thought' in part:
+                    thoughts_text += part['text']
+            return thoughts_text if thoughts_text else ""
+        except (KeyError, IndexError):
+            return ""
+
+    def _extract_text(self):
+        try:
+            text = ""
+            for part in self._data['candidates'][0]['content']['parts']:
+                if 'thought' not in part and 'text' in part:
+                    text += part['text']
+            return text
+        except (KeyError, IndexError):
+            return ""
+
+    def _extract_function_call(self):
+        try:
+            parts = self._data.get('candidates', [{}])[0].get('content', {}).get('parts', [])
+            function_calls = [part['functionCall'] for part in parts if isinstance(part, dict) and 'functionCall' in part]
+            return function_calls if function_calls else None
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def _extract_finish_reason(self):
+        try:
+            return self._data['candidates'][0].get('finishReason')
+        except (KeyError, IndexError):
+            return None
+
+    def _extract_usage(self, name):
+        try:
+            return self._data['usageMetadata'].get(name)
+        except KeyError:
+            return None
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def text(self):
+        return self._text
+
+    @property
+    def finish_reason(self):
+        return self._finish_reason
+
+    @property
+    def prompt_token_count(self):
+        return self._prompt_token_count
+
+    @property
+    def candidates_token_count(self):
+        return self._candidates_token_count
+
+    @property
+    def total_token_count(self):
+        return self._total_token_count
+
+    @property
+    def thoughts(self):
+        return self._thoughts
+
+    @property
+    def json_dumps(self):
+        return self._json_dumps
+
+    @property
+    def model(self):
+        return self._model
+
+    @property
+    def function_call(self):
+        return self._function_call
+
+
+def recorded_stream():
+    """结构与上游流式响应相同的 1000 个数据块，最后一块带结束原因"""
+    chunks = []
+    for i in range(CHUNKS):
+        candidate = {"content": {"parts": [{"text": f"第{i}段：" + "流式响应文本" * 33}], "role": "model"}, "index": 0}
+        if i == CHUNKS - 1:
+            candidate["finishReason"] = "STOP"
+        chunks.append({
+            "candidates": [candidate],
+            "usageMetadata": {"promptTokenCount": 1200, "candidatesTokenCount": i + 1, "totalTokenCount": 1201 + i},
+            "modelVersion": "gemini-2.5-pro",
+        })
+    return chunks
+
+
+def best_of(func):
+    best = float("inf")
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def retained_kib(cls, chunks):
+    gc.collect()
+    tracemalloc.start()
+    wrappers = [cls(chunk, "gemini-2.5-pro") for chunk in chunks]
+    # 模拟热路径读取的属性
+    for wrapper in wrappers:
+        wrapper.text, wrapper.finish_reason, wrapper.total_token_count
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del wrappers
+    return size / 1024
+
+
+def main():
+    chunks = recorded_stream()
+    print(f"Python {sys.version.split()[0]}，{CHUNKS} 个数据块，每项取 {REPEAT} 次中的最好成绩")
+    for label, cls in (("原实现", EagerResponseWrapper), ("新实现", GeminiResponseWrapper)):
+        construct = best_of(lambda: [cls(chunk, "gemini-2.5-pro") for chunk in chunks])
+        convert = best_of(lambda: [openAI_from_Gemini(cls(chunk, "gemini-2.5-pro"), stream=True) for chunk in chunks])
+        print(f"{label}: 构造 {construct:6.1f} ms  构造+openAI_from_Gemini {convert:6.1f} ms  "
+              f"存活对象内存 {retained_kib(cls, chunks):7.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
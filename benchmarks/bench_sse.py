@@ -0,0 +1,122 @@
+"""
+上游 SSE 流解析的微基准：原来的逐行 json.loads 循环 vs app.utils.sse 的增量字节解析器
+
+两种实现都通过 httpx.Response 读取同一份数据（原实现使用 aiter_lines()，新实现使用 aiter_bytes()），
+分别测试单个事件跨越多个 data 行（原实现为平方复杂度）和单行事件两种情况。
+
+用法（在仓库根目录运行）：
+    python benchmarks/bench_sse.py [重复次数]
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from app.utils.sse import aiter_sse_json
+
+REPEAT = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+
+class _ChunkStream(httpx.AsyncByteStream):
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+async def old_loop(chunks):
+    """原 GeminiClient.stream_chat 的解析循环：每读一行都对累积的缓冲区重新 json.loads"""
+    response = httpx.Response(200, stream=_ChunkStream(chunks))
+    buffer = b""
+    count = 0
+    async for line in response.aiter_lines():
+        if not line.strip():
+            continue
+        if line.startswith("data: "):
+            line = line[len("data: "):].strip()
+        if line == "[DONE]":
+            break
+        buffer += line.encode()
+        try:
+            json.loads(buffer.decode())
+            buffer = b""
+            count += 1
+        except json.JSONDecodeError:
+            continue
+    return count
+
+
+async def new_decoder(chunks):
+    response = httpx.Response(200, stream=_ChunkStream(chunks))
+    count = 0
+    async for _ in aiter_sse_json(response.aiter_bytes()):
+        count += 1
+    return count
+
+
+def _split(body, read_size):
+    return [body[i:i + read_size] for i in range(0, len(body), read_size)]
+
+
+def single_line_events(text_size, count, read_size=16384):
+    body = b"".join(
+        b"data: " + json.dumps({"candidates": [{"content": {"parts": [{"text": "y" * text_size}]}}], "i": i}).encode() + b"\n\n"
+        for i in range(count)
+    )
+    return _split(body, read_size)
+
+
+def multi_line_events(text_size, count, lines, read_size=16384):
+    """每个事件的 JSON 分成约 lines 个 data 行"""
+    events = []
+    for i in range(count):
+        # indent=1 的 JSON 每个数组元素占一行，保证可以分成 lines 个 data 行
+        payload = {"candidates": [{"content": {"parts": [{"text": "y" * text_size}]}}], "i": i, "index": list(range(lines))}
+        text = json.dumps(payload, indent=1)
+        rows = text.split("\n")
+        per = -(-len(rows) // lines)
+        groups = ["".join(rows[j:j + per]) for j in range(0, len(rows), per)]
+        events.append(b"".join(b"data: " + group.encode() + b"\n" for group in groups) + b"\n")
+    return _split(b"".join(events), read_size)
+
+
+CASES = [
+    ("100 个事件 x 1000 个 data 行", lambda: multi_line_events(200, 100, 1000)),
+    ("500 个事件 x 50 个 data 行", lambda: multi_line_events(200, 500, 50)),
+    ("200 个事件 x 10 个 data 行（每个约 40KB）", lambda: multi_line_events(40000, 200, 10)),
+    ("2000 个 4KB 单行事件，16KB 读取", lambda: single_line_events(4000, 2000)),
+    ("20 个 400KB 单行事件，16KB 读取", lambda: single_line_events(400000, 20)),
+    ("5000 个 100B 单行事件，4KB 读取", lambda: single_line_events(100, 5000, 4096)),
+]
+
+
+async def best_of(func, chunks):
+    best = float("inf")
+    count = 0
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        count = await func(chunks)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, count
+
+
+async def main():
+    print(f"Python {sys.version.split()[0]}，每项取 {REPEAT} 次中的最好成绩")
+    for label, make in CASES:
+        chunks = make()
+        old_ms, old_count = await best_of(old_loop, chunks)
+        new_ms, new_count = await best_of(new_decoder, chunks)
+        assert old_count == new_count, (label, old_count, new_count)
+        size = sum(len(chunk) for chunk in chunks) / 1024
+        print(f"{label}（{size:.0f}KB）: 原实现 {old_ms:8.1f} ms  新实现 {new_ms:8.1f} ms  ({old_ms / new_ms:.1f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())